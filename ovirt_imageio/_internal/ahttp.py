@@ -0,0 +1,255 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+ahttp - event loop HTTP server.
+
+The threaded http.Server uses a thread per connection, blocked on the socket
+while the connection is idle. This server waits for idle connections in an
+asyncio event loop, and serves requests using a fixed number of worker
+threads. A worker serves one request, and returns the connection to the event
+loop, so thousands of mostly idle connections are served by few threads.
+
+Request handlers are the same blocking handlers used by http.Server; only
+waiting for the next request and the TLS handshake moved out of the request
+threads.
+"""
+
+import asyncio
+import logging
+import socket
+import ssl
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import http
+
+log = logging.getLogger("ahttp")
+
+
+class Server(http.Server):
+    """
+    Event loop HTTP server.
+    """
+
+    # Number of worker threads when max_workers is not set.
+    default_workers = 64
+
+    def __init__(self, server_address, RequestHandlerClass, prefer_ipv4=False,
+                 reuse_port=False):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._executor = None
+        self._shutdown_request = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+        # Idle connections waiting for a request: conn -> timer
+        self._idle = {}
+        super().__init__(
+            server_address,
+            RequestHandlerClass,
+            prefer_ipv4=prefer_ipv4,
+            reuse_port=reuse_port)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Serve until shutdown() is called. poll_interval is ignored, the event
+        loop wakes up only when there is something to do.
+        """
+        workers = self.max_workers or self.default_workers
+        log.debug("Starting event loop with %d workers", workers)
+
+        self._stopped.clear()
+        loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="aworker")
+        try:
+            with self._lock:
+                if self._shutdown_request:
+                    return
+                self._loop = loop
+
+            self.socket.setblocking(False)
+            loop.add_reader(self.socket.fileno(), self._accept)
+            try:
+                loop.run_forever()
+            finally:
+                loop.remove_reader(self.socket.fileno())
+                for conn in list(self._idle):
+                    self._forget(conn)
+                    self._close(conn)
+        finally:
+            with self._lock:
+                self._loop = None
+                self._shutdown_request = False
+            # Requests in progress complete in the worker threads, and their
+            # connections are closed since the loop is gone.
+            self._executor.shutdown(wait=False)
+            loop.close()
+            self._stopped.set()
+            log.debug("Event loop stopped")
+
+    def shutdown(self):
+        """
+        Stop serve_forever() and wait until it returns. Must be called from
+        another thread.
+        """
+        with self._lock:
+            self._shutdown_request = True
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+        self._stopped.wait()
+
+    @property
+    def connections(self):
+        """
+        Return the number of idle connections waiting in the event loop.
+        """
+        return len(self._idle)
+
+    # Running in the event loop thread.
+
+    def _accept(self):
+        while True:
+            try:
+                # Accept a plain socket; the TLS handshake, if needed, is done
+                # in a worker thread so slow clients do not block the loop.
+                sock, client_address = socket.socket.accept(self.socket)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                log.warning("Error accepting connection: %s", e)
+                return
+
+            self._submit(self._open, sock, client_address)
+
+    def _wait(self, conn):
+        """
+        Wait until the client sends the next request or the connection times
+        out.
+        """
+        if self._has_pending_data(conn):
+            self._submit(self._handle, conn)
+            return
+
+        loop = self._loop
+        timeout = conn.connection.gettimeout()
+        if timeout is not None:
+            timer = loop.call_later(timeout, self._expire, conn)
+        else:
+            timer = None
+        self._idle[conn] = timer
+        loop.add_reader(conn.connection.fileno(), self._ready, conn)
+
+    def _ready(self, conn):
+        self._forget(conn)
+        self._submit(self._handle, conn)
+
+    def _expire(self, conn):
+        log.warning("Timeout waiting for request on connection %s", conn.id)
+        self._forget(conn)
+        self._submit(self._close, conn)
+
+    def _forget(self, conn):
+        timer = self._idle.pop(conn)
+        if timer:
+            timer.cancel()
+        self._loop.remove_reader(conn.connection.fileno())
+
+    def _has_pending_data(self, conn):
+        """
+        Return True if the next request was already received, either buffered
+        in the connection file, or decrypted by the TLS layer.
+        """
+        sock = conn.connection
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(conn.rfile.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        except OSError:
+            # Let the worker handle the error.
+            return True
+        finally:
+            sock.settimeout(timeout)
+
+    def _submit(self, func, *args):
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._complete)
+
+    def _complete(self, future):
+        # Called in the worker thread when func returns. If func returned a
+        # connection, wait for the next request in the event loop.
+        conn = future.result()
+        if conn is None:
+            return
+
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._wait, conn)
+                return
+
+        log.debug("Server stopped, closing connection %s", conn.id)
+        self._close(conn)
+
+    # Running in worker threads.
+
+    def _open(self, sock, client_address):
+        try:
+            sock.settimeout(self.RequestHandlerClass.timeout)
+            if isinstance(self.socket, ssl.SSLSocket):
+                sock = self.socket.context.wrap_socket(sock, server_side=True)
+            return self.RequestHandlerClass(sock, client_address, self)
+        except Exception as e:
+            log.warning("Error opening connection from %s: %s",
+                        client_address[0], e)
+            self.shutdown_request(sock)
+            return None
+
+    def _handle(self, conn):
+        try:
+            keep_open = conn.handle_request()
+        except Exception:
+            log.exception("Error handling request on connection %s", conn.id)
+            keep_open = False
+
+        if keep_open:
+            return conn
+
+        self._close(conn)
+        return None
+
+    def _close(self, conn):
+        try:
+            conn.finish()
+        except Exception:
+            log.exception("Error closing connection %s", conn.id)
+        finally:
+            self.shutdown_request(conn.request)
+
+
+class Connection(http.Connection):
+    """
+    HTTP server connection served by the event loop server.
+
+    Unlike http.Connection, the connection is not served in the constructor.
+    The server calls handle_request() in a worker thread when the client sends
+    a request, and finish() when the connection is closed.
+    """
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle_request(self):
+        """
+        Handle one request, returning True if the connection should be kept
+        open for the next request.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        return not self.close_connection
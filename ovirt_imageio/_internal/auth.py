@@ -5,8 +5,11 @@ import logging
 import threading
 import urllib.parse as urllib_parse
 
+from contextlib import contextmanager
+
 from . import backends
 from . import errors
+from . import extent
 from . import measure
 from . import ops
 from . import util
@@ -72,10 +75,25 @@ class Ticket:
         # ticket is not used by any connection.
         self._connections = {}
 
+        # Number of extra backend connections used by operations on this
+        # ticket, for example checksum workers.
+        self._reserved_connections = 0
+
         # Used for waiting until a ticket is unused during cancellation. A
         # ticket can be removed only when this event is set.
         self._unused = threading.Event()
 
+        # The last job started on this ticket.
+        self._job = None
+
+        # Extents cached by all connections using this ticket. With multiple
+        # remote service processes, every process has its own ticket, and
+        # would not see changes done by other processes.
+        if cfg.daemon.extents_cache and cfg.remote.workers == 1:
+            self._extents = extent.Cache()
+        else:
+            self._extents = None
+
     @property
     def uuid(self):
         return self._uuid
@@ -168,18 +186,93 @@ class Ticket:
             # If context was closed, it is safe to remove it.
             del self._connections[con_id]
 
+    @contextmanager
+    def reserve_connections(self, count, limit):
+        """
+        Reserve up to count extra backend connections, so the total number of
+        connections used by this ticket does not exceed limit. Never waits;
+        yields the number of reserved connections, which may be zero.
+        """
+        with self._lock:
+            used = len(self._connections) + self._reserved_connections
+            available = limit - used
+            reserved = max(0, min(count, available))
+            self._reserved_connections += reserved
+        try:
+            yield reserved
+        finally:
+            with self._lock:
+                self._reserved_connections -= reserved
+
+    def extents(self, backend, context="zero", start=0, length=None):
+        """
+        Iterate over backend extents in the range start to start + length,
+        using the ticket extents cache if enabled.
+        """
+        if self._extents is None:
+            return backend.extents(context=context, start=start, length=length)
+        return self._extents.extents(
+            backend, context=context, start=start, length=length)
+
+    def disable_extents_cache(self):
+        """
+        Stop caching extents for this ticket. Called when the image may be
+        modified without using the ticket.
+        """
+        if self._extents is not None:
+            self._extents.disable()
+
     def run(self, operation):
         """
         Run an operation, binding it to the ticket.
         """
         self._add_operation(operation)
         try:
-            return operation.run()
+            if self._extents is None or not isinstance(operation, _WRITE_OPS):
+                return operation.run()
+            return self._run_write(operation)
         except ops.Canceled:
             log.debug("Operation %s was canceled", operation)
         finally:
             self._remove_operation(operation)
 
+    def _run_write(self, operation):
+        """
+        Run an operation modifying the image, updating the extents cache.
+        """
+        self._extents.start_write()
+        completed = False
+        try:
+            res = operation.run()
+            completed = True
+            return res
+        finally:
+            if isinstance(operation, (ops.Write, ops.Zero)):
+                self._extents.end_write(
+                    operation.offset,
+                    operation.done,
+                    zero=isinstance(operation, ops.Zero),
+                    completed=completed)
+            else:
+                # Copy modifies the entire image.
+                self._extents.end_write(0, 0, completed=False)
+
+    def start_job(self, job):
+        """
+        Start a job using this ticket, reporting the job progress in the
+        ticket info. Only one job can run at the same time.
+        """
+        with self._lock:
+            if self._canceled:
+                raise errors.AuthorizationError(
+                    "Transfer {} was canceled".format(self.transfer_id))
+
+            if self._job is not None and self._job.running:
+                raise errors.JobInProgress(self.transfer_id)
+
+            self._job = job
+            job.start()
+
     def touch(self):
         """
         Extend the ticket and update the last access time.
@@ -271,6 +364,8 @@ class Ticket:
         transferred = self.transferred()
         if transferred is not None:
             info["transferred"] = transferred
+        if self._job is not None:
+            info["job"] = self._job.info()
         return info
 
     def extend(self, timeout):
@@ -366,6 +461,10 @@ class Ticket:
                 )
 
 
+# Operations modifying the image.
+_WRITE_OPS = (ops.Write, ops.Zero, ops.Copy)
+
+
 def _required(d, key, type):
     if key not in d:
         raise errors.MissingTicketParameter(key)
@@ -5,7 +5,6 @@ from collections import namedtuple
 from functools import partial
 
 from .. import errors
-from .. import util
 
 from . common import CLOSED
 from . import file
@@ -24,17 +23,17 @@ class Unsupported(Exception):
     """ Requested backend is not supported """
 
 
-class Context(namedtuple("Context", "backend,buffer")):
+class Context(namedtuple("Context", "backend,buffer_size")):
     """
     Backend context stored per ticket connection.
+
+    Buffers are not kept in the context; operations lease a buffer of
+    buffer_size bytes from the buffer pool while they run.
     """
     __slots__ = ()
 
     def close(self):
-        try:
-            self.backend.close()
-        finally:
-            self.buffer.close()
+        self.backend.close()
 
 
 class Closer:
@@ -70,6 +69,39 @@ def supports(name):
     return name in _modules
 
 
+def open(ticket, config, mode=None):
+    """
+    Open a backend for this ticket, and return a backend context. The caller
+    must close the context.
+
+    If mode is not specified, the backend is opened for writing if the ticket
+    allows writing.
+    """
+    if not supports(ticket.url.scheme):
+        raise Unsupported(
+            "Unsupported backend {!r}".format(ticket.url.scheme))
+
+    if mode is None:
+        mode = "r+" if "write" in ticket.ops else "r"
+
+    module = _modules[ticket.url.scheme]
+
+    # If HTTP backend has no explict CA file configuration, use CA file
+    # from TLS configuration.
+    ca_file = config.backend_http.ca_file or config.tls.ca_file
+
+    backend = module.open(
+        ticket.url,
+        mode=mode,
+        sparse=ticket.sparse,
+        dirty=ticket.dirty,
+        max_connections=config.daemon.max_connections,
+        cafile=ca_file)
+
+    backend_config = getattr(config, "backend_" + backend.name)
+    return Context(backend, backend_config.buffer_size)
+
+
 def get(req, ticket, config):
     """
     Return a connection backend for this ticket.
@@ -83,28 +115,7 @@ def get(req, ticket, config):
     try:
         return ticket.get_context(req.connection_id)
     except KeyError:
-        if not supports(ticket.url.scheme):
-            raise Unsupported(
-                "Unsupported backend {!r}".format(ticket.url.scheme))
-
-        mode = "r+" if "write" in ticket.ops else "r"
-        module = _modules[ticket.url.scheme]
-
-        # If HTTP backend has no explict CA file configuration, use CA file
-        # from TLS configuration.
-        ca_file = config.backend_http.ca_file or config.tls.ca_file
-
-        backend = module.open(
-            ticket.url,
-            mode=mode,
-            sparse=ticket.sparse,
-            dirty=ticket.dirty,
-            max_connections=config.daemon.max_connections,
-            cafile=ca_file)
-
-        backend_config = getattr(config, "backend_" + backend.name)
-        buf = util.aligned_buffer(backend_config.buffer_size)
-        ctx = Context(backend, buf)
+        ctx = open(ticket, config)
 
         # Keep the context in the ticket so we monitor the number of
         # connections using the ticket.
@@ -64,6 +64,10 @@ class Backend:
         self._sparse = sparse
         self._dirty = False
         self._max_connections = max_connections
+        # Opened on the first call to sendfile().
+        self._sendfile_fio = None
+        # Opened on the first call to splice().
+        self._splice_fio = None
 
     @property
     def max_readers(self):
@@ -111,9 +115,16 @@ class Backend:
             log.debug("Close path=%r dirty=%r",
                       self._fio.name, self._dirty)
             try:
-                self._fio.close()
+                for fio in (self._sendfile_fio, self._splice_fio):
+                    if fio is not None:
+                        fio.close()
+                self._sendfile_fio = None
+                self._splice_fio = None
             finally:
-                self._fio = CLOSED
+                try:
+                    self._fio.close()
+                finally:
+                    self._fio = CLOSED
 
     # Backend interface.
 
@@ -138,6 +149,58 @@ class Backend:
             else:
                 return self._zero(count)
 
+    def sendfile(self, dst, count):
+        """
+        Send up to count bytes from the current position to dst using
+        dst.sendfile(), without copying the data to user space. Return the
+        number of bytes sent, or 0 at the end of the file.
+        """
+        if self._sendfile_fio is None:
+            # sendfile() does not work with O_DIRECT, so we use another file
+            # descriptor reading via the page cache.
+            self._sendfile_fio = util.open(
+                self._fio.name, "r", direct=False)
+
+        fd = self._sendfile_fio.fileno()
+        offset = self.tell()
+
+        # Drop cached pages before reading, since they may be stale if another
+        # host modified the image on shared storage, and after reading, to
+        # keep the page cache clean like O_DIRECT reads.
+        os.posix_fadvise(fd, offset, count, os.POSIX_FADV_DONTNEED)
+        sent = dst.sendfile(fd, offset, count)
+        if sent:
+            os.posix_fadvise(fd, offset, sent, os.POSIX_FADV_DONTNEED)
+
+        self.seek(offset + sent)
+        return sent
+
+    def splice(self, src, count):
+        """
+        Receive up to count bytes from src into the file at the current
+        position using src.splice(), without copying the data to user space.
+        Return the number of bytes received, or 0 if src has no more data.
+        """
+        if self._splice_fio is None:
+            # splice() does not work with O_DIRECT, so we use another file
+            # descriptor writing via the page cache. Dirty pages are written
+            # by flush(), syncing the file using any file descriptor.
+            self._splice_fio = util.open(
+                self._fio.name, "r+", direct=False)
+
+        fd = self._splice_fio.fileno()
+        offset = self.tell()
+
+        self._dirty = True
+        received = src.splice(fd, offset, count)
+        if received:
+            # Start writing the dirty pages, and drop the pages already
+            # written, to keep the page cache clean like O_DIRECT writes.
+            os.posix_fadvise(fd, offset, received, os.POSIX_FADV_DONTNEED)
+
+        self.seek(offset + received)
+        return received
+
     def flush(self):
         os.fsync(self._fio.fileno())
         self._dirty = False
@@ -146,14 +209,22 @@ class Backend:
     def block_size(self):
         return self._block_size
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
         if context != "zero":
             raise errors.UnsupportedOperation(
                 "Backend {} does not support {} extents"
                 .format(self.name, context))
 
-        # TODO: Use qemu-img map to get extents.
-        yield extent.ZeroExtent(0, self.size(), False, False)
+        # Getting allocation modifies the file position, so we must get all
+        # extents before yielding the first extent.
+        pos = self.tell()
+        try:
+            extents = self._allocation_extents()
+        finally:
+            self.seek(pos)
+
+        for ext in extent.clip(extents, start, length):
+            yield ext
 
     # Debugging interface
 
@@ -184,6 +255,49 @@ class Backend:
 
     # Private
 
+    def _allocation_extents(self):
+        """
+        Return list of extents using lseek(SEEK_DATA) and lseek(SEEK_HOLE).
+        Holes are reported as zero extents. If the file system does not
+        support these flags, report a single data extent.
+        """
+        size = self.size()
+        if size == 0 or not hasattr(os, "SEEK_DATA"):
+            return [extent.ZeroExtent(0, size, False, False)]
+
+        fd = self._fio.fileno()
+        extents = []
+        start = 0
+
+        while start < size:
+            try:
+                data = os.lseek(fd, start, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # No more data after start.
+                    data = size
+                elif e.errno == errno.EINVAL and start == 0:
+                    log.debug("File system does not support SEEK_DATA: %s",
+                              e)
+                    return [extent.ZeroExtent(0, size, False, False)]
+                else:
+                    raise
+
+            data = min(data, size)
+            if data > start:
+                extents.append(
+                    extent.ZeroExtent(start, data - start, True, False))
+                start = data
+                if start == size:
+                    break
+
+            hole = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append(
+                extent.ZeroExtent(start, hole - start, False, False))
+            start = hole
+
+        return extents
+
     def _aligned(self, n):
         """
         Return True if number n is aligned to block size.
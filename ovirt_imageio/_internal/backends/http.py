@@ -9,8 +9,13 @@ import http.client as http_client
 import json
 import logging
 import os
+import select
 import socket
 import ssl
+import threading
+import time
+
+from urllib.parse import urlencode
 
 from .. import errors
 from .. import extent
@@ -21,6 +26,21 @@ from . common import CLOSED
 
 log = logging.getLogger("backends.http")
 
+# Maximum number of idle connections kept per server address.
+MAX_IDLE = 8
+
+# Idle connections older than this are closed instead of reused, since the
+# server is likely to close them soon.
+IDLE_TIMEOUT = 60
+
+# Number of seconds to use cached server OPTIONS for a ticket. Tickets are
+# unique per transfer, so they rarely change, but a server may be upgraded
+# during a long transfer.
+OPTIONS_TTL = 60
+
+# Content type of the binary extents format.
+BINARY = "application/octet-stream"
+
 
 def open(url, mode="r+", sparse=True, dirty=False, max_connections=8,
          **options):
@@ -42,6 +62,10 @@ def open(url, mode="r+", sparse=True, dirty=False, max_connections=8,
             secure (bool): If False, disable server certificate verification.
             connect_timeout: Time to wait for connection to server.
             read_timeout: Time to wait when reading from server.
+            pool (Pool): pool of idle connections to share with other
+                backends. The caller must close the pool when done. If not
+                set, the backend and its clones use their own pool, closed
+                when the last of them is closed.
     """
     assert url.scheme in ("http", "https")
     return Backend(url, **options)
@@ -50,7 +74,7 @@ def open(url, mode="r+", sparse=True, dirty=False, max_connections=8,
 class Backend:
 
     def __init__(self, url, cafile=None, secure=True, connect_timeout=10,
-                 read_timeout=60, connect=True):
+                 read_timeout=60, connect=True, pool=None):
         log.debug("Open netloc=%r path=%r cafile=%r secure=%r",
                   url.netloc, url.path, cafile, secure)
         self.url = url
@@ -66,13 +90,24 @@ class Backend:
         self._context = None
         self._con = CLOSED
         self._can_extents = False
+        self._can_extents_binary = False
         self._can_zero = False
+        self._can_zero_ranges = False
         self._can_flush = False
         self._max_readers = 1
         self._max_writers = 1
 
+        if pool is None:
+            pool = Pool(auto_close=True)
+        pool.attach()
+        self._pool = pool
+
         if connect:
-            self._connect()
+            try:
+                self._connect()
+            except Exception:
+                self.close()
+                raise
 
     def clone(self):
         """
@@ -87,7 +122,8 @@ class Backend:
                 secure=self._secure,
                 connect_timeout=self._connect_timeout,
                 read_timeout=self._read_timeout,
-                connect=False)
+                connect=False,
+                pool=self._pool)
 
             # Use cloned connection.
             backend._con = con
@@ -96,15 +132,17 @@ class Backend:
             # server capabilities.
             backend._context = self._context
             backend._can_extents = self._can_extents
+            backend._can_extents_binary = self._can_extents_binary
             backend._can_zero = self._can_zero
+            backend._can_zero_ranges = self._can_zero_ranges
             backend._can_flush = self._can_flush
             backend._max_readers = self._max_readers
             backend._max_writers = self._max_writers
 
-            # Copy size and extents to save expensive EXTENTS calls.
+            # Share size and extents to save expensive EXTENTS calls. Extents
+            # are kept as immutable bytes, so they can be shared.
             backend._size = self._size
-            for ctx in list(self._extents):
-                backend._extents[ctx] = self._extents[ctx].copy()
+            backend._extents = dict(self._extents)
 
             return backend
         except Exception:
@@ -113,13 +151,18 @@ class Backend:
 
     def _connect(self):
         if self.url.scheme == "https":
-            self._context = self._create_ssl_context()
+            self._context = self._pool.ssl_context(self._cafile, self._secure)
         self._con = self._create_tcp_connection()
         try:
-            options = self._options()
+            options = self._pool.options(self._options_key())
+            if options is None:
+                options = self._options()
+                self._pool.set_options(self._options_key(), options)
             log.debug("Server options: %s", options)
             self._can_extents = options.get("extents", False)
+            self._can_extents_binary = options.get("extents_binary", False)
             self._can_zero = options.get("zero", False)
+            self._can_zero_ranges = options.get("zero_ranges", False)
             self._can_flush = options.get("flush", False)
 
             # In oVirt 4.3 qemu-nbd was configured to allow only single
@@ -281,6 +324,30 @@ class Backend:
         self._position += length
         return length
 
+    def zero_ranges(self, ranges):
+        """
+        Zero multiple ranges, specified as list of (offset, length) tuples.
+        Send single PATCH/zero request if the server supports zeroing
+        multiple ranges, or zero every range otherwise. Does not change the
+        current position.
+        """
+        if not self._can_zero_ranges:
+            position = self._position
+            try:
+                for offset, length in ranges:
+                    self._position = offset
+                    self.zero(length)
+            finally:
+                self._position = position
+            return
+
+        msg = {
+            "op": "zero",
+            "ranges": [{"offset": o, "size": n} for o, n in ranges],
+            "flush": not self._can_flush
+        }
+        self._patch(msg)
+
     def flush(self):
         """
         Send a PATCH/flush request, flushing changes to storage.
@@ -288,27 +355,53 @@ class Backend:
         if self._can_flush:
             self._patch({"op": "flush"})
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
         """
-        Get image extents, return iterator over received extents.
+        Get image extents, return iterator over received extents in the
+        range start to start + length, or until the end of the image if
+        length is None.
         """
         if context not in ("zero", "dirty"):
             raise RuntimeError("Invalid context: {}".format(context))
 
         if not self._can_extents:
             if context == "zero":
-                yield extent.ZeroExtent(0, self.size(), False, False)
+                extents = [extent.ZeroExtent(0, self.size(), False, False)]
+                for ext in extent.clip(extents, start, length):
+                    yield ext
                 return
             else:
                 raise errors.UnsupportedOperation(
                     "Server does not support dirty extents")
 
         if context not in self._extents:
-            self._extents[context] = list(self._get_extents(context))
+            self._extents[context] = self._get_extents(context)
 
-        for ext in self._extents[context]:
+        cls = extent.ZeroExtent if context == "zero" else extent.DirtyExtent
+        extents = extent.unpack(cls, self._extents[context])
+        for ext in extent.clip(extents, start, length):
             yield ext
 
+    def checksum_map(self, algorithm, block_size):
+        """
+        Get the digests of the image blocks computed by the server.
+        """
+        query = urlencode({"algorithm": algorithm, "block_size": block_size})
+        self._con.request(
+            "GET", self.url.path + "/checksum/map?" + query)
+        res = self._con.getresponse()
+        data = res.read()
+
+        if res.status == http_client.NOT_FOUND:
+            raise errors.UnsupportedOperation(
+                "Server does not support checksum map: {}"
+                .format(data[:512]))
+
+        if res.status != http_client.OK:
+            self._reraise(res.status, data)
+
+        return json.loads(data.decode("utf-8"))
+
     def tell(self):
         return self._position
 
@@ -339,9 +432,15 @@ class Backend:
         if self._con is not CLOSED:
             log.debug("Close netloc=%r path=%r",
                       self.url.netloc, self.url.path)
-            self._con.close()
+            # Keep the connection for the next backend connecting to the same
+            # server.
+            self._pool.put(self._con)
             self._con = CLOSED
 
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.detach()
+
     def __enter__(self):
         return self
 
@@ -362,27 +461,29 @@ class Backend:
 
     # Private
 
-    def _create_ssl_context(self):
-        context = ssl.create_default_context(
-            purpose=ssl.Purpose.SERVER_AUTH, cafile=self._cafile)
-
-        if not self._secure:
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-
-        return context
+    def _options_key(self):
+        return (self.url.scheme, self.url.netloc, self.url.path)
 
     def _create_tcp_connection(self):
+        key = (self.url.scheme, self.url.netloc, self._cafile, self._secure)
+        con = self._pool.get(key)
+        if con is not None:
+            log.debug("Reusing connection to tcp socket %r", self.url.netloc)
+            con.sock.settimeout(self._read_timeout)
+            return con
+
         log.debug("Connecting to tcp socket %r", self.url.netloc)
         if self._context is not None:
             con = HTTPSConnection(
                 self.url.netloc,
                 timeout=self._connect_timeout,
-                context=self._context)
+                context=self._context,
+                session=self._pool.session(key))
         else:
             con = HTTPConnection(
                 self.url.netloc,
                 timeout=self._connect_timeout)
+        con.pool_key = key
         try:
             con.connect()
             con.sock.settimeout(self._read_timeout)
@@ -390,12 +491,23 @@ class Backend:
             con.close()
             raise
 
+        if self._context is not None:
+            self._pool.record_handshake(con.sock.session_reused)
+
         return con
 
     def _create_unix_connection(self, unix_socket):
+        key = ("unix", unix_socket)
+        con = self._pool.get(key)
+        if con is not None:
+            log.debug("Reusing connection to unix socket %r", unix_socket)
+            con.sock.settimeout(self._read_timeout)
+            return con
+
         log.debug("Connecting to unix socket %r", unix_socket)
         con = UnixHTTPConnection(
             unix_socket, timeout=self._connect_timeout)
+        con.pool_key = key
         try:
             con.connect()
             con.sock.settimeout(self._read_timeout)
@@ -418,13 +530,15 @@ class Backend:
         except Exception as e:
             log.warning("Cannot use unix socket: %s", e)
         else:
-            self._con.close()
+            self._pool.put(self._con)
             self._con = con
 
     def _clone_connection(self):
         if isinstance(self._con, UnixHTTPConnection):
             return self._create_unix_connection(self.server_address)
         else:
+            # Resume this connection TLS session in the new connection.
+            self._pool.save_session(self._con)
             return self._create_tcp_connection()
 
     def _get(self, length):
@@ -506,7 +620,18 @@ class Backend:
         return options
 
     def _get_extents(self, context):
-        self._con.request("GET", self.url.path + "/extents?context=" + context)
+        """
+        Get extents from the server, and return them as binary records.
+        Binary records are much smaller and faster to parse than JSON, so we
+        request them if the server supports them.
+        """
+        headers = {}
+        if self._can_extents_binary:
+            headers["accept"] = BINARY
+
+        self._con.request(
+            "GET", self.url.path + "/extents?context=" + context,
+            headers=headers)
         res = self._con.getresponse()
         data = res.read()
 
@@ -518,11 +643,13 @@ class Backend:
         if res.status != http_client.OK:
             self._reraise(res.status, data)
 
+        if res.getheader("content-type") == BINARY:
+            return data
+
         extents = json.loads(data.decode("utf-8"))
 
         cls = extent.ZeroExtent if context == "zero" else extent.DirtyExtent
-        for ext in extents:
-            yield cls.from_dict(ext)
+        return extent.pack(cls.from_dict(ext) for ext in extents)
 
     def _emulate_head(self):
         """
@@ -593,11 +720,234 @@ class Backend:
         raise http.Error(status, msg)
 
 
+class Pool:
+    """
+    Pool of idle connections and cached server state, shared by backends
+    using the pool.
+
+    Backends take idle connections to the same server instead of connecting,
+    and return their connection to the pool when closed. Connections are
+    keyed by server address and TLS configuration, so they can be reused by
+    backends for different tickets on the same server.
+
+    The pool also caches SSL contexts, the last TLS session for every server
+    for resuming the session when connecting, and the server OPTIONS for
+    every ticket.
+
+    Idle connections are kept open until the pool is closed. If auto_close
+    is True, the pool is closed when the last backend using it is closed.
+    Otherwise the pool owner must close it.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT,
+                 options_ttl=OPTIONS_TTL, clock=time.monotonic,
+                 auto_close=False):
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._options_ttl = options_ttl
+        self._clock = clock
+        self._auto_close = auto_close
+        self._lock = threading.Lock()
+        # Number of backends using the pool.
+        self._users = 0
+        # key -> list of (connection, time) tuples
+        self._idle = {}
+        # (cafile, secure) -> ssl.SSLContext
+        self._contexts = {}
+        # key -> ssl.SSLSession
+        self._sessions = {}
+        # (scheme, netloc, path) -> (options, time)
+        self._options = {}
+        self._stats = {
+            "connected": 0,
+            "reused": 0,
+            "options_cached": 0,
+            "tls_full": 0,
+            "tls_resumed": 0,
+        }
+
+    def attach(self):
+        """
+        Called by a backend starting to use the pool.
+        """
+        with self._lock:
+            self._users += 1
+
+    def detach(self):
+        """
+        Called by a backend closed by the user. Closes the pool when the last
+        backend is closed if auto_close is True.
+        """
+        with self._lock:
+            self._users -= 1
+            unused = self._users == 0
+        if unused and self._auto_close:
+            self.close()
+
+    def get(self, key):
+        """
+        Return an idle connection for key, or None if there is no usable idle
+        connection.
+        """
+        now = self._clock()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                # Use the most recently used connection.
+                con, added = idle.pop()
+                if now - added < self._idle_timeout and _is_usable(con):
+                    self._stats["reused"] += 1
+                    return con
+                con.close()
+            self._stats["connected"] += 1
+            return None
+
+    def put(self, con):
+        """
+        Return a connection to the pool, or close it if it cannot be reused.
+        """
+        key = getattr(con, "pool_key", None)
+        if key is None or not _is_reusable(con):
+            con.close()
+            return
+
+        self.save_session(con)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) >= self._max_idle:
+                con.close()
+                return
+
+            idle.append((con, self._clock()))
+
+    def ssl_context(self, cafile, secure):
+        """
+        Return a client SSL context. Using the same context for all
+        connections avoids loading the CA certificates for every connection.
+        """
+        key = (cafile, secure)
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                context = ssl.create_default_context(
+                    purpose=ssl.Purpose.SERVER_AUTH, cafile=cafile)
+                if not secure:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                self._contexts[key] = context
+            return context
+
+    def session(self, key):
+        """
+        Return the last TLS session used to connect to key, or None.
+        """
+        with self._lock:
+            return self._sessions.get(key)
+
+    def save_session(self, con):
+        """
+        Keep the connection TLS session for resuming it in new connections to
+        the same server. With TLSv1.3 the session is available only after
+        receiving the first response.
+        """
+        session = getattr(con.sock, "session", None)
+        if session is not None and session.has_ticket:
+            with self._lock:
+                self._sessions[con.pool_key] = session
+
+    def record_handshake(self, resumed):
+        with self._lock:
+            self._stats["tls_resumed" if resumed else "tls_full"] += 1
+
+    def options(self, key):
+        """
+        Return cached server options for key, or None.
+        """
+        with self._lock:
+            cached = self._options.get(key)
+            if cached is None:
+                return None
+            options, added = cached
+            if self._clock() - added >= self._options_ttl:
+                del self._options[key]
+                return None
+            self._stats["options_cached"] += 1
+            return dict(options)
+
+    def set_options(self, key, options):
+        with self._lock:
+            self._options[key] = (dict(options), self._clock())
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = sum(len(v) for v in self._idle.values())
+            return stats
+
+    def close(self):
+        """
+        Close idle connections and drop cached state. The pool can still be
+        used after closing it.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for con, _ in idle:
+                    con.close()
+            self._idle.clear()
+            self._contexts.clear()
+            self._sessions.clear()
+            self._options.clear()
+
+
+def _is_reusable(con):
+    """
+    Return True if the connection completed the last request and the
+    response was read, so it can send the next request.
+    """
+    if con.sock is None or con.busy:
+        return False
+    res = con.last_response
+    return res is None or res.isclosed()
+
+
+def _is_usable(con):
+    """
+    Return True if an idle connection is still connected. An idle connection
+    is readable only if the server closed it, or sent unexpected data.
+    """
+    if con.sock is None:
+        return False
+    if isinstance(con.sock, ssl.SSLSocket) and con.sock.pending():
+        return False
+    poller = select.poll()
+    poller.register(con.sock, select.POLLIN)
+    return not poller.poll(0)
+
+
 class ConnectionMixin:
     """
     Mix-in class for enhanced connections.
     """
 
+    # Set by the pool when creating the connection.
+    pool_key = None
+
+    # True while a request is sent and the response was not received yet.
+    busy = False
+
+    # The last response received on this connection.
+    last_response = None
+
+    def putrequest(self, *args, **kwargs):
+        self.busy = True
+        super().putrequest(*args, **kwargs)
+
+    def getresponse(self):
+        res = super().getresponse()
+        self.busy = False
+        self.last_response = res
+        return res
+
     def is_local(self):
         """
         Return True if connected to the local host.
@@ -627,11 +977,23 @@ class HTTPConnection(ConnectionMixin, http_client.HTTPConnection):
 
 class HTTPSConnection(ConnectionMixin, http_client.HTTPSConnection):
     """
-    Enhanced HTTPS connection.
+    Enhanced HTTPS connection, resuming TLS session if possible.
     """
 
+    def __init__(self, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 context=None, session=None):
+        super().__init__(host, timeout=timeout, context=context)
+        self.session = session
+
+    def connect(self):
+        http_client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self.host, session=self.session)
+        log.debug("Connected to %r session_reused=%s",
+                  self.host, self.sock.session_reused)
+
 
-class UnixHTTPConnection(http_client.HTTPConnection):
+class UnixHTTPConnection(ConnectionMixin, http_client.HTTPConnection):
     """
     HTTP connection over unix domain socket.
     """
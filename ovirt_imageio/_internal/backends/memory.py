@@ -143,11 +143,13 @@ class Backend:
     def block_size(self):
         return 1
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
         self._check_closed()
         # If not configured, report single data extent.
         if not self._extents and context == "zero":
-            yield extent.ZeroExtent(0, self.size(), False, False)
+            extents = [extent.ZeroExtent(0, self.size(), False, False)]
+            for ext in extent.clip(extents, start, length):
+                yield ext
             return
 
         if context not in self._extents:
@@ -155,7 +157,7 @@ class Backend:
                 "Backend {} does not support {} extents"
                 .format(self.name, context))
 
-        for ext in self._extents[context]:
+        for ext in extent.clip(self._extents[context], start, length):
             yield ext
 
     # Debugging interface
@@ -159,7 +159,7 @@ class Backend:
                 raise
             log.exception("Error closing")
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
         if context not in ("zero", "dirty"):
             raise errors.UnsupportedOperation(
                 "Backend nbd does not support {} extents".format(context))
@@ -167,7 +167,10 @@ class Backend:
         # If server does not support base:allocation, we can safely report one
         # data extent like other backends.
         if context == "zero" and not self._client.has_base_allocation:
-            yield extent.ZeroExtent(0, self._client.export_size, False, False)
+            extents = [
+                extent.ZeroExtent(0, self._client.export_size, False, False)]
+            for ext in extent.clip(extents, start, length):
+                yield ext
             return
 
         # If dirty extents are not available, client may be able to use zero
@@ -178,8 +181,8 @@ class Backend:
                 .format(self._client.export_name))
 
         dirty = context == "dirty"
-        start = 0
-        for ext in nbdutil.extents(self._client, dirty=dirty):
+        for ext in nbdutil.extents(
+                self._client, offset=start, length=length, dirty=dirty):
             if dirty:
                 yield extent.DirtyExtent(
                     start, ext.length, ext.dirty, ext.zero)
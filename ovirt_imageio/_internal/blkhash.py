@@ -44,17 +44,36 @@ class Hash:
         self._zero_block_digest = self._func(b"\0" * block_size).digest()
 
     def update(self, block):
-        block_digest = self._func(block).digest()
-        self._hash.update(block_digest)
+        self._hash.update(self.block_digest(block))
 
     def zero(self, count):
+        self._hash.update(self.zero_digest(count))
+
+    def block_digest(self, block):
+        """
+        Return the digest of a data block. Combining block digests using
+        update_digest() gives the same result as update(), so block digests
+        can be computed in parallel.
+        """
+        return self._func(block).digest()
+
+    def zero_digest(self, count):
+        """
+        Return the digest of a zero block of count bytes.
+        """
         if count == self._block_size:
             # Fast path.
-            self._hash.update(self._zero_block_digest)
+            return self._zero_block_digest
         else:
             # Slow path.
-            block_digest = self._func(b"\0" * count).digest()
-            self._hash.update(block_digest)
+            return self._func(b"\0" * count).digest()
+
+    def update_digest(self, block_digest):
+        """
+        Add digest returned from block_digest() or zero_digest() to the hash.
+        Block digests must be added in the order of the blocks in the file.
+        """
+        self._hash.update(block_digest)
 
     def digest(self):
         return self._hash.digest()
@@ -0,0 +1,220 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+bufpool - process wide pool of aligned buffers.
+
+Buffers are leased for the duration of an operation instead of keeping a
+buffer per connection, so idle connections do not consume memory. When the
+pool is limited, the total size of allocated buffers never exceeds the limit,
+and callers wait until other operations release their buffers.
+"""
+
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+from . import errors
+from . import util
+
+log = logging.getLogger("bufpool")
+
+
+class Pool:
+    """
+    Pool of aligned buffers.
+
+    If max_size is 0, the pool is not limited; buffers are allocated when
+    acquired and freed when released. Otherwise released buffers are kept in
+    the pool for reuse, and acquiring a buffer waits up to timeout seconds if
+    allocating it would exceed max_size bytes.
+    """
+
+    def __init__(self, max_size=0, timeout=60.0):
+        self._max_size = max_size
+        self._timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        # Released buffers, least recently used first.
+        self._free = []
+        # Total size of allocated buffers, free and leased.
+        self._size = 0
+        self._leased = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+
+    def configure(self, max_size, timeout):
+        """
+        Change pool limits, freeing cached buffers.
+        """
+        with self._cond:
+            log.debug("Configure max_size=%s timeout=%s", max_size, timeout)
+            self._max_size = max_size
+            self._timeout = timeout
+            self._clear()
+            self._cond.notify_all()
+
+    @contextmanager
+    def lease(self, size):
+        """
+        Context manager acquiring a buffer of size bytes, and releasing it
+        when exiting the context.
+        """
+        buf = self.acquire(size)
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def acquire(self, size, timeout=None):
+        """
+        Return a buffer of size bytes. The buffer must be released using
+        release() when the caller is done with it.
+
+        If timeout is None, wait up to the pool timeout. Use timeout=0 to
+        fail immediately if the pool is exhausted.
+
+        Raises errors.BufferTooLarge if size exceeds the pool size, and
+        errors.BufferPoolTimeout if the pool is exhausted and no buffer was
+        released in time.
+        """
+        with self._cond:
+            if not self._max_size:
+                return self._allocate(size)
+
+            if size > self._max_size:
+                raise errors.BufferTooLarge(size, self._max_size)
+
+            if timeout is None:
+                timeout = self._timeout
+
+            start = time.monotonic()
+            deadline = start + timeout
+            waited = False
+
+            try:
+                while True:
+                    buf = self._take_free(size)
+                    if buf is not None:
+                        return buf
+
+                    if self._make_room(size):
+                        return self._allocate(size)
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise errors.BufferPoolTimeout(size, timeout)
+
+                    if not waited:
+                        log.debug("Pool exhausted, waiting for %s bytes", size)
+                        waited = True
+                        self._waits += 1
+
+                    self._cond.wait(remaining)
+            finally:
+                if waited:
+                    self._wait_seconds += time.monotonic() - start
+
+    def release(self, buf):
+        """
+        Return buffer acquired by acquire() to the pool.
+        """
+        with self._cond:
+            self._leased -= len(buf)
+            if self._max_size and self._size <= self._max_size:
+                self._free.append(buf)
+            else:
+                self._size -= len(buf)
+                _close(buf)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_size": self._max_size,
+                "size": self._size,
+                "leased": self._leased,
+                "free": len(self._free),
+                "waits": self._waits,
+                "wait_seconds": self._wait_seconds,
+            }
+
+    def clear(self):
+        """
+        Free cached buffers.
+        """
+        with self._cond:
+            self._clear()
+
+    # Private, must be called with self._cond held.
+
+    def _allocate(self, size):
+        buf = util.aligned_buffer(size)
+        self._size += size
+        self._leased += size
+        return buf
+
+    def _take_free(self, size):
+        for i, buf in enumerate(self._free):
+            if len(buf) == size:
+                del self._free[i]
+                self._leased += size
+                return buf
+        return None
+
+    def _make_room(self, size):
+        """
+        Free least recently used free buffers until we can allocate size
+        bytes. Return True if allocating size bytes is possible.
+        """
+        while self._size + size > self._max_size and self._free:
+            buf = self._free.pop(0)
+            self._size -= len(buf)
+            _close(buf)
+        return self._size + size <= self._max_size
+
+    def _clear(self):
+        while self._free:
+            buf = self._free.pop()
+            self._size -= len(buf)
+            _close(buf)
+
+
+def _close(buf):
+    try:
+        buf.close()
+    except BufferError:
+        # A memoryview of the buffer is still alive, for example in the
+        # traceback of a failed operation. The memory is freed when the last
+        # view is released.
+        log.debug("Buffer has exported views, not closing it")
+
+
+# The process wide pool. The default pool is not limited and does not keep
+# buffers; the server configures it using the daemon configuration.
+_pool = Pool()
+
+
+def configure(max_size, timeout):
+    _pool.configure(max_size, timeout)
+
+
+def lease(size):
+    return _pool.lease(size)
+
+
+def acquire(size, timeout=None):
+    return _pool.acquire(size, timeout=timeout)
+
+
+def release(buf):
+    _pool.release(buf)
+
+
+def stats():
+    return _pool.stats()
+
+
+def clear():
+    _pool.clear()
@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 from . import configloader
-from .units import MiB
+from .units import GiB, MiB
 
 
 class daemon:
@@ -21,6 +21,109 @@ class daemon:
     # creating an image transfer.
     inactivity_timeout = 60
 
+    # Number of additional buffers used for reading ahead when downloading
+    # image data. Reading ahead overlaps reading from storage and sending data
+    # to the client. Every buffer uses backend buffer_size bytes during the
+    # download, and reading ahead uses an additional thread per download
+    # request. Use 0 to disable reading ahead.
+    read_ahead = 0
+
+    # Send image data from file backends to clients using sendfile(),
+    # avoiding copying the data to user space. Used only for connections
+    # without TLS, or for TLS connections using kernel TLS (see
+    # tls:enable_ktls).
+    #
+    # Unlike normal downloads using direct I/O, the data is read via the page
+    # cache, dropping the cached pages before and after the transfer. If the
+    # image is modified by another host using shared storage, the download
+    # may read stale cached data. Enable only for local or non-shared
+    # storage.
+    zero_copy = False
+
+    # Receive image data from clients into file backends using splice(),
+    # avoiding copying the data to user space. Used only for connections
+    # without TLS. Requires Python 3.10, and is disabled when detect_zeroes is
+    # enabled.
+    #
+    # Unlike normal uploads using direct I/O, spliced data is written to the
+    # page cache, and reaches storage only when the client flushes or when
+    # the kernel writes back the dirty pages. Other hosts using shared storage
+    # may not see the data until then. Enable only if clients flush before
+    # the image is used by another host.
+    zero_copy_upload = False
+
+    # Number of additional buffers used for writing behind when uploading
+    # image data. Writing behind overlaps receiving data from the client and
+    # writing to storage. Every buffer uses backend buffer_size bytes during
+    # the upload, and writing behind uses an additional thread per upload
+    # request. Use 0 to disable writing behind.
+    write_behind = 0
+
+    # Detect zeroes in uploaded data, and zero the image instead of writing
+    # blocks containing only zeroes. If the ticket is sparse, zeroing
+    # deallocates space. This saves storage bandwidth and space when clients
+    # upload images without sending zero extents, but consumes more CPU.
+    detect_zeroes = False
+
+    # Number of threads used to copy image data between tickets using the
+    # control service. Every thread uses a buffer of the destination backend
+    # buffer_size bytes, up to 32 MiB.
+    copy_workers = 4
+
+    # Maximum number of threads serving connections in the remote and local
+    # services. Connections are persistent, so this limits the number of
+    # connections served concurrently by every service. When all threads are
+    # busy, accepted connections wait in a queue. Use 0 to serve every
+    # connection in a new thread.
+    #
+    # An idle keep-alive connection keeps its thread until the client closes
+    # the connection or the connection times out (60 seconds, or the ticket
+    # inactivity_timeout after the client was authorized), so max_workers
+    # should be larger than the expected number of concurrent clients.
+    #
+    # The worker pool statistics, including the time connections waited in
+    # the queue, are available from the control service at /stats/.
+    max_workers = 0
+
+    # Maximum number of accepted connections waiting for a free thread when
+    # max_workers is set. When the queue is full, the service stops accepting
+    # connections until a thread becomes available.
+    max_queued = 40
+
+    # Maximum total size in bytes of image data buffers. Buffers are leased
+    # from a process wide pool while an operation runs, so idle connections do
+    # not use buffers. Released buffers are kept for reuse by the next
+    # operations. When the pool is exhausted, operations wait until buffers
+    # are released, and use less read ahead or write behind buffers and
+    # checksum workers. Use 0 to allocate buffers without limit and free them
+    # when operations complete. When using remote:workers processes, every
+    # process has its own pool, limited to buffer_pool_size / workers bytes.
+    # The pool of every process must be large enough for the largest backend
+    # buffer_size and the maximum checksum block_size (16 MiB).
+    buffer_pool_size = 1 * GiB
+
+    # Number of seconds to wait for a buffer when the buffer pool is
+    # exhausted. If no buffer was released in time, the request fails with
+    # "503 Service Unavailable".
+    buffer_pool_timeout = 60
+
+    # Number of worker threads used for computing image checksum. Every worker
+    # uses its own backend connection and a buffer of checksum block_size
+    # bytes. The total number of connections used by the ticket, including
+    # checksum workers, is limited by the backend max_readers, so fewer
+    # workers are used when other clients are connected. Use 1 to compute the
+    # checksum in the request thread.
+    checksum_workers = 4
+
+    # Cache image extents per ticket, so getting extents again does not
+    # access storage. The cache is updated when data is written or zeroed
+    # using the ticket. Caching is disabled when using multiple remote
+    # service processes, since a process cannot see changes done by other
+    # processes, and for a ticket after passing a writable file descriptor to
+    # a local client. Disable if the image may be modified outside of the
+    # daemon during the transfer.
+    extents_cache = True
+
     # Daemon run directory. Runtime stuff like socket or profile information
     # will be stored in this directory.
     # This is configurable only for development purposes and is not expected to
@@ -76,6 +179,19 @@ class tls:
     # TLSv1.2.
     enable_tls1_1 = False
 
+    # Send TLS session tickets to clients, allowing them to resume the session
+    # on the next connection without a full handshake. Clients opening many
+    # connections, like backup applications, save CPU time and latency on
+    # both sides. Tickets are accepted by all worker processes.
+    session_tickets = True
+
+    # Offload TLS record encryption to the kernel. When enabled, and the
+    # kernel tls module and OpenSSL support the negotiated cipher, image data
+    # is sent to clients without copying it to user space (see
+    # daemon:zero_copy), and without encrypting it in the server thread. When
+    # kernel TLS cannot be used, data is encrypted by OpenSSL.
+    enable_ktls = False
+
 
 class backend_file:
 
@@ -122,6 +238,22 @@ class remote:
     # configuration.
     port = 54322
 
+    # Wait for requests on idle connections in an event loop, and serve
+    # requests using daemon:max_workers threads (64 if max_workers is 0),
+    # instead of using a thread per connection. This scales better when
+    # having many mostly idle connections.
+    event_loop = False
+
+    # Number of processes serving the remote service. When larger than 1, the
+    # daemon starts worker processes listening on the remote port using
+    # SO_REUSEPORT, and the kernel distributes connections between the
+    # processes. This allows using more than one CPU core for encryption and
+    # data processing. Tickets are managed by the main process and forwarded
+    # to the worker processes. The local and control services are served only
+    # by the main process. The daemon:buffer_pool_size is divided between the
+    # processes.
+    workers = 1
+
 
 class local:
 
@@ -131,6 +263,13 @@ class local:
     # Local service unix socket for accessing images locally.
     socket = "\u0000/org/ovirt/imageio"
 
+    # Allow local clients to get an open file descriptor for the image of a
+    # ticket using a file backend, via GET /images/ticket-id/fd. Clients can
+    # access the image directly without transferring the data over HTTP. The
+    # server cannot revoke the file descriptor when the ticket expires or is
+    # canceled, so this is disabled by default.
+    fd_passing = False
+
 
 class control:
 
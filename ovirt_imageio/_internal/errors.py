@@ -16,6 +16,23 @@ class PartialContent(Error):
         self.available = available
 
 
+class BufferPoolTimeout(Error):
+    msg = ("Timeout waiting {self.timeout} seconds for a buffer of "
+           "{self.size} bytes")
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+
+
+class BufferTooLarge(Error):
+    msg = "Buffer of {self.size} bytes exceeds buffer pool size {self.limit}"
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+
+
 class InvalidTicket(Error):
     """Base class for ticket errors"""
 
@@ -51,6 +68,13 @@ class TransferCancelTimeout(Error):
         self.transfer_id = transfer_id
 
 
+class JobInProgress(Error):
+    msg = "Transfer {self.transfer_id} is running another job"
+
+    def __init__(self, transfer_id):
+        self.transfer_id = transfer_id
+
+
 class UnsupportedOperation(Error):
     msg = "Operation not supported: {self.reason}"
 
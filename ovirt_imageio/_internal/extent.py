@@ -1,8 +1,21 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import bisect
+import math
+import struct
+import threading
+
 from collections import namedtuple
 
+# Binary extent record: start, length, flags, in network byte order.
+RECORD = struct.Struct("!QQI")
+
+# Binary extent record flags.
+FLAG_ZERO = 1 << 0
+FLAG_HOLE = 1 << 1
+FLAG_DIRTY = 1 << 2
+
 
 class ZeroExtent(namedtuple("ZeroExtent", "start,length,zero,hole")):
     """
@@ -30,6 +43,14 @@ class ZeroExtent(namedtuple("ZeroExtent", "start,length,zero,hole")):
         # Old imageio server did not report holes.
         return cls(d["start"], d["length"], d["zero"], d.get("hole"))
 
+    @classmethod
+    def from_flags(cls, start, length, flags):
+        """
+        Create instance from binary record fields.
+        """
+        return cls(start, length, bool(flags & FLAG_ZERO),
+                   bool(flags & FLAG_HOLE))
+
     @property
     def data(self):
         """
@@ -37,6 +58,18 @@ class ZeroExtent(namedtuple("ZeroExtent", "start,length,zero,hole")):
         """
         return not self.zero
 
+    @property
+    def flags(self):
+        """
+        Flags for binary record.
+        """
+        flags = 0
+        if self.zero:
+            flags |= FLAG_ZERO
+        if self.hole:
+            flags |= FLAG_HOLE
+        return flags
+
     def to_dict(self):
         """
         Crate dict representation.
@@ -75,6 +108,14 @@ class DirtyExtent(namedtuple("DirtyExtent", "start,length,dirty,zero")):
         # optimize the transfer by not copying zero area.
         return cls(d["start"], d["length"], d["dirty"], d.get("zero", False))
 
+    @classmethod
+    def from_flags(cls, start, length, flags):
+        """
+        Create instance from binary record fields.
+        """
+        return cls(start, length, bool(flags & FLAG_DIRTY),
+                   bool(flags & FLAG_ZERO))
+
     @property
     def data(self):
         """
@@ -82,6 +123,18 @@ class DirtyExtent(namedtuple("DirtyExtent", "start,length,dirty,zero")):
         """
         return not self.zero
 
+    @property
+    def flags(self):
+        """
+        Flags for binary record.
+        """
+        flags = 0
+        if self.dirty:
+            flags |= FLAG_DIRTY
+        if self.zero:
+            flags |= FLAG_ZERO
+        return flags
+
     def to_dict(self):
         """
         Crate dict representation.
@@ -92,3 +145,254 @@ class DirtyExtent(namedtuple("DirtyExtent", "start,length,dirty,zero")):
             "dirty": self.dirty,
             "zero": self.zero,
         }
+
+
+def pack(extents):
+    """
+    Return bytes with binary records for extents.
+    """
+    return b"".join(RECORD.pack(ext.start, ext.length, ext.flags)
+                    for ext in extents)
+
+
+def unpack(cls, data):
+    """
+    Iterate over extents of type cls from binary records in data.
+    """
+    if len(data) % RECORD.size:
+        raise ValueError(
+            "Invalid extents data size {}, expecting multiple of {}"
+            .format(len(data), RECORD.size))
+
+    for start, length, flags in RECORD.iter_unpack(data):
+        yield cls.from_flags(start, length, flags)
+
+
+def clip(extents, start=0, length=None):
+    """
+    Iterate over extents overlapping the range start to start + length,
+    clipping the first and last extents to the range. If length is None,
+    iterate until the end of extents.
+
+    Extents must be sorted by start offset, and may be any extent type.
+    """
+    if start == 0 and length is None:
+        for ext in extents:
+            yield ext
+        return
+
+    end = None if length is None else start + length
+    if end == start:
+        return
+
+    for ext in extents:
+        ext_end = ext.start + ext.length
+
+        if ext_end <= start:
+            continue
+
+        if end is not None and ext.start >= end:
+            break
+
+        if ext.start < start or (end is not None and ext_end > end):
+            new_start = max(ext.start, start)
+            new_end = ext_end if end is None else min(ext_end, end)
+            ext = ext._replace(start=new_start, length=new_end - new_start)
+
+        yield ext
+
+
+class Cache:
+    """
+    Cache image extents, updated by writes to the image.
+
+    Getting extents from storage may be slow for large fragmented images, and
+    clients may get the extents several times during a transfer. The cache
+    keeps the extents of the entire image, and patches the cached zero
+    extents when data is written or zeroed, so getting extents again does
+    not access storage.
+
+    The cache must know about every change to the image. It cannot be used
+    if the image is modified by another process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Cached extents lists: context -> list of extents.
+        self._extents = {}
+        # Number of ongoing writes. Extents are not cached or returned from
+        # the cache while the image is modified.
+        self._writers = 0
+        # Incremented when a write starts or ends, so extents received before
+        # a write are not cached after the write.
+        self._generation = 0
+        # Set when the image may be modified without using the cache.
+        self._disabled = False
+
+    def extents(self, backend, context="zero", start=0, length=None):
+        """
+        Iterate over extents in the range start to start + length, or until
+        the end of the image if length is None.
+
+        If the extents are not cached, get them from backend, and cache them
+        if the entire image was requested.
+        """
+        with self._lock:
+            cached = None
+            if not self._writers and context in self._extents:
+                # Copy the requested range, since the cached list may be
+                # modified when we iterate over the extents.
+                cached = _slice(self._extents[context], start, length)
+            generation = self._generation
+
+        if cached is not None:
+            return clip(cached, start, length)
+
+        if start == 0 and length is None and not self._disabled:
+            return self._fetch(backend, context, generation)
+
+        return backend.extents(context=context, start=start, length=length)
+
+    def start_write(self):
+        """
+        Called before modifying the image.
+        """
+        with self._lock:
+            self._writers += 1
+            self._generation += 1
+
+    def end_write(self, start, length, zero=False, completed=True):
+        """
+        Called after modifying the range start to start + length. If zero is
+        True, the range was zeroed. If completed is False, the write failed,
+        and the state of the range is unknown.
+        """
+        with self._lock:
+            self._writers -= 1
+            self._generation += 1
+
+            # Dirty extents are used only during backup, when the image is
+            # not modified. Drop them instead of guessing.
+            self._extents.pop("dirty", None)
+
+            if "zero" not in self._extents:
+                return
+
+            if not completed:
+                del self._extents["zero"]
+                return
+
+            if length:
+                ext = ZeroExtent(start, length, zero, False)
+                if not _replace(self._extents["zero"], ext):
+                    del self._extents["zero"]
+
+    def clear(self):
+        """
+        Drop all cached extents.
+        """
+        with self._lock:
+            self._generation += 1
+            self._extents.clear()
+
+    def disable(self):
+        """
+        Drop all cached extents and stop caching. Called when the image may
+        be modified without using the cache.
+        """
+        with self._lock:
+            self._disabled = True
+            self._generation += 1
+            self._extents.clear()
+
+    def _fetch(self, backend, context, generation):
+        extents = []
+        for ext in backend.extents(context=context):
+            extents.append(ext)
+            yield ext
+
+        with self._lock:
+            # If the image was modified while we were getting the extents,
+            # the extents may be stale.
+            if (not self._writers and not self._disabled and
+                    generation == self._generation):
+                self._extents[context] = extents
+
+
+def _slice(extents, start, length):
+    """
+    Return a copy of the sorted list extents items overlapping the range
+    start to start + length.
+    """
+    first = max(_find(extents, start), 0)
+    if length is None:
+        last = len(extents)
+    else:
+        last = bisect.bisect_left(extents, (start + length,))
+    return extents[first:last]
+
+
+def _replace(extents, new):
+    """
+    Replace the range of extent new in the sorted list extents with new,
+    merging it with adjacent extents of the same type.
+
+    Return False if the range is not within extents.
+    """
+    start = new.start
+    end = start + new.length
+
+    if not extents:
+        return False
+    last_ext = extents[-1]
+    if end > last_ext.start + last_ext.length:
+        return False
+
+    # The extent containing start, and the extent after the extent
+    # containing end.
+    first = _find(extents, start)
+    last = bisect.bisect_left(extents, (end,))
+
+    head = extents[first]
+    tail = extents[last - 1]
+    tail_end = tail.start + tail.length
+
+    replacement = []
+    if head.start < start:
+        replacement.append(head._replace(length=start - head.start))
+    replacement.append(new)
+    if tail_end > end:
+        replacement.append(tail._replace(start=end, length=tail_end - end))
+
+    # Include the adjacent extents so they can be merged.
+    lo = max(first - 1, 0)
+    hi = min(last + 1, len(extents))
+    window = extents[lo:first] + replacement + extents[last:hi]
+
+    extents[lo:hi] = _merged(window)
+    return True
+
+
+def _find(extents, offset):
+    """
+    Return the index of the extent containing offset in the sorted list
+    extents, or -1 if offset is before the first extent.
+    """
+    # Tuples are compared item by item, so (offset, inf) is larger than all
+    # extents starting at offset, and (offset,) is smaller than all extents
+    # starting at offset.
+    return bisect.bisect_right(extents, (offset, math.inf)) - 1
+
+
+def _merged(extents):
+    """
+    Merge consecutive extents of same type.
+    """
+    result = [extents[0]]
+    for ext in extents[1:]:
+        prev = result[-1]
+        if ext.flags == prev.flags:
+            result[-1] = prev._replace(length=prev.length + ext.length)
+        else:
+            result.append(ext)
+    return result
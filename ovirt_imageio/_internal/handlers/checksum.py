@@ -3,9 +3,14 @@
 
 import hashlib
 import logging
+import queue
+
+from contextlib import contextmanager
+from functools import partial
 
 from .. import backends
 from .. import blkhash
+from .. import bufpool
 from .. import errors
 from .. import http
 from .. import ioutil
@@ -35,28 +40,64 @@ class Checksum:
         if not ticket_id:
             raise http.Error(http.BAD_REQUEST, "Ticket id is required")
 
-        algorithm = validate.enum(
-            req.query,
-            "algorithm",
-            ALGORITHMS,
-            default=blkhash.ALGORITHM)
+        algorithm, block_size = _parse_params(req)
 
         try:
-            block_size = int(req.query.get("block_size", blkhash.BLOCK_SIZE))
-        except ValueError:
-            raise http.Error(
-                http.BAD_REQUEST,
-                "Invalid block size: {!r}".format(req.query["block_size"]))
+            ticket = self.auth.authorize(ticket_id, "read")
+            ctx = backends.get(req, ticket, self.config)
+        except errors.AuthorizationError as e:
+            raise http.Error(http.FORBIDDEN, str(e))
 
-        if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
-            raise http.Error(
-                http.BAD_REQUEST,
-                "Block size out of allowed range: {}-{}"
-                .format(MIN_BLOCK_SIZE, MAX_BLOCK_SIZE))
+        log.info("[%s] CHECKSUM transfer=%s algorithm=%s block_size=%s",
+                 req.client_addr, ticket.transfer_id, algorithm, block_size)
+
+        with _workers(self.config, ticket, ctx.backend) as workers:
+            try:
+                with bufpool.lease(block_size) as buf:
+                    op = Operation(
+                        ctx.backend,
+                        buf,
+                        algorithm,
+                        workers=workers,
+                        extents=partial(ticket.extents, ctx.backend),
+                        clock=req.clock)
+                    checksum = ticket.run(op)
+            except errors.AuthorizationError as e:
+                resp.close_connection()
+                raise http.Error(http.FORBIDDEN, str(e)) from None
+            except errors.BufferPoolTimeout as e:
+                raise http.Error(http.SERVICE_UNAVAILABLE, str(e)) from None
+            except errors.BufferTooLarge as e:
+                raise http.Error(
+                    http.REQUEST_ENTITY_TOO_LARGE, str(e)) from None
+
+        resp.send_json(checksum)
+
+
+class Map:
+    """
+    Handle requests for the /images/ticket-id/checksum/map resource.
+
+    Return the digests of the image blocks, allowing a client to transfer
+    only the blocks that differ.
+    """
 
-        if block_size % 4096:
+    def __init__(self, config, auth):
+        self.config = config
+        self.auth = auth
+
+    def get(self, req, resp, ticket_id):
+        if not ticket_id:
+            raise http.Error(http.BAD_REQUEST, "Ticket id is required")
+
+        algorithm, block_size = _parse_params(req)
+
+        offset = _parse_int(req, "offset", 0)
+        if offset % block_size:
             raise http.Error(
-                http.BAD_REQUEST, "Block size is not aligned to 4096")
+                http.BAD_REQUEST,
+                "Offset {} is not aligned to block size {}"
+                .format(offset, block_size))
 
         try:
             ticket = self.auth.authorize(ticket_id, "read")
@@ -64,21 +105,45 @@ class Checksum:
         except errors.AuthorizationError as e:
             raise http.Error(http.FORBIDDEN, str(e))
 
-        log.info("[%s] CHECKSUM transfer=%s algorithm=%s block_size=%s",
-                 req.client_addr, ticket.transfer_id, algorithm, block_size)
+        image_size = ctx.backend.size()
+        if offset > image_size:
+            raise http.Error(
+                http.REQUESTED_RANGE_NOT_SATISFIABLE,
+                "Offset {} is after end of image {}"
+                .format(offset, image_size),
+                content_range="bytes */{}".format(image_size))
+
+        length = _parse_int(req, "length", image_size - offset)
+        validate.available_range(offset, length, ticket, ctx.backend)
 
-        # For simplicity we create a new buffer even if block_size is same as
-        # ctx.buffer length.
+        log.info("[%s] CHECKSUM MAP transfer=%s algorithm=%s block_size=%s "
+                 "offset=%s length=%s",
+                 req.client_addr, ticket.transfer_id, algorithm, block_size,
+                 offset, length)
 
-        with util.aligned_buffer(block_size) as buf:
-            op = Operation(ctx.backend, buf, algorithm, clock=req.clock)
+        with _workers(self.config, ticket, ctx.backend) as workers:
             try:
-                checksum = ticket.run(op)
+                with bufpool.lease(block_size) as buf:
+                    op = MapOperation(
+                        ctx.backend,
+                        buf,
+                        algorithm,
+                        offset=offset,
+                        size=length,
+                        workers=workers,
+                        extents=partial(ticket.extents, ctx.backend),
+                        clock=req.clock)
+                    checksum_map = ticket.run(op)
             except errors.AuthorizationError as e:
                 resp.close_connection()
                 raise http.Error(http.FORBIDDEN, str(e)) from None
+            except errors.BufferPoolTimeout as e:
+                raise http.Error(http.SERVICE_UNAVAILABLE, str(e)) from None
+            except errors.BufferTooLarge as e:
+                raise http.Error(
+                    http.REQUEST_ENTITY_TOO_LARGE, str(e)) from None
 
-        resp.send_json(checksum)
+        resp.send_json(checksum_map)
 
 
 class Algorithms:
@@ -95,61 +160,319 @@ class Algorithms:
         resp.send_json({"algorithms": sorted(ALGORITHMS)})
 
 
+@contextmanager
+def _workers(config, ticket, backend):
+    """
+    Yield the number of checksum workers, reserving a backend connection for
+    every worker. Every worker uses its own connection, so the number of
+    workers is limited by the connections already used by the ticket.
+    """
+    count = min(config.daemon.checksum_workers, backend.max_readers)
+    if count < 2:
+        yield 1
+        return
+
+    with ticket.reserve_connections(count, backend.max_readers) as reserved:
+        if reserved < 2:
+            log.debug("Backend connections in use, using 1 worker")
+        yield max(reserved, 1)
+
+
+def _parse_params(req):
+    """
+    Parse and validate algorithm and block_size query parameters.
+    """
+    algorithm = validate.enum(
+        req.query,
+        "algorithm",
+        ALGORITHMS,
+        default=blkhash.ALGORITHM)
+
+    block_size = _parse_int(req, "block_size", blkhash.BLOCK_SIZE)
+
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise http.Error(
+            http.BAD_REQUEST,
+            "Block size out of allowed range: {}-{}"
+            .format(MIN_BLOCK_SIZE, MAX_BLOCK_SIZE))
+
+    if block_size % 4096:
+        raise http.Error(
+            http.BAD_REQUEST, "Block size is not aligned to 4096")
+
+    return algorithm, block_size
+
+
+def _parse_int(req, name, default):
+    try:
+        value = int(req.query.get(name, default))
+    except ValueError:
+        raise http.Error(
+            http.BAD_REQUEST,
+            "Invalid {}: {!r}".format(name.replace("_", " "), req.query[name]))
+
+    if value < 0:
+        raise http.Error(
+            http.BAD_REQUEST, "Invalid {}: {}".format(name, value))
+
+    return value
+
+
+def new_hash(algorithm, block_size):
+    """
+    Return blkhash.Hash used for computing checksums with algorithm and
+    block_size.
+    """
+    # Only blakse2b and blake2s support variable digest size, and 32 works
+    # with both and is large enough.
+    if algorithm.startswith("blake2"):
+        digest_size = blkhash.DIGEST_SIZE
+    else:
+        digest_size = None
+
+    return blkhash.Hash(
+        block_size=block_size,
+        algorithm=algorithm,
+        digest_size=digest_size)
+
+
 class Operation(ops.Operation):
     """
     Checksum operation.
+
+    If workers is larger than 1, data blocks are read and hashed by worker
+    threads, each using its own clone of the backend, and block digests are
+    combined in the order of the blocks, producing the same checksum.
+
+    If offset or size are specified, compute checksum of size bytes starting
+    at offset. offset must be aligned to block size.
+
+    If extents is specified, it is used to get the image extents instead of
+    backend.extents(), for example to use the ticket extents cache.
     """
 
     name = "checksum"
 
     def __init__(self, backend, buf, algorithm, detect_zeroes=True,
-                 clock=None):
-        super().__init__(size=backend.size(), buf=buf, clock=clock)
+                 workers=1, offset=0, size=None, extents=None, clock=None):
+        if size is None:
+            size = backend.size() - offset
+        super().__init__(size=size, offset=offset, buf=buf, clock=clock)
         self._backend = backend
+        self._get_extents = extents or backend.extents
         self._algorithm = algorithm
         self._detect_zeroes = detect_zeroes
+        self._workers = workers
 
     def _run(self):
-        block_size = len(self._buf)
-        # Only blakse2b and blake2s support variable digest size, and 32 works
-        # with both and is large enough.
-        if self._algorithm.startswith("blake2"):
-            digest_size = blkhash.DIGEST_SIZE
+        h = self._hash()
+        self._compute(h, h.update_digest)
+        return {
+            "algorithm": self._algorithm,
+            "block_size": len(self._buf),
+            "checksum": h.hexdigest(),
+        }
+
+    def _hash(self):
+        return new_hash(self._algorithm, len(self._buf))
+
+    def _compute(self, h, add_digest):
+        """
+        Compute the digests of the blocks in the requested range, calling
+        add_digest() with every block digest in the order of the blocks.
+        """
+        blocks = self._blocks()
+        if self._workers > 1:
+            self._run_parallel(h, blocks, add_digest)
         else:
-            digest_size = None
+            self._run_serial(h, blocks, add_digest)
+
+    def _blocks(self):
+        end = self._offset + self._size
+        extents = self._get_extents("zero")
+        for block in blkhash.split(extents, len(self._buf)):
+            if block.start + block.length <= self._offset:
+                continue
+            if block.start >= end:
+                break
+            # The last block may be partial if the range is not aligned to
+            # block size.
+            block.length = min(block.length, end - block.start)
+            yield block
+
+    def _run_serial(self, h, blocks, add_digest):
+        for block in blocks:
+            block_digest = self._block_digest(
+                h, self._backend, self._buf, block)
+            add_digest(block_digest)
+            self._done += block.length
 
-        h = blkhash.Hash(
-            block_size=block_size,
-            algorithm=self._algorithm,
-            digest_size=digest_size)
+            if self._canceled:
+                raise ops.Canceled
+
+    def _run_parallel(self, h, blocks, add_digest):
+        work = queue.Queue()
+        results = queue.Queue()
+        workers = []
+        resources = []
+        buffers = []
 
-        for block in blkhash.split(self._backend.extents("zero"), block_size):
-            if block.zero:
-                h.zero(block.length)
+        # Block digests waiting for previous blocks: index -> (digest, length)
+        pending = {}
+        next_index = 0
+
+        # Limit the number of blocks we have not combined yet, to keep memory
+        # usage bounded when blocks complete out of order.
+        max_pending = self._workers * 2
+        inflight = 0
+
+        try:
+            for i in range(self._workers):
+                # Use less workers if the buffer pool is exhausted, instead of
+                # waiting while holding our buffer.
+                try:
+                    buf = bufpool.acquire(len(self._buf), timeout=0)
+                except errors.BufferPoolTimeout:
+                    log.debug("Buffer pool exhausted, using %d workers",
+                              len(workers))
+                    break
+                buffers.append(buf)
+                backend = self._backend.clone()
+                resources.append(backend)
+                t = util.start_thread(
+                    self._worker_loop,
+                    args=(h, backend, buf, work, results),
+                    name="checksum/{}".format(i))
+                workers.append(t)
+
+            if not workers:
+                self._run_serial(h, blocks, add_digest)
+                return
+
+            for index, block in enumerate(blocks):
+                if block.zero:
+                    block_digest = h.zero_digest(block.length)
+                    pending[index] = (block_digest, block.length)
+                else:
+                    work.put((index, block))
+                    inflight += 1
+
+                while inflight and index + 1 - next_index >= max_pending:
+                    self._wait_for_result(results, pending)
+                    inflight -= 1
+                    next_index = self._combine(add_digest, pending, next_index)
+
+                next_index = self._combine(add_digest, pending, next_index)
+
+                if self._canceled:
+                    raise ops.Canceled
+
+            while inflight:
+                self._wait_for_result(results, pending)
+                inflight -= 1
+                next_index = self._combine(add_digest, pending, next_index)
+
+                if self._canceled:
+                    raise ops.Canceled
+        finally:
+            # Drop blocks not processed yet and stop the workers.
+            while True:
+                try:
+                    work.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in workers:
+                work.put(None)
+            for t in workers:
+                t.join()
+            for r in resources:
+                r.close()
+            for buf in buffers:
+                bufpool.release(buf)
+
+    def _wait_for_result(self, results, pending):
+        index, result = results.get()
+        if isinstance(result, Exception):
+            raise result
+        pending[index] = result
+
+    def _combine(self, add_digest, pending, next_index):
+        """
+        Add digests of consecutive completed blocks, and return the index of
+        the next block to add.
+        """
+        while next_index in pending:
+            block_digest, length = pending.pop(next_index)
+            add_digest(block_digest)
+            self._done += length
+            next_index += 1
+        return next_index
+
+    def _worker_loop(self, h, backend, buf, work, results):
+        """
+        Compute digests of blocks using backend. Runs in a worker thread.
+        """
+        while True:
+            item = work.get()
+            if item is None:
+                return
+
+            index, block = item
+            try:
+                block_digest = self._block_digest(h, backend, buf, block)
+            except Exception as e:
+                results.put((index, e))
             else:
-                with memoryview(self._buf)[:block.length] as view:
-                    self._backend.seek(block.start)
-                    self._backend.readinto(view)
-                    if self._detect_zeroes and ioutil.is_zero(view):
-                        h.zero(block.length)
-                    else:
-                        h.update(view)
+                results.put((index, (block_digest, block.length)))
 
-            self._done += block.length
+    def _block_digest(self, h, backend, buf, block):
+        if block.zero:
+            return h.zero_digest(block.length)
+
+        with memoryview(buf)[:block.length] as view:
+            backend.seek(block.start)
+            backend.readinto(view)
+            if self._detect_zeroes and ioutil.is_zero(view):
+                return h.zero_digest(block.length)
+            else:
+                return h.block_digest(view)
 
-            if self._canceled:
-                raise ops.Canceled
 
+class MapOperation(Operation):
+    """
+    Compute the digests of the image blocks.
+    """
+
+    name = "checksum_map"
+
+    def _run(self):
+        h = self._hash()
+        digests = []
+        self._compute(h, lambda block_digest: digests.append(block_digest))
         return {
             "algorithm": self._algorithm,
-            "block_size": block_size,
-            "checksum": h.hexdigest(),
+            "block_size": len(self._buf),
+            "offset": self._offset,
+            "length": self._size,
+            "digests": [d.hex() for d in digests],
         }
 
 
-def compute(backend, buf, algorithm=blkhash.ALGORITHM, detect_zeroes=True):
+def compute(backend, buf, algorithm=blkhash.ALGORITHM, detect_zeroes=True,
+            workers=1):
     """
     Compute image checksum.
     """
-    op = Operation(backend, buf, algorithm, detect_zeroes=detect_zeroes)
+    op = Operation(
+        backend, buf, algorithm, detect_zeroes=detect_zeroes, workers=workers)
+    return op.run()
+
+
+def compute_map(backend, buf, algorithm=blkhash.ALGORITHM, detect_zeroes=True,
+                workers=1):
+    """
+    Compute image block digests.
+    """
+    op = MapOperation(
+        backend, buf, algorithm, detect_zeroes=detect_zeroes, workers=workers)
     return op.run()
@@ -1,15 +1,25 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import itertools
+import json
 import logging
 
 from .. import backends
 from .. import errors
+from .. import extent
 from .. import http
 from .. import validate
 
 log = logging.getLogger("extents")
 
+# Extents are sent in chunks of about this size, so the client can process
+# the first extents while the server is still getting the next extents.
+CHUNK_SIZE = 64 * 1024
+
+# Content type of the binary extents format.
+BINARY = "application/octet-stream"
+
 
 class Handler:
     """
@@ -38,14 +48,119 @@ class Handler:
             raise http.Error(
                 http.NOT_FOUND, "Ticket does not support dirty extents")
 
-        log.info("[%s] EXTENTS transfer=%s context=%s",
-                 req.client_addr, ticket.transfer_id, context)
+        fmt = _parse_format(req)
+
+        image_size = ctx.backend.size()
+
+        start = _parse_int(req, "start", 0)
+        if start > image_size:
+            raise http.Error(
+                http.REQUESTED_RANGE_NOT_SATISFIABLE,
+                "Start {} is after end of image {}"
+                .format(start, image_size),
+                content_range="bytes */{}".format(image_size))
+
+        # If length is not specified, return all extents after start.
+        length = None
+        if "length" in req.query:
+            length = _parse_int(req, "length", None)
+            if start + length > image_size:
+                raise http.Error(
+                    http.REQUESTED_RANGE_NOT_SATISFIABLE,
+                    "Requested range is after end of image: {} > {}"
+                    .format(start + length, image_size),
+                    content_range="bytes */{}".format(image_size))
+
+        log.info("[%s] EXTENTS transfer=%s context=%s format=%s start=%s "
+                 "length=%s",
+                 req.client_addr, ticket.transfer_id, context, fmt, start,
+                 length)
 
         with req.clock.run("extents"):
+            extents = ticket.extents(
+                ctx.backend, context=context, start=start, length=length)
+
+            # Get the first extent before starting the response, so we can
+            # still fail the request if the backend does not support this
+            # context.
             try:
-                extents = [ext.to_dict()
-                           for ext in ctx.backend.extents(context=context)]
+                first = next(extents, None)
             except errors.UnsupportedOperation as e:
                 raise http.Error(http.NOT_FOUND, str(e))
 
-        resp.send_json(extents)
+            if first is not None:
+                extents = itertools.chain([first], extents)
+
+            if fmt == "binary":
+                resp.send_chunked(_binary_chunks(extents), content_type=BINARY)
+            else:
+                resp.send_chunked(_json_chunks(extents))
+
+
+def _parse_format(req):
+    """
+    Return the requested extents format. The format query parameter takes
+    precedence over the Accept header.
+    """
+    if "format" in req.query:
+        return validate.enum(req.query, "format", ("json", "binary"))
+
+    if BINARY in req.headers.get("accept", ""):
+        return "binary"
+
+    return "json"
+
+
+def _json_chunks(extents, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over chunks of JSON array of extents. The result is the same as
+    json.dumps() of the list of extents dicts.
+    """
+    buf = bytearray(b"[")
+    sep = b""
+
+    for ext in extents:
+        buf += sep
+        buf += json.dumps(ext.to_dict()).encode("utf-8")
+        sep = b", "
+
+        if len(buf) >= chunk_size:
+            yield buf
+            buf = bytearray()
+
+    # Adding newline makes it easier to debug from the command line.
+    buf += b"]\n"
+    yield buf
+
+
+def _binary_chunks(extents, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over chunks of binary extent records.
+    """
+    buf = bytearray()
+    pack = extent.RECORD.pack
+
+    for ext in extents:
+        buf += pack(ext.start, ext.length, ext.flags)
+
+        if len(buf) >= chunk_size:
+            yield buf
+            buf = bytearray()
+
+    if buf:
+        yield buf
+
+
+def _parse_int(req, name, default):
+    try:
+        value = int(req.query.get(name, default))
+    except ValueError:
+        raise http.Error(
+            http.BAD_REQUEST,
+            "Invalid {}: {!r}".format(name, req.query[name]))
+
+    if value < 0:
+        raise http.Error(
+            http.BAD_REQUEST, "Invalid {}: {}".format(name, value))
+
+    return value
@@ -0,0 +1,76 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+
+from .. import errors
+from .. import http
+from .. import util
+
+log = logging.getLogger("fd")
+
+
+class Handler:
+    """
+    Handle requests for the /images/ticket-id/fd resource.
+
+    Pass an open file descriptor for the ticket image to the client, so local
+    clients can access the image directly instead of transferring the data
+    over HTTP. Supported only by the local service, for tickets using a file
+    backend, when local:fd_passing is enabled.
+
+    The file descriptor is opened read-only if the ticket allows only
+    reading, and read-write if the ticket allows writing. It is opened
+    without O_DIRECT; clients can enable it using fcntl(F_SETFL). Writes
+    using the file descriptor are not seen by the ticket extents cache, so
+    passing a writable file descriptor disables the cache for the ticket.
+
+    The file descriptor provides access to the entire file. Clients must
+    access only the first "size" bytes, as reported in the response. The
+    server cannot revoke the file descriptor when the ticket expires or is
+    canceled.
+    """
+
+    def __init__(self, config, auth):
+        self.config = config
+        self.auth = auth
+
+    def get(self, req, resp, ticket_id):
+        if not ticket_id:
+            raise http.Error(http.BAD_REQUEST, "Ticket id is required")
+
+        if not self.config.local.fd_passing:
+            raise http.Error(
+                http.NOT_FOUND, "File descriptor passing is disabled")
+
+        try:
+            ticket = self.auth.authorize(ticket_id, "read")
+        except errors.AuthorizationError as e:
+            resp.close_connection()
+            raise http.Error(http.FORBIDDEN, str(e))
+
+        if ticket.url.scheme != "file":
+            raise http.Error(
+                http.NOT_FOUND,
+                "Ticket backend {!r} does not support file descriptor passing"
+                .format(ticket.url.scheme))
+
+        mode = "r+" if ticket.may("write") else "r"
+
+        log.info("[%s] FD transfer=%s mode=%s",
+                 req.client_addr, ticket.transfer_id, mode)
+
+        try:
+            fio = util.open(ticket.url.path, mode, direct=False)
+        except OSError as e:
+            raise http.Error(
+                http.INTERNAL_SERVER_ERROR,
+                "Cannot open image: {}".format(e)) from None
+
+        if mode == "r+":
+            ticket.disable_extents_cache()
+
+        with fio:
+            resp.send_fd(fio.fileno(), {"mode": mode, "size": ticket.size})
+
+        ticket.touch()
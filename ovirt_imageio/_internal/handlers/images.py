@@ -5,6 +5,7 @@ import json
 import logging
 
 from .. import backends
+from .. import bufpool
 from .. import cors
 from .. import errors
 from .. import http
@@ -13,8 +14,11 @@ from .. import validate
 
 log = logging.getLogger("images")
 
-BASE_FEATURES = ("checksum", "extents")
-ALL_FEATURES = BASE_FEATURES + ("flush", "zero")
+BASE_FEATURES = ("checksum", "extents", "extents_binary")
+ALL_FEATURES = BASE_FEATURES + ("flush", "zero", "zero_ranges")
+
+# Maximum number of ranges in single PATCH/zero request.
+MAX_ZERO_RANGES = 1024
 
 
 class Handler:
@@ -60,21 +64,27 @@ class Handler:
             "[%s] WRITE size=%d offset=%d flush=%s close=%s transfer=%s",
             req.client_addr, size, offset, flush, close, ticket.transfer_id)
 
-        op = ops.Write(
-            ctx.backend,
-            req,
-            ctx.buffer,
-            size,
-            offset=offset,
-            flush=flush,
-            clock=req.clock)
         try:
-            ticket.run(op)
+            with bufpool.lease(ctx.buffer_size) as buf:
+                op = ops.Write(
+                    ctx.backend,
+                    req,
+                    buf,
+                    size,
+                    offset=offset,
+                    flush=flush,
+                    write_behind=self.config.daemon.write_behind,
+                    detect_zeroes=self.config.daemon.detect_zeroes,
+                    zero_copy=self.config.daemon.zero_copy_upload,
+                    clock=req.clock)
+                ticket.run(op)
         except errors.AuthorizationError as e:
             resp.close_connection()
             raise http.Error(http.FORBIDDEN, str(e)) from None
         except errors.PartialContent as e:
             raise http.Error(http.BAD_REQUEST, str(e))
+        except (errors.BufferPoolTimeout, errors.BufferTooLarge) as e:
+            raise http.Error(http.SERVICE_UNAVAILABLE, str(e)) from None
 
     @cors.allow()
     def get(self, req, resp, ticket_id):
@@ -132,20 +142,25 @@ class Handler:
             resp.headers["content-range"] = "bytes %d-%d/%d" % (
                 offset, offset + size - 1, ticket.size)
 
-        op = ops.Read(
-            ctx.backend,
-            resp,
-            ctx.buffer,
-            size,
-            offset=offset,
-            clock=req.clock)
         try:
-            ticket.run(op)
+            with bufpool.lease(ctx.buffer_size) as buf:
+                op = ops.Read(
+                    ctx.backend,
+                    resp,
+                    buf,
+                    size,
+                    offset=offset,
+                    read_ahead=self.config.daemon.read_ahead,
+                    zero_copy=self.config.daemon.zero_copy,
+                    clock=req.clock)
+                ticket.run(op)
         except errors.AuthorizationError as e:
             resp.close_connection()
             raise http.Error(http.FORBIDDEN, str(e)) from None
         except errors.PartialContent as e:
             raise http.Error(http.BAD_REQUEST, str(e))
+        except (errors.BufferPoolTimeout, errors.BufferTooLarge) as e:
+            raise http.Error(http.SERVICE_UNAVAILABLE, str(e)) from None
 
     def patch(self, req, resp, ticket_id):
         if not ticket_id:
@@ -168,6 +183,9 @@ class Handler:
             raise RuntimeError("Unreachable")
 
     def _zero(self, req, resp, ticket_id, msg):
+        if "ranges" in msg:
+            return self._zero_ranges(req, resp, ticket_id, msg)
+
         size = validate.integer(msg, "size", minval=0)
         offset = validate.integer(msg, "offset", minval=0, default=0)
         flush = validate.boolean(msg, "flush", default=False)
@@ -200,6 +218,58 @@ class Handler:
         except errors.PartialContent as e:
             raise http.Error(http.BAD_REQUEST, str(e))
 
+    def _zero_ranges(self, req, resp, ticket_id, msg):
+        """
+        Zero multiple ranges in order, and flush if requested after zeroing
+        all ranges.
+        """
+        ranges = msg["ranges"]
+        if not isinstance(ranges, list):
+            raise http.Error(
+                http.BAD_REQUEST, "List required {!r}".format(ranges))
+        if len(ranges) > MAX_ZERO_RANGES:
+            raise http.Error(
+                http.BAD_REQUEST,
+                "Too many ranges {} > {}".format(len(ranges), MAX_ZERO_RANGES))
+
+        # Validate all ranges before zeroing anything.
+        zero_ranges = []
+        for r in ranges:
+            if not isinstance(r, dict):
+                raise http.Error(
+                    http.BAD_REQUEST, "Invalid range {!r}".format(r))
+            size = validate.integer(r, "size", minval=0)
+            offset = validate.integer(r, "offset", minval=0)
+            zero_ranges.append((offset, size))
+
+        flush = validate.boolean(msg, "flush", default=False)
+
+        try:
+            ticket = self.auth.authorize(ticket_id, "write")
+            ctx = backends.get(req, ticket, self.config)
+        except errors.AuthorizationError as e:
+            resp.close_connection()
+            raise http.Error(http.FORBIDDEN, str(e))
+
+        for offset, size in zero_ranges:
+            validate.allowed_range(offset, size, ticket)
+
+        log.debug(
+            "[%s] ZERO ranges=%d flush=%s transfer=%s",
+            req.client_addr, len(zero_ranges), flush, ticket.transfer_id)
+
+        try:
+            for offset, size in zero_ranges:
+                ticket.run(ops.Zero(
+                    ctx.backend, size, offset=offset, clock=req.clock))
+            if flush:
+                ticket.run(ops.Flush(ctx.backend, clock=req.clock))
+        except errors.AuthorizationError as e:
+            resp.close_connection()
+            raise http.Error(http.FORBIDDEN, str(e)) from None
+        except errors.PartialContent as e:
+            raise http.Error(http.BAD_REQUEST, str(e))
+
     def _flush(self, req, resp, ticket_id, msg):
         try:
             ticket = self.auth.authorize(ticket_id, "write")
@@ -0,0 +1,18 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+
+class Handler:
+    """
+    Handle requests for the /stats/ resource.
+
+    Return the server statistics, for monitoring the server while it runs.
+    """
+
+    def __init__(self, config, auth, get_stats):
+        self.config = config
+        self.auth = auth
+        self.get_stats = get_stats
+
+    def get(self, req, resp):
+        resp.send_json(self.get_stats())
@@ -6,6 +6,7 @@ import logging
 
 from .. import errors
 from .. import http
+from .. import jobs
 from .. import validate
 
 log = logging.getLogger("tickets")
@@ -107,3 +108,78 @@ class Handler:
             self.auth.clear()
 
         resp.status_code = http.NO_CONTENT
+
+
+class Copy:
+    """
+    Handle requests for the /tickets/ticket-id/copy resource.
+
+    Start copying image data from the source ticket specified in the request
+    to this ticket in the server. The copy progress is reported in the ticket
+    info "job" key.
+    """
+
+    def __init__(self, config, auth):
+        self.config = config
+        self.auth = auth
+
+    def post(self, req, resp, ticket_id):
+        if not ticket_id:
+            raise http.Error(http.BAD_REQUEST, "Ticket id is required")
+
+        try:
+            msg = json.loads(req.read())
+        except ValueError as e:
+            raise http.Error(
+                http.BAD_REQUEST, "Invalid copy request: {}".format(e))
+
+        if not isinstance(msg, dict):
+            raise http.Error(
+                http.BAD_REQUEST,
+                "Invalid copy request: {!r}, expecting a dict".format(msg))
+
+        src_id = msg.get("src")
+        if not isinstance(src_id, str):
+            raise http.Error(
+                http.BAD_REQUEST, "Invalid source ticket id: {!r}"
+                .format(src_id))
+
+        zero = validate.boolean(msg, "zero", default=True)
+        hole = validate.boolean(msg, "hole", default=True)
+
+        src = self._get(src_id, "read")
+        dst = self._get(ticket_id, "write")
+
+        if src.size > dst.size:
+            raise http.Error(
+                http.BAD_REQUEST,
+                "Source size {} is larger than destination size {}"
+                .format(src.size, dst.size))
+
+        log.info("[%s] COPY src=%s dst=%s zero=%s hole=%s",
+                 req.client_addr, src.transfer_id, dst.transfer_id, zero,
+                 hole)
+
+        job = jobs.CopyJob(src, dst, self.config, zero=zero, hole=hole)
+        try:
+            dst.start_job(job)
+        except errors.AuthorizationError as e:
+            raise http.Error(http.FORBIDDEN, str(e))
+        except errors.JobInProgress as e:
+            raise http.Error(http.CONFLICT, str(e))
+
+        resp.status_code = http.ACCEPTED
+
+    def _get(self, ticket_id, op):
+        try:
+            ticket = self.auth.get(ticket_id)
+        except KeyError:
+            raise http.Error(
+                http.NOT_FOUND, "No such ticket {!r}".format(ticket_id))
+
+        if not ticket.may(op):
+            raise http.Error(
+                http.FORBIDDEN,
+                "Transfer {} forbids {}".format(ticket.transfer_id, op))
+
+        return ticket
@@ -1,6 +1,8 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import array
+import email.utils
 import errno
 import http.server
 import io
@@ -8,13 +10,20 @@ import ipaddress
 import itertools
 import json
 import logging
+import os
+import queue
 import re
+import select
 import socket
 import socketserver
+import ssl
+import threading
+import time
 import urllib
 
 from . import errors
 from . import stats
+from . import util
 from . import version
 
 log = logging.getLogger("http")
@@ -23,6 +32,7 @@ log = logging.getLogger("http")
 # See https://tools.ietf.org/html/rfc2616#section-6.1.1
 CONTINUE = 100
 OK = 200
+ACCEPTED = 202
 NO_CONTENT = 204
 PARTIAL_CONTENT = 206
 BAD_REQUEST = 400
@@ -31,9 +41,13 @@ NOT_FOUND = 404
 METHOD_NOT_ALLOWED = 405
 NOT_ACCEPTABLE = 406
 CONFLICT = 409
+REQUEST_ENTITY_TOO_LARGE = 413
 REQUEST_URI_TOO_LARGE = 414
 REQUESTED_RANGE_NOT_SATISFIABLE = 416
+REQUEST_HEADER_FIELDS_TOO_LARGE = 431
 INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+HTTP_VERSION_NOT_SUPPORTED = 505
 
 # Taken from asyncore.py. Treat these as expected error when reading or writing
 # to client connection.
@@ -48,6 +62,20 @@ _DISCONNECTED = frozenset((
 # Sentinel for lazy initialization, ensuring that we initialize only once.
 _UNKNOWN = object()
 
+# Server header value.
+_SERVER = "imageio/" + version.string
+
+# Cached response status lines: status code -> bytes.
+_status_lines = {}
+
+# Cached Date header value: (seconds, bytes).
+_date = (0, b"")
+
+# Kernel TLS socket options from linux/tls.h, not available in the socket
+# module.
+_SOL_TLS = 282
+_TLS_TX = 1
+
 
 class Error(Exception):
 
@@ -81,7 +109,23 @@ class Server(socketserver.ThreadingMixIn,
     # profiling.
     clock_class = stats.NullClock
 
-    def __init__(self, server_address, RequestHandlerClass, prefer_ipv4=False):
+    # Maximum number of worker threads serving connections. If 0, serve every
+    # connection in a new thread.
+    max_workers = 0
+
+    # Maximum number of accepted connections waiting for a worker thread.
+    # When the queue is full, the server stops accepting connections until a
+    # worker becomes available.
+    max_queued = 40
+
+    def __init__(self, server_address, RequestHandlerClass, prefer_ipv4=False,
+                 reuse_port=False):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._reuse_port = reuse_port
+        self._handshakes_lock = threading.Lock()
+        self._handshakes = {"full": 0, "resumed": 0}
+
         super().__init__(
             server_address, RequestHandlerClass, bind_and_activate=False)
 
@@ -136,8 +180,14 @@ class Server(socketserver.ThreadingMixIn,
 
     def server_bind(self):
         """
-        Override server_bind to make server_address uniform.
+        Override server_bind to make server_address uniform, and allow
+        multiple processes to bind the same port.
         """
+        if self._reuse_port:
+            # Let the kernel distribute connections between processes
+            # listening on the same address and port.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         super().server_bind()
 
         # TCPServer.server_bind() overwrites server_address with
@@ -148,6 +198,186 @@ class Server(socketserver.ThreadingMixIn,
         # hostname/IP address and port number.
         self.server_address = self.server_address[:2]
 
+    def record_handshake(self, resumed):
+        """
+        Count a completed TLS handshake.
+        """
+        with self._handshakes_lock:
+            self._handshakes["resumed" if resumed else "full"] += 1
+
+    def handshakes(self):
+        """
+        Return the number of full and resumed TLS handshakes.
+        """
+        with self._handshakes_lock:
+            return dict(self._handshakes)
+
+    def process_request(self, request, client_address):
+        """
+        Override to serve the connection using the worker pool if
+        max_workers is set.
+        """
+        if not self.max_workers:
+            super().process_request(request, client_address)
+            return
+
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = WorkerPool(
+                    self, self.max_workers, self.max_queued)
+
+        self._pool.submit(request, client_address)
+
+    def shutdown(self):
+        # Closing the pool first unblocks the server loop if it is waiting
+        # for a free worker.
+        with self._pool_lock:
+            pool = self._pool
+        if pool:
+            pool.close()
+            log.info("Worker pool stats: %s", pool.stats())
+
+        super().shutdown()
+
+    @property
+    def pool(self):
+        """
+        Return the worker pool, or None if the server does not use a worker
+        pool or did not serve any connection yet.
+        """
+        return self._pool
+
+
+class WorkerPool:
+    """
+    Serve connections using a bounded number of worker threads.
+
+    Accepted connections are queued until a worker is available. When the
+    queue is full, submit() blocks, so the server stops accepting new
+    connections, and new connections wait in the listen backlog.
+    """
+
+    # Seconds to wait for free space in the queue before checking if the pool
+    # was closed.
+    poll_interval = 0.5
+
+    def __init__(self, server, max_workers, max_queued):
+        self._server = server
+        self._max_workers = max_workers
+        self._queue = queue.Queue(max_queued)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = 0
+        self._idle = 0
+        self._served = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._counter = itertools.count(1)
+
+    def submit(self, request, client_address):
+        """
+        Queue connection for serving by a worker thread. Blocks if the queue
+        is full until a worker takes a connection from the queue, or the pool
+        is closed.
+        """
+        with self._lock:
+            if (self._idle <= self._queue.qsize()
+                    and self._workers < self._max_workers):
+                self._start_worker()
+
+        item = (request, client_address, time.monotonic())
+        while True:
+            if self._closed:
+                log.debug("Pool closed, dropping connection from %s",
+                          client_address)
+                self._server.shutdown_request(request)
+                return
+            try:
+                self._queue.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                log.debug("Worker pool busy, waiting for free worker")
+
+    def close(self):
+        """
+        Close the pool, closing queued connections and stopping idle
+        workers. Workers serving connections stop when the connection ends.
+        """
+        self._closed = True
+
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._server.shutdown_request(item[0])
+
+        with self._lock:
+            workers = self._workers
+
+        for _ in range(workers):
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+    def stats(self):
+        """
+        Return pool statistics.
+        """
+        with self._lock:
+            return {
+                "workers": self._workers,
+                "idle": self._idle,
+                "queued": self._queue.qsize(),
+                "served": self._served,
+                "wait_seconds": self._wait_seconds,
+                "max_wait": self._max_wait,
+            }
+
+    def _start_worker(self):
+        # Called with self._lock held.
+        name = "worker/{}".format(next(self._counter))
+        log.debug("Starting worker %s", name)
+        self._workers += 1
+        try:
+            util.start_thread(self._run, name=name)
+        except BaseException:
+            self._workers -= 1
+            raise
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    self._idle += 1
+                try:
+                    item = self._queue.get()
+                finally:
+                    with self._lock:
+                        self._idle -= 1
+
+                if item is None or self._closed:
+                    if item is not None:
+                        self._server.shutdown_request(item[0])
+                    break
+
+                request, client_address, queued = item
+                wait = time.monotonic() - queued
+                with self._lock:
+                    self._served += 1
+                    self._wait_seconds += wait
+                    self._max_wait = max(self._max_wait, wait)
+
+                log.debug("Serving connection from %s waited %.6f seconds",
+                          client_address, wait)
+                self._server.process_request_thread(request, client_address)
+        finally:
+            with self._lock:
+                self._workers -= 1
+            log.debug("Worker stopped")
+
 
 class Connection(http.server.BaseHTTPRequestHandler):
     """
@@ -170,6 +400,9 @@ class Connection(http.server.BaseHTTPRequestHandler):
     # to support long URIs, so we use small value.
     max_request_line = 4096
 
+    # The maximum number of request headers, same as http.client.
+    max_headers = 100
+
     # Number of second to wait for recv() or send() on unauthorized
     # connections.  When the timeout expires we close the connection.
     # Authorized connections get a larger timeout using the ticket
@@ -182,11 +415,20 @@ class Connection(http.server.BaseHTTPRequestHandler):
     # thread name.
     _counter = itertools.count(1)
 
+    # True if this is a TLS connection, and the kernel encrypts data sent on
+    # the connection socket.
+    ktls = False
+
     def setup(self):
         self.id = next(self._counter)
         log.info("OPEN connection=%s client=%s",
                  self.id, self.address_string())
         super().setup()
+        if isinstance(self.connection, ssl.SSLSocket):
+            self.server.record_handshake(self.connection.session_reused)
+            self.ktls = _uses_ktls(self.connection)
+            log.debug("TLS connection=%s resumed=%s ktls=%s",
+                      self.id, self.connection.session_reused, self.ktls)
         # Per connection context, used by application to cache state.
         self.context = Context()
         self.clock = self.server.clock_class()
@@ -244,6 +486,105 @@ class Connection(http.server.BaseHTTPRequestHandler):
             log.debug("Client disconnected: %s", e)
             self.close_connection = 1
 
+    def parse_request(self):
+        """
+        Override to parse the subset of HTTP/1.1 used by imageio clients.
+
+        The original version parses headers using the email package, which
+        is too slow for small requests. This version is also more strict,
+        rejecting HTTP/0.9 requests, obsolete line folding, and invalid
+        header lines.
+
+        Request headers are kept in a Headers dict with lowercase names.
+        Repeated headers are combined to single comma separated value.
+
+        Returns True if the request was parsed, or False if the request was
+        invalid and an error was sent to the client.
+        """
+        self.command = None
+        self.request_version = "HTTP/1.1"
+        self.close_connection = True
+
+        requestline = str(self.raw_requestline, "iso-8859-1").rstrip("\r\n")
+        self.requestline = requestline
+
+        words = requestline.split(" ")
+        if len(words) != 3:
+            self.send_error(
+                BAD_REQUEST, "Bad request syntax ({!r})".format(requestline))
+            return False
+
+        command, path, version = words
+        if version == "HTTP/1.1":
+            self.close_connection = False
+        elif version != "HTTP/1.0":
+            if version.startswith("HTTP/"):
+                code = HTTP_VERSION_NOT_SUPPORTED
+            else:
+                code = BAD_REQUEST
+            self.send_error(
+                code, "Unsupported HTTP version ({!r})".format(version))
+            return False
+
+        self.command = command
+        self.request_version = version
+
+        # Protect against open redirect, see
+        # https://github.com/python/cpython/issues/87389.
+        if path.startswith("//"):
+            path = "/" + path.lstrip("/")
+        self.path = path
+
+        headers = Headers()
+        count = 0
+        while True:
+            line = self.rfile.readline(self.max_request_line + 1)
+            if len(line) > self.max_request_line:
+                self.send_error(
+                    REQUEST_HEADER_FIELDS_TOO_LARGE, "Line too long")
+                return False
+
+            if line in (b"\r\n", b"\n"):
+                break
+
+            if not line:
+                log.debug("Client disconnected while sending headers")
+                self.close_connection = True
+                return False
+
+            count += 1
+            if count > self.max_headers:
+                self.send_error(
+                    REQUEST_HEADER_FIELDS_TOO_LARGE, "Too many headers")
+                return False
+
+            name, sep, value = line.partition(b":")
+            if not sep or not name or b" " in name or b"\t" in name:
+                self.send_error(
+                    BAD_REQUEST, "Invalid header line ({!r})".format(line))
+                return False
+
+            name = str(name, "iso-8859-1").lower()
+            value = str(value, "iso-8859-1").strip(" \t\r\n")
+            if name in headers:
+                value = headers[name] + ", " + value
+            dict.__setitem__(headers, name, value)
+
+        self.headers = headers
+
+        conntype = headers.get("connection", "").lower()
+        if conntype == "close":
+            self.close_connection = True
+        elif conntype == "keep-alive":
+            self.close_connection = False
+
+        if (version == "HTTP/1.1" and
+                headers.get("expect", "").lower() == "100-continue"):
+            if not self.handle_expect_100():
+                return False
+
+        return True
+
     def address_string(self):
         """
         Override to avoid slow and unneeded name lookup.
@@ -273,7 +614,15 @@ class Connection(http.server.BaseHTTPRequestHandler):
         """
         Used in Server header.
         """
-        return "imageio/" + version.string
+        return _SERVER
+
+    def date_time_string(self, timestamp=None):
+        """
+        Override to use the cached Date header value.
+        """
+        if timestamp is None:
+            return _http_date().decode("ascii")
+        return super().date_time_string(timestamp)
 
     def set_timeout(self, timeout):
         log.debug("Setting connection timeout to %s seconds", timeout)
@@ -455,6 +804,93 @@ class Request:
         self._length -= n
         return n
 
+    @property
+    def zero_copy(self):
+        """
+        Return True if splice() can receive data without copying it to user
+        space. Data received on TLS connections must be decrypted in user
+        space, and os.splice() is available only since Python 3.10. The body
+        of a request using a transfer encoding such as "chunked" is not the
+        image data, so it cannot be spliced into the image.
+        """
+        return (hasattr(os, "splice") and
+                not isinstance(self._con.connection, ssl.SSLSocket) and
+                "transfer-encoding" not in self.headers)
+
+    def splice(self, fd, offset, count):
+        """
+        Receive up to count bytes from the request body into file descriptor
+        fd starting at offset using os.splice(), and return the number of
+        bytes received. Should be used only if zero_copy is True.
+
+        Returns less than count bytes only if the client has sent less data.
+        """
+        if not self.length:
+            return 0
+
+        count = min(count, self._length)
+
+        # Data already buffered by the connection cannot be spliced.
+        data = self._take_buffered(count)
+        received = 0
+        while received < len(data):
+            with memoryview(data)[received:] as view:
+                received += os.pwrite(fd, view, offset + received)
+
+        if received < count:
+            received += self._splice(fd, offset + received, count - received)
+
+        self._length -= received
+        return received
+
+    def _take_buffered(self, count):
+        """
+        Return up to count bytes buffered in the connection file, without
+        waiting for more data from the client.
+        """
+        sock = self._con.connection
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            data = self._con.rfile.peek(1)
+        except BlockingIOError:
+            return b""
+        finally:
+            sock.settimeout(timeout)
+
+        data = data[:count]
+        if data:
+            # Consume the buffered data, never reading from the socket.
+            self._con.rfile.read(len(data))
+        return data
+
+    def _splice(self, fd, offset, count):
+        sock = self._con.connection
+        received = 0
+        r, w = os.pipe()
+        try:
+            while received < count:
+                try:
+                    n = os.splice(sock.fileno(), w, count - received)
+                except BlockingIOError:
+                    # The socket has a timeout, so it is non-blocking.
+                    _wait_for(sock, select.POLLIN)
+                    continue
+
+                if n == 0:
+                    break
+
+                # Move the data from the pipe to the file.
+                while n:
+                    written = os.splice(r, fd, n, offset_dst=offset + received)
+                    received += written
+                    n -= written
+        finally:
+            os.close(r)
+            os.close(w)
+
+        return received
+
     def connection_lost(self):
         """
         Return True if the underlying socket was disconnected.
@@ -531,6 +967,110 @@ class Response:
         self.headers["content-type"] = "application/json"
         self.write(body)
 
+    def send_chunked(self, chunks, content_type="application/json"):
+        """
+        Send a response with body of unknown size, writing every chunk from
+        iterable chunks as soon as it is available, using chunked transfer
+        encoding.
+
+        HTTP/1.0 clients do not support chunked transfer encoding, so the
+        chunks are sent as is, and the connection is closed to mark the end
+        of the body.
+        """
+        if self._started:
+            raise AssertionError("Response already sent")
+
+        self.status_code = OK
+        del self.headers["content-length"]
+        self.headers["content-type"] = content_type
+
+        if self._con.request_version == "HTTP/1.0":
+            self.close_connection()
+            self.write(b"")
+            for chunk in chunks:
+                if chunk:
+                    self.write(chunk)
+            return
+
+        self.headers["transfer-encoding"] = "chunked"
+        self.write(b"")
+        for chunk in chunks:
+            # Empty chunk would end the body.
+            if chunk:
+                self.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.write(b"0\r\n\r\n")
+
+    def send_fd(self, fd, obj):
+        """
+        Send a JSON response, passing file descriptor fd to the client with
+        the response using SCM_RIGHTS. Supported only on unix socket
+        connections.
+
+        The response is sent using a single sendmsg() call, so the client
+        receives the file descriptor with the first part of the response.
+        """
+        if self._started:
+            raise AssertionError("Response already sent")
+
+        self.status_code = OK
+        body = json.dumps(obj).encode("utf-8") + b"\n"
+        self.headers["content-length"] = len(body)
+        self.headers["content-type"] = "application/json"
+        self._started = True
+
+        b = io.BytesIO()
+        self._write_header(b)
+        b.write(body)
+        data = b.getvalue()
+
+        sock = self._con.connection
+        fds = array.array("i", [fd])
+        sent = sock.sendmsg(
+            [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        if sent < len(data):
+            self._con.wfile.write(data[sent:])
+
+        # This avoids name lookup on the next calls to write.
+        self.write = self._con.wfile.write
+
+    @property
+    def zero_copy(self):
+        """
+        Return True if sendfile() can send data without copying it to user
+        space. Data sent on TLS connections must be encrypted in user space,
+        unless encryption was offloaded to the kernel.
+        """
+        return (self._con.ktls or
+                not isinstance(self._con.connection, ssl.SSLSocket))
+
+    def sendfile(self, fd, offset, count):
+        """
+        Send up to count bytes from file descriptor fd starting at offset to
+        the response body using os.sendfile(), and return the number of bytes
+        sent. Should be used only if zero_copy is True.
+
+        Returns less than count bytes only if fd has less data.
+        """
+        if not self._started:
+            self.write(b"")
+
+        sock = self._con.connection
+        sent = 0
+
+        while sent < count:
+            try:
+                n = os.sendfile(sock.fileno(), fd, offset + sent, count - sent)
+            except BlockingIOError:
+                # The socket has a timeout, so it is non-blocking.
+                _wait_for(sock, select.POLLOUT)
+                continue
+
+            if n == 0:
+                break
+            sent += n
+
+        return sent
+
     def close_connection(self):
         """
         Mark the connection for closing when the request completes.
@@ -565,33 +1105,18 @@ class Response:
 
     def _write_header(self, b):
         """
-        Write HTTP header to buffer b, avoiding one syscall per line in python
-        2.7.
+        Write HTTP header to buffer b, avoiding one syscall per line.
         """
-        if self.status_code in self._con.responses:
-            msg = self._con.responses[self.status_code][0].encode("latin1")
-        else:
-            msg = b""
-
-        # Write response line.
-        b.write(b"%s %d %s\r\n" % (
-                self._con.protocol_version.encode("latin1"),
-                self.status_code,
-                msg))
-
-        # Write default headers.
-        b.write(b"server: %s\r\n" %
-                self._con.version_string().encode("latin1"))
-        b.write(b"date: %s\r\n" %
-                self._con.date_time_string().encode("latin1"))
-
-        # Write user headers.
-        for name, value in self.headers.items():
-            # Encoding entire line to allow using integer value, for example
-            # content-length.
-            # Note: content-disposition may contain unicode values, so we must
-            # encode headers using utf-8.
-            b.write(("%s: %s\r\n" % (name, value)).encode("utf-8"))
+        # Write response line and default headers.
+        b.write(_status_line(self._con, self.status_code))
+        b.write(b"date: %s\r\n" % _http_date())
+
+        # Write user headers. Encoding entire lines to allow using integer
+        # values, for example content-length.
+        # Note: content-disposition may contain unicode values, so we must
+        # encode headers using utf-8.
+        b.write("".join("%s: %s\r\n" % item
+                        for item in self.headers.items()).encode("utf-8"))
 
         # End header.
         b.write(b"\r\n")
@@ -845,6 +1370,63 @@ class Router:
 
 # Helpers
 
+def _status_line(con, status_code):
+    """
+    Return response status line and server header for status code.
+    """
+    line = _status_lines.get(status_code)
+    if line is None:
+        if status_code in con.responses:
+            msg = con.responses[status_code][0]
+        else:
+            msg = ""
+        line = "{} {} {}\r\nserver: {}\r\n".format(
+            con.protocol_version, status_code, msg, _SERVER)
+        line = _status_lines[status_code] = line.encode("latin1")
+    return line
+
+
+def _http_date():
+    """
+    Return Date header value for current time. The value is formatted once
+    per second.
+    """
+    global _date
+    now = int(time.time())
+    cached = _date
+    if cached[0] != now:
+        value = email.utils.formatdate(now, usegmt=True).encode("ascii")
+        cached = _date = (now, value)
+    return cached[1]
+
+
+def _wait_for(sock, event):
+    """
+    Wait until non-blocking socket is ready for event, raising socket.timeout
+    if the socket timeout expired.
+    """
+    poller = select.poll()
+    poller.register(sock, event)
+    timeout = sock.gettimeout()
+    if timeout is not None:
+        timeout *= 1000
+    if not poller.poll(timeout):
+        raise socket.timeout("timed out")
+
+
+def _uses_ktls(sock):
+    """
+    Return True if OpenSSL installed the transmit keys in the kernel after the
+    handshake, so data written to the socket is encrypted by the kernel.
+    """
+    try:
+        # Returns the crypto info if kernel TLS is used for sending.
+        sock.getsockopt(_SOL_TLS, _TLS_TX, 64)
+    except OSError:
+        return False
+    return True
+
+
 def find_addresses(host, port=0):
     # In the past we use "" as a special address to bind to all interfaces.
     # Using "" with socket.getaddrinfo() would result into socket.gaierror. To
@@ -0,0 +1,132 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+jobs - long running operations started by the control service.
+"""
+
+import logging
+
+from . import backends
+from . import errors
+from . import ops
+from . import util
+
+log = logging.getLogger("jobs")
+
+# Job status.
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELED = "canceled"
+
+
+class CopyJob:
+    """
+    Copy image data from source ticket to destination ticket in a background
+    thread, without transferring the data through a client.
+
+    The copy is bound to both tickets, so removing either ticket cancels the
+    copy. The job is started using the destination ticket, reporting the
+    progress in the destination ticket info.
+    """
+
+    def __init__(self, src, dst, config, zero=True, hole=True):
+        self._src = src
+        self._dst = dst
+        self._config = config
+        self._zero = zero
+        self._hole = hole
+        self._status = RUNNING
+        self._error = None
+        self._op = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._status == RUNNING
+
+    def start(self):
+        self._thread = util.start_thread(
+            self._run, name="copy/" + self._dst.uuid[:8])
+
+    def wait(self, timeout=None):
+        """
+        Wait until the job completes. Return True if the job completed.
+        """
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def info(self):
+        op = self._op
+        info = {
+            "type": "copy",
+            "src": self._src.uuid,
+            "status": self._status,
+            "size": self._src.size,
+            "done": op.done if op else 0,
+        }
+        if self._error:
+            info["error"] = self._error
+        return info
+
+    def _run(self):
+        log.info("Copying transfer %s to transfer %s",
+                 self._src.transfer_id, self._dst.transfer_id)
+        try:
+            self._copy()
+        except errors.AuthorizationError as e:
+            log.info("Copy to transfer %s canceled: %s",
+                     self._dst.transfer_id, e)
+            self._error = str(e)
+            self._status = CANCELED
+        except Exception as e:
+            log.exception("Copy to transfer %s failed", self._dst.transfer_id)
+            self._error = str(e)
+            self._status = FAILED
+        else:
+            log.info("Copy to transfer %s completed", self._dst.transfer_id)
+            self._status = DONE
+
+    def _copy(self):
+        src_ctx = backends.open(self._src, self._config, mode="r")
+        try:
+            dst_ctx = backends.open(self._dst, self._config, mode="r+")
+            try:
+                self._op = ops.Copy(
+                    src_ctx.backend,
+                    dst_ctx.backend,
+                    self._src.size,
+                    max_workers=self._config.daemon.copy_workers,
+                    buffer_size=dst_ctx.buffer_size,
+                    zero=self._zero,
+                    hole=self._hole)
+                self._src.run(_Bound(self._dst, self._op))
+            finally:
+                dst_ctx.close()
+        finally:
+            src_ctx.close()
+
+
+class _Bound:
+    """
+    Operation running another operation bound to another ticket.
+    """
+
+    def __init__(self, ticket, op):
+        self._ticket = ticket
+        self._op = op
+
+    @property
+    def offset(self):
+        return self._op.offset
+
+    @property
+    def done(self):
+        return self._op.done
+
+    def run(self):
+        return self._ticket.run(self._op)
+
+    def cancel(self):
+        self._op.cancel()
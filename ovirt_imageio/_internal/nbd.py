@@ -12,6 +12,9 @@ import os
 import re
 import socket
 import struct
+import sys
+
+from array import array
 
 from . import ipv6
 from . import sockutil
@@ -183,6 +186,12 @@ MAX_LENGTH = 2**32 - 1
 # fail the connection.
 MAX_EXTENTS = MAX_LENGTH // 4096
 
+# Maximum number of commands in flight when using the pipelined interface.
+# qemu-nbd processes up to 16 requests concurrently per client (see
+# MAX_NBD_REQUESTS in qemu nbd/server.c); sending more commands only queue
+# them in the socket buffers.
+MAX_INFLIGHT = 16
+
 log = logging.getLogger("nbd")
 
 
@@ -224,7 +233,7 @@ class InvalidLength(ProtocolError):
 
 
 class UnexpectedHandle(ProtocolError):
-    fmt = "Unepected handle {self.handle}, expecting {self.expected}"
+    fmt = "Unepected handle {self.handle}, expecting one of {self.expected}"
 
     def __init__(self, handle, expected):
         self.handle = handle
@@ -310,12 +319,12 @@ class TCPAddress(sockutil.TCPAddress):
         return s
 
 
-def open(url, dirty=False):
+def open(url, dirty=False, max_inflight=MAX_INFLIGHT):
     """
     Open parsed NBD URL and return a connected Client instance.
     """
     address, name = _parse_url(url)
-    return Client(address, name, dirty=dirty)
+    return Client(address, name, dirty=dirty, max_inflight=max_inflight)
 
 
 def _parse_url(url):
@@ -368,11 +377,39 @@ CLOSED = 3
 
 
 class Client:
+    """
+    NBD client.
+
+    The client provides 2 interfaces:
+
+    - Synchronous interface (readinto(), write(), zero(), flush(),
+      extents()), sending a command and waiting until the command completes.
+
+    - Pipelined interface (aio_readinto(), aio_write(), aio_zero(),
+      aio_flush(), aio_extents()), sending a command and returning the
+      command object without waiting for the reply. Up to max_inflight
+      commands can be in flight; submitting more commands waits until some
+      command completes. Replies are matched to commands by handle, so the
+      server may complete commands in any order.
+
+    Use wait() to wait for a command and get its result, or poll() to
+    receive the next reply. A command may have a callback, called with the
+    completed command when the reply is received.
+
+    The client is not thread safe. Mixing both interfaces is allowed;
+    synchronous calls complete other in-flight commands while waiting for
+    their reply.
+    """
+
+    def __init__(self, address, export_name=None, dirty=False,
+                 max_inflight=MAX_INFLIGHT):
+        if max_inflight < 1:
+            raise ValueError("Invalid max_inflight {}".format(max_inflight))
 
-    def __init__(self, address, export_name=None, dirty=False):
         self.address = address
         self.export_name = export_name or ""
         self.dirty = dirty
+        self.max_inflight = max_inflight
 
         log.debug("Connecting address=%r export_name=%r dirty=%r",
                   address, self.export_name, dirty)
@@ -402,6 +439,10 @@ class Client:
         self._counter = itertools.count()
         self._state = CONNECTING
 
+        # Mapping of handle to command sent to the server and waiting for a
+        # reply.
+        self._inflight = {}
+
         self._sock = self._connect(address)
         try:
             self._newstyle_handshake(dirty)
@@ -419,52 +460,130 @@ class Client:
     def has_allocation_depth(self):
         return QEMU_ALLOCATION_DEPTH in self._meta_context
 
+    @property
+    def inflight(self):
+        """
+        Return the number of commands waiting for a reply.
+        """
+        return len(self._inflight)
+
     def read(self, offset, length):
         buf = bytearray(length)
         self.readinto(offset, buf)
         return buf
 
     def readinto(self, offset, buf):
+        return self.wait(self.aio_readinto(offset, buf))
+
+    def write(self, offset, data):
+        self.wait(self.aio_write(offset, data))
+
+    def zero(self, offset, length, punch_hole=True):
+        self.wait(self.aio_zero(offset, length, punch_hole=punch_hole))
+
+    def flush(self):
+        # TODO: is this the best way to handle this?
+        if self.transmission_flags & FLAG_SEND_FLUSH == 0:
+            return
+        self.wait(self.aio_flush())
+
+    def extents(self, offset, length):
+        return self.wait(self.aio_extents(offset, length))
+
+    # Pipelined interface.
+
+    def aio_readinto(self, offset, buf, callback=None):
+        """
+        Send NBD_CMD_READ, reading into buf, and return the command without
+        waiting for the reply. buf must not be accessed until the command
+        completes.
+        """
         # If structured reply was negotiated, the server must send structured
         # reply to NBD_CMD_READ.
         cmd = Read(
             self._next_handle(), offset, buf,
             only_structured=self._structured_reply)
-        self._send_command(cmd)
-        self._recv_reply(cmd)
-        return len(buf)
+        self._submit(cmd, callback=callback)
+        return cmd
 
-    def write(self, offset, data):
+    def aio_write(self, offset, data, callback=None):
+        """
+        Send NBD_CMD_WRITE with data, and return the command without waiting
+        for the reply. The data was sent when this returns and can be reused.
+        """
         cmd = Write(self._next_handle(), offset, len(data))
-        self._send_command(cmd)
-        self._send(data)
-        self._recv_reply(cmd)
+        self._submit(cmd, payload=data, callback=callback)
+        return cmd
 
-    def zero(self, offset, length, punch_hole=True):
+    def aio_zero(self, offset, length, punch_hole=True, callback=None):
         if self.transmission_flags & FLAG_SEND_WRITE_ZEROES == 0:
             raise UnsupportedRequest(
                 "Server does not support CMD_WRITE_ZEROES")
         flags = 0 if punch_hole else CMD_FLAG_NO_HOLE
         cmd = WriteZeroes(self._next_handle(), offset, length, flags=flags)
-        self._send_command(cmd)
-        self._recv_reply(cmd)
+        self._submit(cmd, callback=callback)
+        return cmd
 
-    def flush(self):
-        # TODO: is this the best way to handle this?
+    def aio_flush(self, callback=None):
         if self.transmission_flags & FLAG_SEND_FLUSH == 0:
-            return
+            raise UnsupportedRequest("Server does not support CMD_FLUSH")
         cmd = Flush(self._next_handle())
-        self._send_command(cmd)
-        self._recv_reply(cmd)
+        self._submit(cmd, callback=callback)
+        return cmd
 
-    def extents(self, offset, length):
+    def aio_extents(self, offset, length, callback=None):
         cmd = BlockStatus(self._next_handle(), offset, length)
-        self._send_command(cmd)
-        self._recv_reply(cmd)
-        return cmd.reply
+        self._submit(cmd, callback=callback)
+        return cmd
+
+    def wait(self, cmd=None):
+        """
+        Wait until cmd completes and return its result, raising the command
+        error if the command failed. If cmd is None, wait until all in-flight
+        commands complete, raising the first command error.
+        """
+        if cmd is None:
+            error = None
+            while self._inflight:
+                done = self.poll()
+                if done.error and error is None:
+                    error = done.error
+            if error:
+                raise error
+            return None
+
+        while not cmd.done:
+            self.poll()
+
+        if cmd.error:
+            raise cmd.error
+
+        return cmd.result()
+
+    def poll(self):
+        """
+        Receive replies until the next in-flight command completes, and
+        return the completed command. The command callback, if any, was
+        called when this returns.
+        """
+        if not self._inflight:
+            raise RuntimeError("No command in flight")
+
+        while True:
+            cmd = self._recv_reply()
+            if cmd:
+                return cmd
 
     def close(self):
-        if self._state in (HANDSHAKE, TRANSMISSION):
+        if self._inflight:
+            # The spec does not allow sending NBD_CMD_DISC before all
+            # replies are received, and we cannot wait for them since the
+            # connection may be broken.
+            log.debug("Closing with %d commands in flight",
+                      len(self._inflight))
+            self._inflight.clear()
+            self._hard_disconnect()
+        elif self._state in (HANDSHAKE, TRANSMISSION):
             self._soft_disconnect()
         else:
             self._hard_disconnect()
@@ -943,52 +1062,65 @@ class Client:
     def _next_handle(self):
         return next(self._counter)
 
+    def _submit(self, cmd, payload=None, callback=None):
+        """
+        Send a command, waiting until the number of in-flight commands drops
+        below max_inflight.
+        """
+        while len(self._inflight) >= self.max_inflight:
+            self.poll()
+
+        cmd.callback = callback
+        self._inflight[cmd.handle] = cmd
+        self._send_command(cmd)
+        if payload is not None:
+            self._send(payload)
+
     def _send_command(self, cmd):
         log.debug("Sending %s", cmd)
         self._send(cmd.to_bytes())
 
-    def _recv_reply(self, cmd):
+    def _complete(self, cmd, error=None):
         """
-        Receive either a simple reply or structured reply for cmd.
+        Mark cmd as completed and run its callback.
         """
-        while True:
-            magic = self._recv_fmt("!I")[0]
+        del self._inflight[cmd.handle]
+        cmd.done = True
+        cmd.error = error
+        if cmd.callback:
+            cmd.callback(cmd)
 
-            if magic == SIMPLE_REPLY_MAGIC:
-                if cmd.only_structured:
-                    raise ProtocolError(
-                        "Unexpected simple reply magic {:x}, expecting "
-                        "structured reply magic {:x}"
-                        .format(magic, STRUCTURED_REPLY_MAGIC))
-
-                self._recv_simple_reply(cmd)
-                return
+    def _inflight_command(self, handle):
+        try:
+            return self._inflight[handle]
+        except KeyError:
+            raise UnexpectedHandle(handle, sorted(self._inflight)) from None
 
-            elif magic == STRUCTURED_REPLY_MAGIC:
-                if not self._structured_reply:
-                    raise ProtocolError(
-                        "Unexpected structured reply magic {:x}, expecting "
-                        "simple reply magic {:x}"
-                        .format(magic, SIMPLE_REPLY_MAGIC))
+    def _recv_reply(self):
+        """
+        Receive either a simple reply or structured reply chunk for one of the
+        in-flight commands. Return the command if this reply completed it,
+        None otherwise.
+        """
+        magic = self._recv_fmt("!I")[0]
 
-                # We started to received structured reply chunks, so simple
-                # reply is not allowed.
-                cmd.only_structured = True
+        if magic == SIMPLE_REPLY_MAGIC:
+            return self._recv_simple_reply()
 
-                if self._recv_reply_chunk(cmd):
-                    break
+        elif magic == STRUCTURED_REPLY_MAGIC:
+            if not self._structured_reply:
+                raise ProtocolError(
+                    "Unexpected structured reply magic {:x}, expecting "
+                    "simple reply magic {:x}"
+                    .format(magic, SIMPLE_REPLY_MAGIC))
 
-            else:
-                raise ProtocolError("Unexpected reply magic {:x}"
-                                    .format(magic))
+            return self._recv_reply_chunk()
 
-        if cmd.errors:
-            # Some chunks failed. We don't have a good way to report
-            # partial failures since content chunks may be fragmented, so
-            # fail the entire request.
-            raise RequestError("Errors receiving reply: {}".format(cmd.errors))
+        else:
+            raise ProtocolError("Unexpected reply magic {:x}"
+                                .format(magic))
 
-    def _recv_simple_reply(self, cmd):
+    def _recv_simple_reply(self):
         """
         Receive a simple reply (magic was already read).
 
@@ -998,21 +1130,29 @@ class Client:
            error is zero)
         """
         error, handle = self._recv_fmt("!IQ")
+        cmd = self._inflight_command(handle)
+
+        if cmd.only_structured:
+            raise ProtocolError(
+                "Unexpected simple reply magic {:x}, expecting "
+                "structured reply magic {:x}"
+                .format(SIMPLE_REPLY_MAGIC, STRUCTURED_REPLY_MAGIC))
 
         if error != 0:
             # We have no context in this case.
-            raise ReplyError(error, "Simple reply failed")
-
-        if handle != cmd.handle:
-            raise UnexpectedHandle(handle, cmd.handle)
+            self._complete(cmd, ReplyError(error, "Simple reply failed"))
+            return cmd
 
         if cmd.buf:
             self._recv_into(cmd.buf)
 
-    def _recv_reply_chunk(self, cmd):
+        self._complete(cmd)
+        return cmd
+
+    def _recv_reply_chunk(self):
         """
-        Receive a structured reply chunk (magic was already read). Return True
-        if this was the last chunk.
+        Receive a structured reply chunk (magic was already read). Return the
+        command if this was the last chunk, None otherwise.
 
         S: 16 bits, flags
         S: 16 bits, type
@@ -1021,14 +1161,15 @@ class Client:
         S: length bytes of payload data (if length is nonzero)
         """
         flags, type, handle, length = self._recv_fmt("!HHQI")
+        cmd = self._inflight_command(handle)
 
-        if handle != cmd.handle:
-            raise UnexpectedHandle(handle, cmd.handle)
+        # We started to received structured reply chunks, so simple reply is
+        # not allowed.
+        cmd.only_structured = True
 
         if type == REPLY_TYPE_ERROR:
-            self._handle_error_chunk(length, flags)
-
-        if type == REPLY_TYPE_ERROR_OFFSET:
+            self._handle_error_chunk(length, cmd)
+        elif type == REPLY_TYPE_ERROR_OFFSET:
             self._handle_error_offset_chunk(length, cmd)
         elif type == REPLY_TYPE_NONE:
             self._handle_none_chunk(flags, length)
@@ -1043,7 +1184,22 @@ class Client:
                 "Received unknown chunk type={} flags={} length={}"
                 .format(type, flags, length))
 
-        return flags & REPLY_FLAG_DONE
+        if not flags & REPLY_FLAG_DONE:
+            return None
+
+        if cmd.reply_error:
+            self._complete(cmd, cmd.reply_error)
+        elif cmd.errors:
+            # Some chunks failed. We don't have a good way to report
+            # partial failures since content chunks may be fragmented, so
+            # fail the entire request.
+            self._complete(
+                cmd, RequestError(
+                    "Errors receiving reply: {}".format(cmd.errors)))
+        else:
+            self._complete(cmd)
+
+        return cmd
 
     def _handle_block_status_chunk(self, length, cmd):
         """
@@ -1079,42 +1235,22 @@ class Client:
         else:
             context = Extent.ALLOC
 
-        extents = []
-        for ext in self._recv_extents(length - ctx_id_size, context):
-            if ext.length % self.minimum_block_size:
-                raise ProtocolError(
-                    "Invalid extent length {}: not an integer multiple "
-                    "of minimum block size {}"
-                    .format(ext.length, self.minimum_block_size))
-            extents.append(ext)
+        # Receive and unpack all extent descriptors at once. The payload size
+        # is limited by MAX_EXTENTS.
+        data = self._recv(length - ctx_id_size)
+        extents = ExtentList.unpack(data, context)
 
-        cmd.reply[ctx_name] = extents
-
-    def _recv_extents(self, length, context):
-        """
-        Iterator receiving and unpacking extents descriptors form block status
-        payload.
-
-        Yield Extent object for every extent descriptor.
-        """
-        # We don't expect many extents in 4 GiB, so 1024 extents per call
-        # should be more than enough.
-        buf = bytearray(min(length, Extent.size * 1024))
-
-        while length:
-            # Shrink buffer for the last receive.
-            if length < len(buf):
-                buf = memoryview(buf)[:length]
-
-            # Receive next buffer.
-            self._recv_into(buf)
-            length -= len(buf)
+        # qemu-nbd always reports minimum_block_size=1, so we check only if
+        # the server reports a larger value.
+        if self.minimum_block_size > 1:
+            for n in extents.lengths:
+                if n % self.minimum_block_size:
+                    raise ProtocolError(
+                        "Invalid extent length {}: not an integer multiple "
+                        "of minimum block size {}"
+                        .format(n, self.minimum_block_size))
 
-            # Unpack extents in buffer.
-            view = memoryview(buf)
-            while len(view):
-                yield Extent.unpack(view[:Extent.size], context)
-                view = view[Extent.size:]
+        cmd.reply[ctx_name] = extents
 
     def _handle_none_chunk(self, flags, length):
         if not flags & REPLY_FLAG_DONE:
@@ -1124,12 +1260,11 @@ class Client:
         if length != 0:
             raise InvalidLength(REPLY_TYPE_NONE, length, 0)
 
-    def _handle_error_chunk(self, length, flags):
+    def _handle_error_chunk(self, length, cmd):
         """
-        Handle general error (entire request failed).
-
-        If this the last chunk raise ReplyError, failing this request.
-        Otherwise raise ProtocolError failing entire connection.
+        Handle general error (entire request failed). This may not be the last
+        chunk, so we keep the error and fail the request when receiving the
+        last chunk.
 
         32 bits: error (MUST be nonzero)
         16 bits: message length (no more than header length - 6)
@@ -1137,13 +1272,8 @@ class Client:
             human being
         """
         code, message = self._recv_error_chunk(length)
-
-        if flags & REPLY_FLAG_DONE:
-            raise ReplyError(code, message)
-        else:
-            raise ProtocolError(
-                "Unrecoverable error chunk code={} message={!r}"
-                .format(code, message))
+        if cmd.reply_error is None:
+            cmd.reply_error = ReplyError(code, message)
 
     def _handle_error_offset_chunk(self, length, cmd):
         """
@@ -1285,6 +1415,23 @@ class Command:
         # NBD_REPLY_TYPE_ERROR_OFFSET chunks received when handling structued
         # reply. Can happen only in Read, Write, and BlockStatus.
         self.errors = []
+        # NBD_REPLY_TYPE_ERROR chunk received when handling structured reply.
+        # The entire request failed, but the server may send more chunks
+        # before the last chunk.
+        self.reply_error = None
+        # Set when the reply was received. If the command failed, error is
+        # the exception that will be raised when waiting for the command.
+        self.done = False
+        self.error = None
+        # Called with the command when the reply was received.
+        self.callback = None
+
+    def result(self):
+        """
+        Return the command result. Valid only after the command completed
+        successfully.
+        """
+        return None
 
     def to_bytes(self):
         return self.wire_format.pack(
@@ -1310,6 +1457,9 @@ class Read(Command):
         self.buf = buf
         self.only_structured = only_structured
 
+    def result(self):
+        return self.length
+
 
 class Write(Command):
     type = 1
@@ -1347,6 +1497,9 @@ class BlockStatus(Command):
         # Mapping of meta context name to list of Extent objects.
         self.reply = {}
 
+    def result(self):
+        return self.reply
+
 
 class Extent:
     """
@@ -1456,3 +1609,167 @@ class Extent:
 
     def __repr__(self):
         return "Extent(length={}, flags={})".format(self.length, self._flags)
+
+
+class ExtentList:
+    """
+    A compact list of extents, keeping extents lengths and flags in arrays.
+
+    Block status reply for a fragmented image may include thousands of
+    extents. Creating an Extent object for every extent descriptor, and more
+    objects when merging extents from different meta contexts is slow, so we
+    keep the extents in arrays and create Extent objects only when iterating
+    over the list.
+    """
+
+    __slots__ = ("lengths", "flags")
+
+    def __init__(self, lengths=(), flags=()):
+        self.lengths = array("Q", lengths)
+        self.flags = array("I", flags)
+
+    @classmethod
+    def create(cls, extents):
+        """
+        Create extent list from iterable of Extent objects. If extents is
+        already an ExtentList, return it.
+        """
+        if isinstance(extents, cls):
+            return extents
+        self = cls()
+        for ext in extents:
+            self.append(ext.length, ext.flags)
+        return self
+
+    @classmethod
+    def unpack(cls, data, context=Extent.ALLOC):
+        """
+        Create extent list from extent descriptors data.
+
+        Based on context, we map NBD flags bits to private bits to allow
+        merging different types of extents. See Extent.unpack().
+        """
+        if len(data) % Extent.size:
+            raise ProtocolError(
+                "Invalid extents data length {}".format(len(data)))
+
+        # Decode all descriptors at once as pairs of 32 bits integers.
+        words = array("I")
+        words.frombytes(data)
+        if sys.byteorder == "little":
+            words.byteswap()
+
+        self = cls(words[0::2])
+        flags = words[1::2]
+
+        if 0 in self.lengths:
+            raise ProtocolError(
+                "Invalid extent length=0 flags={}"
+                .format(flags[self.lengths.index(0)]))
+
+        if context == Extent.ALLOC:
+            # The remainder of the flags field is reserved. Servers SHOULD set
+            # it to all-zero; clients MUST ignore unknown flags.
+            mask = STATE_HOLE | STATE_ZERO
+            self.flags = array("I", [f & mask for f in flags])
+        elif context == Extent.DIRTY:
+            self.flags = array(
+                "I", [EXTENT_DIRTY if f & STATE_DIRTY else 0 for f in flags])
+        elif context == Extent.DEPTH:
+            self.flags = array(
+                "I", [EXTENT_BACKING if f == 0 else 0 for f in flags])
+        else:
+            self.flags = flags
+
+        return self
+
+    def append(self, length, flags):
+        self.lengths.append(length)
+        self.flags.append(flags)
+
+    def items(self):
+        """
+        Iterate over (length, flags) tuples, without creating Extent objects.
+        """
+        return zip(self.lengths, self.flags)
+
+    def merged(self, other):
+        """
+        Merge with other extent list with distinct flags bits, returning new
+        extent list with flags from both lists. Merging ends when the shorter
+        list ends.
+        """
+        res = ExtentList()
+        res_lengths = res.lengths
+        res_flags = res.flags
+
+        iter_a = self.items()
+        iter_b = other.items()
+        a_length = b_length = 0
+        a_flags = b_flags = 0
+
+        while True:
+            if a_length == 0:
+                a_length, a_flags = next(iter_a, (0, 0))
+                if a_length == 0:
+                    break
+            if b_length == 0:
+                b_length, b_flags = next(iter_b, (0, 0))
+                if b_length == 0:
+                    break
+
+            # Add the overlapping area and keep the rest.
+            n = a_length if a_length < b_length else b_length
+            res_lengths.append(n)
+            res_flags.append(a_flags | b_flags)
+            a_length -= n
+            b_length -= n
+
+        return res
+
+    def coalesced(self):
+        """
+        Return new extent list, merging consecutive extents with same flags.
+        """
+        res = ExtentList()
+        res_lengths = res.lengths
+        res_flags = res.flags
+
+        cur_length = 0
+        cur_flags = None
+
+        for length, flags in self.items():
+            if flags == cur_flags:
+                cur_length += length
+            else:
+                if cur_flags is not None:
+                    res_lengths.append(cur_length)
+                    res_flags.append(cur_flags)
+                cur_length = length
+                cur_flags = flags
+
+        if cur_flags is not None:
+            res_lengths.append(cur_length)
+            res_flags.append(cur_flags)
+
+        return res
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return Extent(self.lengths[i], self.flags[i])
+
+    def __iter__(self):
+        for length, flags in self.items():
+            yield Extent(length, flags)
+
+    def __eq__(self, other):
+        try:
+            other = ExtentList.create(other)
+        except (TypeError, AttributeError):
+            return NotImplemented
+        return self.lengths == other.lengths and self.flags == other.flags
+
+    def __repr__(self):
+        return "ExtentList({})".format(list(self))
@@ -83,7 +83,7 @@ import logging
 import queue
 import sys
 
-from collections import namedtuple
+from collections import deque, namedtuple
 
 from . import nbd
 from . import util
@@ -97,17 +97,24 @@ MAX_ZERO = GiB
 log = logging.getLogger("nbdutil")
 
 
-def extents(client, offset=0, length=None, dirty=False):
+def extents(client, offset=0, length=None, dirty=False, queue_depth=4):
     """
     Iterate over all extents for requested range.
 
     Requested range must not excceed image size, but is not limited by NBD
     maximum length, since we send multiple block status commands to the server.
 
+    Up to queue_depth block status commands are sent to the server before
+    waiting for the first reply, so the server can look up the next ranges
+    while we process the previous replies. Replies are processed in order.
+
     Consecutive extents of same type are merged automatically.
 
     Return iterator of nbd.Extent objects.
     """
+    if queue_depth < 1:
+        raise ValueError("Invalid queue_depth {}".format(queue_depth))
+
     if length is None:
         end = client.export_size
     else:
@@ -117,49 +124,92 @@ def extents(client, offset=0, length=None, dirty=False):
     # number of extents kept in memory when accessing very fragmented images.
     max_step = 2 * GiB
 
+    # Commands sent to the server, as (step_end, cmd) tuples, ordered by
+    # offset.
+    pending = deque()
+    next_offset = offset
+
     # Keep the current extent, until we find a new extent with different flags.
-    cur = None
-
-    while offset < end:
-        # Get the next extent reply since the last returned extent. This
-        # handles the cases of single extent, short reply, and last extent
-        # exceeding requested range.
-        step = min(end - offset, max_step)
-        res = client.extents(offset, step)
-
-        if dirty:
-            extents = merged(
-                res[nbd.BASE_ALLOCATION], res[client.dirty_bitmap])
-        elif nbd.QEMU_ALLOCATION_DEPTH in res:
-            extents = merged(
-                res[nbd.BASE_ALLOCATION], res[nbd.QEMU_ALLOCATION_DEPTH])
-        else:
-            extents = res[nbd.BASE_ALLOCATION]
+    # Extents are processed as (length, flags) tuples, and nbd.Extent objects
+    # are created only for the merged extents.
+    cur_length = 0
+    cur_flags = None
 
-        for ext in extents:
-            # Handle the case of last extent of the last block status command
-            # exceeding requested range.
-            if offset + ext.length > end:
-                ext.length = end - offset
+    try:
+        while offset < end:
+            while len(pending) < queue_depth and next_offset < end:
+                step = min(end - next_offset, max_step)
+                cmd = client.aio_extents(next_offset, step)
+                next_offset += step
+                pending.append((next_offset, cmd))
+
+            step_end, cmd = pending[0]
+            res = client.wait(cmd)
+
+            extents = nbd.ExtentList.create(res[nbd.BASE_ALLOCATION])
+            if dirty:
+                extents = extents.merged(
+                    nbd.ExtentList.create(res[client.dirty_bitmap]))
+            elif nbd.QEMU_ALLOCATION_DEPTH in res:
+                extents = extents.merged(
+                    nbd.ExtentList.create(res[nbd.QEMU_ALLOCATION_DEPTH]))
+
+            for length, flags in extents.coalesced().items():
+                # Handle the case of last extent exceeding requested range.
+                if offset + length > step_end:
+                    length = step_end - offset
+
+                offset += length
+
+                # Handle the case of consecutive extents with same flags.
+                if flags == cur_flags:
+                    cur_length += length
+                else:
+                    if cur_flags is not None:
+                        yield nbd.Extent(cur_length, cur_flags)
+                    cur_length = length
+                    cur_flags = flags
+
+                # The spec does not allow the server to send more extent.
+                # Ensure that we don't report wrong data if the server does
+                # not comply.
+                if offset == step_end:
+                    break
+
+            if offset < step_end:
+                # Handle the cases of single extent and short reply by getting
+                # the rest of the range since the last returned extent.
+                cmd = client.aio_extents(offset, step_end - offset)
+                pending[0] = (step_end, cmd)
+            else:
+                pending.popleft()
+    finally:
+        # The caller stopped iterating or we failed. Do not leave replies in
+        # flight, since closing the client with in-flight commands breaks the
+        # connection.
+        _drain(client, pending)
 
-            offset += ext.length
+    if cur_flags is not None:
+        yield nbd.Extent(cur_length, cur_flags)
 
-            # Handle the case of consecutive extents with same flags.
-            if cur is None:
-                cur = ext
-            elif cur.flags == ext.flags:
-                cur.length += ext.length
-            else:
-                yield cur
-                cur = ext
 
-            # The spec does not allow the server to send more extent. Ensure
-            # that we don't report wrong data if the server does not comply.
-            if offset == end:
+def _drain(client, pending):
+    """
+    Wait for pending block status commands, ignoring their replies. Errors
+    are logged, so they do not hide the error that stopped the iteration.
+    """
+    for _, cmd in pending:
+        if cmd.done:
+            continue
+        try:
+            client.wait(cmd)
+        except Exception as e:
+            log.warning("Error waiting for pending extents command: %s", e)
+            if not cmd.done:
+                # Receiving replies failed, so waiting for the next commands
+                # would fail too.
                 break
 
-    yield cur
-
 
 def merged(extents_a, extents_b):
     """
@@ -169,36 +219,10 @@ def merged(extents_a, extents_b):
 
     Yields nbd.Extent() including all bits from both extents.
     """
-    iter_a = iter(extents_a)
-    iter_b = iter(extents_b)
-
-    a = None
-    b = None
-
-    while True:
-        try:
-            if a is None:
-                a = next(iter_a)
-            if b is None:
-                b = next(iter_b)
-        except StopIteration:
-            return
-
-        if a.length == b.length:
-            # The easy case, merge and clear both.
-            yield nbd.Extent(a.length, a.flags | b.flags)
-            a = None
-            b = None
-        elif a.length > b.length:
-            # Yield the overlapping area and keep rest of a.
-            yield nbd.Extent(b.length, a.flags | b.flags)
-            a = nbd.Extent(a.length - b.length, a.flags)
-            b = None
-        else:  # a.length < b.length
-            # Yield the overlapping area and keep rest of b.
-            yield nbd.Extent(a.length, a.flags | b.flags)
-            b = nbd.Extent(b.length - a.length, b.flags)
-            a = None
+    a = nbd.ExtentList.create(extents_a)
+    b = nbd.ExtentList.create(extents_b)
+    for ext in a.merged(b):
+        yield ext
 
 
 def copy(src_client, dst_client, block_size=4 * MiB, queue_depth=4,
@@ -2,11 +2,16 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import logging
+import queue
+import threading
 
+from . import bufpool
 from . import errors
+from . import io
+from . import ioutil
 from . import stats
 from . import util
-from .units import MiB
+from .units import KiB, MiB
 
 log = logging.getLogger("ops")
 
@@ -78,62 +83,202 @@ class Operation:
 class Read(Operation):
     """
     Read data source backend to file object.
+
+    If read_ahead is positive, read the next chunks from the source backend in
+    a helper thread while the current chunk is written to the destination,
+    using up to read_ahead additional buffers of the same size as buf.
+
+    If zero_copy is True, and the source backend and the destination support
+    sendfile(), send the data from the source to the destination without
+    copying it to buf.
     """
 
     name = "read"
 
-    def __init__(self, src, dst, buf, size, offset=0, clock=None):
+    def __init__(self, src, dst, buf, size, offset=0, read_ahead=0,
+                 zero_copy=False, clock=None):
         super().__init__(size=size, offset=offset, buf=buf, clock=clock)
         self._src = src
         self._dst = dst
+        self._read_ahead = read_ahead
+        self._zero_copy = (
+            zero_copy
+            and hasattr(src, "sendfile")
+            and getattr(dst, "zero_copy", False))
 
     def _run(self):
+        if self._zero_copy:
+            self._run_sendfile()
+            return
+
         skip = self._offset % self._src.block_size
         self._src.seek(self._offset - skip)
+
+        # Reading ahead is useful only if we need more than one chunk.
+        if self._read_ahead and skip + self._todo > len(self._buf):
+            self._run_read_ahead(skip)
+            return
+
         if skip:
             self._read_chunk(skip)
         while self._todo:
             self._read_chunk()
 
+    def _run_sendfile(self):
+        self._src.seek(self._offset)
+        while self._todo:
+            # Send one buffer size at a time to allow cancellation.
+            count = min(self._todo, len(self._buf))
+            with self._record("sendfile") as s:
+                sent = self._src.sendfile(self._dst, count)
+                s.bytes += sent
+            if sent == 0:
+                raise errors.PartialContent(self.size, self.done)
+            self._done += sent
+
+            if self._canceled:
+                raise Canceled
+
     def _read_chunk(self, skip=0):
+        size = self._read_into(self._buf, self._todo, skip, self.done)
+        self._write_chunk(self._buf, skip, size)
+
+        if self._canceled:
+            raise Canceled
+
+    def _run_read_ahead(self, skip):
+        free = queue.Queue()
+        ready = queue.Queue()
+
+        free.put(self._buf)
+        buffers = []
+        try:
+            for _ in range(self._read_ahead):
+                # Use less buffers if the buffer pool is exhausted, instead
+                # of waiting while holding our buffer.
+                try:
+                    buf = bufpool.acquire(len(self._buf), timeout=0)
+                except errors.BufferPoolTimeout:
+                    log.debug("Buffer pool exhausted, using %d buffers",
+                              len(buffers) + 1)
+                    break
+                buffers.append(buf)
+                free.put(buf)
+
+            reader = util.start_thread(
+                self._read_ahead_loop,
+                args=(skip, free, ready),
+                name="read-ahead")
+            try:
+                while self._todo:
+                    item = ready.get()
+                    if isinstance(item, Exception):
+                        raise item
+
+                    buf, skip, size = item
+                    self._write_chunk(buf, skip, size)
+                    free.put(buf)
+
+                    if self._canceled:
+                        raise Canceled
+            finally:
+                # Wake up the reader if it is waiting for a free buffer, and
+                # wait until it stops using the source backend.
+                free.put(None)
+                reader.join()
+        finally:
+            for buf in buffers:
+                bufpool.release(buf)
+
+    def _read_ahead_loop(self, skip, free, ready):
+        """
+        Read chunks from the source into free buffers, passing filled buffers
+        to the caller thread. Runs in the read ahead thread.
+        """
+        todo = self._todo
+        try:
+            while todo:
+                buf = free.get()
+                if buf is None:
+                    log.debug("Read ahead stopped")
+                    return
+
+                size = self._read_into(buf, todo, skip, self._size - todo)
+                ready.put((buf, skip, size))
+                todo -= size
+                skip = 0
+        except Exception as e:
+            ready.put(e)
+
+    def _read_into(self, buf, todo, skip, done):
+        """
+        Read the next chunk from the source into buf, and return the number of
+        bytes available in buf after skip.
+        """
         if self._src.tell() % self._src.block_size:
-            raise errors.PartialContent(self.size, self.done)
+            raise errors.PartialContent(self.size, done)
 
-        # If self._todo is not aligned to backend block_size we read complete
-        # block and drop up to block_size - 1 bytes.
-        aligned_todo = util.round_up(self._todo, self._src.block_size)
+        # If todo is not aligned to backend block_size we read complete block
+        # and drop up to block_size - 1 bytes.
+        aligned_todo = util.round_up(todo, self._src.block_size)
 
-        with memoryview(self._buf)[:aligned_todo] as view:
+        with memoryview(buf)[:aligned_todo] as view:
             with self._record("read") as s:
                 count = self._src.readinto(view)
                 s.bytes += count
             if count == 0:
-                raise errors.PartialContent(self.size, self.done)
+                raise errors.PartialContent(self.size, done)
 
-        size = min(count - skip, self._todo)
-        with memoryview(self._buf)[skip:skip + size] as view:
+        return min(count - skip, todo)
+
+    def _write_chunk(self, buf, skip, size):
+        with memoryview(buf)[skip:skip + size] as view:
             with self._record("write") as s:
                 self._dst.write(view)
                 s.bytes += size
         self._done += size
 
-        if self._canceled:
-            raise Canceled
-
 
 class Write(Operation):
     """
     Write data from file object to destination backend.
+
+    If write_behind is positive, write received chunks to the destination
+    backend in a helper thread while the next chunk is received from the
+    source, using up to write_behind additional buffers of the same size as
+    buf.
+
+    If detect_zeroes is True, zero areas in the destination instead of
+    writing received blocks of ZERO_BLOCK_SIZE bytes containing only zeroes.
+    If the destination is sparse, zeroing deallocates space.
+
+    If zero_copy is True, and the destination backend and the source support
+    splice(), receive the data from the source into the destination without
+    copying it to buf. Unaligned edges are still written using buf. Zero
+    detection requires the data in buf, so it disables zero copy.
     """
 
     name = "write"
 
+    # Granularity of zero detection, aligned to image offset. Using larger
+    # blocks minimizes the number of backend calls, but detects less zeroes.
+    ZERO_BLOCK_SIZE = 64 * KiB
+
     def __init__(self, dst, src, buf, size=None, offset=0, flush=True,
+                 write_behind=0, detect_zeroes=False, zero_copy=False,
                  clock=None):
         super().__init__(size=size, offset=offset, buf=buf, clock=clock)
         self._src = src
         self._dst = dst
         self._flush = flush
+        self._write_behind = write_behind
+        self._detect_zeroes = detect_zeroes
+        self._zero_copy = (
+            zero_copy
+            and not detect_zeroes
+            and size is not None
+            and hasattr(dst, "splice")
+            and getattr(src, "zero_copy", False))
 
     @property
     def _todo(self):
@@ -145,18 +290,15 @@ class Write(Operation):
         try:
             self._dst.seek(self._offset)
 
-            # If offset is not aligned to block size, receive partial chunk
-            # until the start of the next block.
-            unaligned = self._offset % self._dst.block_size
-            if unaligned:
-                count = min(self._todo, self._dst.block_size - unaligned)
-                self._write_chunk(count)
-
-            # Now current file position is aligned to block size and we can
-            # receive full chunks.
-            while self._todo:
-                count = min(self._todo, len(self._buf))
-                self._write_chunk(count)
+            if self._zero_copy:
+                self._run_splice()
+            # Writing behind is useful only if we may need more than one
+            # chunk.
+            elif self._write_behind and (
+                    self._size is None or self._size > len(self._buf)):
+                self._run_write_behind()
+            else:
+                self._run_serial()
         except EOF:
             pass
 
@@ -164,9 +306,186 @@ class Write(Operation):
             with self._record("flush"):
                 self._dst.flush()
 
+    def _run_serial(self):
+        # If offset is not aligned to block size, receive partial chunk until
+        # the start of the next block.
+        unaligned = self._offset % self._dst.block_size
+        if unaligned:
+            count = min(self._todo, self._dst.block_size - unaligned)
+            self._write_chunk(count)
+
+        # Now current file position is aligned to block size and we can
+        # receive full chunks.
+        while self._todo:
+            count = min(self._todo, len(self._buf))
+            self._write_chunk(count)
+
+    def _run_splice(self):
+        block_size = self._dst.block_size
+
+        # Unaligned edges are small, so they are received into buf and
+        # written like any other chunk, and only complete blocks are spliced.
+        unaligned = self._offset % block_size
+        if unaligned:
+            count = min(self._todo, block_size - unaligned)
+            self._write_chunk(count)
+
+        # Receive one buffer size at a time to allow cancellation.
+        chunk_size = max(util.round_down(len(self._buf), block_size),
+                         block_size)
+
+        while self._todo >= block_size:
+            count = util.round_down(min(self._todo, chunk_size), block_size)
+            with self._record("splice") as s:
+                received = self._dst.splice(self._src, count)
+                s.bytes += received
+            self._done += received
+
+            if received < count:
+                raise errors.PartialContent(self.size, self.done)
+
+            if self._canceled:
+                raise Canceled
+
+        if self._todo:
+            self._write_chunk(self._todo)
+
     def _write_chunk(self, count):
         self._buf.seek(0)
-        with memoryview(self._buf)[:count] as view:
+        read = self._receive(self._buf, count)
+        self._write(self._buf, read)
+        self._done += read
+
+        if read < count:
+            if self._size is None:
+                raise EOF
+            raise errors.PartialContent(self.size, self.done)
+
+        if self._canceled:
+            raise Canceled
+
+    def _run_write_behind(self):
+        free = queue.Queue()
+        ready = queue.Queue()
+
+        free.put(self._buf)
+        buffers = []
+        try:
+            for _ in range(self._write_behind):
+                # Use less buffers if the buffer pool is exhausted, instead
+                # of waiting while holding our buffer.
+                try:
+                    buf = bufpool.acquire(len(self._buf), timeout=0)
+                except errors.BufferPoolTimeout:
+                    log.debug("Buffer pool exhausted, using %d buffers",
+                              len(buffers) + 1)
+                    break
+                buffers.append(buf)
+                free.put(buf)
+
+            writer = util.start_thread(
+                self._write_behind_loop,
+                args=(free, ready),
+                name="write-behind")
+            try:
+                short_read = self._receive_chunks(free, ready)
+            except BaseException:
+                # Drop chunks not written yet, we are going to fail anyway.
+                while True:
+                    try:
+                        ready.get_nowait()
+                    except queue.Empty:
+                        break
+                raise
+            finally:
+                # Let the writer finish writing the received chunks, and wait
+                # until it stops using the destination backend.
+                ready.put(None)
+                writer.join()
+        finally:
+            for buf in buffers:
+                bufpool.release(buf)
+
+        # The writer may have failed after we received the last chunk.
+        while not free.empty():
+            item = free.get_nowait()
+            if isinstance(item, Exception):
+                raise item
+
+        if short_read:
+            if self._size is None:
+                raise EOF
+            raise errors.PartialContent(self.size, self.done)
+
+    def _receive_chunks(self, free, ready):
+        """
+        Receive chunks from the source into free buffers, passing filled
+        buffers to the writer thread. Return True if the source had less data
+        than expected.
+        """
+        received = 0
+
+        # If offset is not aligned to block size, receive partial chunk until
+        # the start of the next block.
+        count = self._next_count(received)
+        unaligned = self._offset % self._dst.block_size
+        if unaligned:
+            count = min(count, self._dst.block_size - unaligned)
+
+        while count:
+            buf = free.get()
+            if isinstance(buf, Exception):
+                raise buf
+
+            buf.seek(0)
+            read = self._receive(buf, count)
+            if read:
+                ready.put((buf, read))
+            else:
+                free.put(buf)
+
+            if read < count:
+                return True
+
+            if self._canceled:
+                raise Canceled
+
+            received += read
+            count = self._next_count(received)
+
+        return False
+
+    def _next_count(self, received):
+        if self._size is None:
+            return len(self._buf)
+        return min(self._size - received, len(self._buf))
+
+    def _write_behind_loop(self, free, ready):
+        """
+        Write received chunks to the destination, returning written buffers
+        to the caller thread. Runs in the write behind thread.
+        """
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    log.debug("Write behind stopped")
+                    return
+
+                buf, count = item
+                self._write(buf, count)
+                self._done += count
+                free.put(buf)
+        except Exception as e:
+            free.put(e)
+
+    def _receive(self, buf, count):
+        """
+        Receive up to count bytes from the source into buf, and return the
+        number of bytes received. Return less than count only if the source
+        has no more data.
+        """
+        with memoryview(buf)[:count] as view:
             read = 0
             while read < count:
                 with view[read:] as v:
@@ -177,22 +496,70 @@ class Write(Operation):
                     break
                 read += n
 
-            pos = 0
-            while pos < read:
-                with view[pos:read] as v:
-                    with self._record("write") as s:
-                        n = self._dst.write(v)
-                        s.bytes += n
-                pos += n
+        return read
 
-        self._done += read
-        if read < count:
-            if self._size is None:
-                raise EOF
-            raise errors.PartialContent(self.size, self.done)
+    def _write(self, buf, count):
+        """
+        Write count bytes from buf to the destination.
+        """
+        with memoryview(buf)[:count] as view:
+            if self._detect_zeroes:
+                self._write_detect_zeroes(view)
+            else:
+                self._write_data(view)
 
-        if self._canceled:
-            raise Canceled
+    def _write_detect_zeroes(self, view):
+        """
+        Write view to the destination, zeroing instead of writing blocks
+        containing only zeroes. Consecutive blocks of the same kind are
+        written or zeroed using a single call.
+        """
+        offset = self._dst.tell()
+        count = len(view)
+        run_start = 0
+        run_zero = None
+        pos = 0
+
+        while pos < count:
+            # Check up to the next block boundary in the image.
+            end = util.round_up(offset + pos + 1, self.ZERO_BLOCK_SIZE)
+            end = min(end - offset, count)
+
+            with view[pos:end] as v:
+                zero = ioutil.is_zero(v)
+
+            if run_zero is not None and zero != run_zero:
+                self._write_run(view, run_start, pos, run_zero)
+                run_start = pos
+
+            run_zero = zero
+            pos = end
+
+        if run_zero is not None:
+            self._write_run(view, run_start, count, run_zero)
+
+    def _write_run(self, view, start, end, zero):
+        with view[start:end] as v:
+            if zero:
+                self._zero_data(len(v))
+            else:
+                self._write_data(v)
+
+    def _write_data(self, view):
+        pos = 0
+        while pos < len(view):
+            with view[pos:] as v:
+                with self._record("write") as s:
+                    n = self._dst.write(v)
+                    s.bytes += n
+            pos += n
+
+    def _zero_data(self, count):
+        while count:
+            with self._record("zero") as s:
+                n = self._dst.zero(count)
+                s.bytes += n
+            count -= n
 
 
 class Zero(Operation):
@@ -251,3 +618,65 @@ class Flush(Operation):
 
     def _run(self):
         self._dst.flush()
+
+
+class Copy(Operation):
+    """
+    Copy image data from source backend to destination backend using
+    io.copy(), copying data extents and zeroing zero extents using up to
+    max_workers threads. The destination is flushed when the copy completes.
+
+    If zero is False, skip zero extents. If hole is False, skip holes, keeping
+    them unallocated in the destination. See io.copy() for more info.
+    """
+
+    name = "copy"
+
+    def __init__(self, src, dst, size, max_workers=io.MAX_WORKERS,
+                 buffer_size=io.BUFFER_SIZE, zero=True, hole=True,
+                 clock=None):
+        super().__init__(size=size, clock=clock)
+        self._src = src
+        self._dst = dst
+        self._max_workers = max_workers
+        self._buffer_size = buffer_size
+        self._zero = zero
+        self._hole = hole
+        self._lock = threading.Lock()
+
+    def _run(self):
+        with self._record("copy"):
+            io.copy(
+                self._src,
+                self._dst,
+                max_workers=self._max_workers,
+                buffer_size=self._buffer_size,
+                zero=self._zero,
+                hole=self._hole,
+                progress=_Progress(self),
+                name="copy",
+                check=self._check_canceled)
+
+    def _check_canceled(self):
+        # Called by the copy workers before handling every request.
+        if self._canceled:
+            raise Canceled
+
+    def _update(self, n):
+        # Called by the copy workers when a request was handled.
+        with self._lock:
+            self._done += n
+
+
+class _Progress:
+    """
+    Progress interface used by io.copy(), updating the operation.
+    """
+
+    def __init__(self, op):
+        self._op = op
+        # Set by io.copy() to the source size.
+        self.size = None
+
+    def update(self, n):
+        self._op._update(n)
@@ -0,0 +1,332 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+prefork - serve the remote service using multiple processes.
+
+The main process forks worker processes, each serving the remote service on
+the same port using SO_REUSEPORT. The main process keeps serving the control
+and local services, and forwards ticket changes to the workers using a socket
+pair created for every worker. The socket pair has no address, so other
+processes cannot modify the workers tickets.
+"""
+
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import auth
+from . import errors
+from . import services
+from . import uhttp
+
+log = logging.getLogger("prefork")
+
+
+class WorkerError(errors.Error):
+    msg = ("Worker {self.pid} failed to {self.method} {self.path}: "
+           "{self.status} {self.reason}")
+
+    def __init__(self, pid, method, path, status, reason):
+        self.pid = pid
+        self.method = method
+        self.path = path
+        self.status = status
+        self.reason = reason
+
+
+class Worker:
+    """
+    A worker process, as seen from the main process.
+    """
+
+    def __init__(self, pid, channel, pipe):
+        self.pid = pid
+        # Socket connected to the worker service. Requests are sent one at a
+        # time on the same connection.
+        self.channel = channel
+        self._con = uhttp.ChannelHTTPConnection(channel)
+        self._lock = threading.Lock()
+        # The worker exits when the main process closes this pipe.
+        self._pipe = pipe
+
+    def request(self, method, path, body=None):
+        """
+        Send request to the worker service, returning response status and
+        body text.
+        """
+        with self._lock:
+            self._con.request(method, path, body=body)
+            res = self._con.getresponse()
+            return res.status, res.read().decode("utf-8", errors="replace")
+
+    def stop(self):
+        if self._pipe is not None:
+            os.close(self._pipe)
+            self._pipe = None
+        self._con.close()
+
+    def wait(self, timeout):
+        """
+        Wait until the worker exits, killing it if it did not exit within
+        timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                log.debug("Worker %s exited with status %s", self.pid, status)
+                return
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.05)
+
+        log.warning("Timeout waiting for worker %s, killing it", self.pid)
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+
+    def __repr__(self):
+        return "<Worker pid={}>".format(self.pid)
+
+
+class Authorizer(auth.Authorizer):
+    """
+    Authorizer forwarding ticket changes to the worker processes.
+
+    Tickets are added first to the main process, so invalid tickets are
+    rejected before reaching the workers, and removed from the workers before
+    removing them from the main process.
+    """
+
+    def __init__(self, config, workers=()):
+        super().__init__(config)
+        self.workers = list(workers)
+
+    def add(self, ticket_dict):
+        super().add(ticket_dict)
+        body = json.dumps(ticket_dict).encode("utf-8")
+        self._forward("PUT", "/tickets/" + ticket_dict["uuid"], body)
+
+    def remove(self, ticket_id):
+        try:
+            ticket = self.get(ticket_id)
+        except KeyError:
+            return
+
+        results = self._forward(
+            "DELETE", "/tickets/" + ticket_id, check=False)
+        for worker, status, text in results:
+            if status == 409:
+                # The ticket is still used by some connection in the worker.
+                raise errors.TransferCancelTimeout(ticket.transfer_id)
+            if status >= 400:
+                raise WorkerError(
+                    worker.pid, "DELETE", "/tickets/" + ticket_id, status,
+                    text)
+
+        super().remove(ticket_id)
+
+    def clear(self):
+        self._forward("DELETE", "/tickets/")
+        super().clear()
+
+    def get(self, ticket_id):
+        return Ticket(super().get(ticket_id), self)
+
+    def _forward(self, method, path, body=None, check=True):
+        """
+        Send request to all workers concurrently, returning list of (worker,
+        status, text) tuples.
+        """
+        if not self.workers:
+            return []
+
+        def send(worker):
+            status, text = worker.request(method, path, body=body)
+            if check and status >= 400:
+                raise WorkerError(worker.pid, method, path, status, text)
+            return worker, status, text
+
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
+            return list(executor.map(send, self.workers))
+
+
+class Ticket:
+    """
+    Ticket in the main process, including the workers state.
+    """
+
+    def __init__(self, ticket, authorizer):
+        self._ticket = ticket
+        self._authorizer = authorizer
+
+    def info(self):
+        """
+        Return ticket info merged with the ticket info in the workers.
+        """
+        info = self._ticket.info()
+        path = "/tickets/" + self._ticket.uuid
+        for _, status, text in self._authorizer._forward(
+                "GET", path, check=False):
+            if status == 200:
+                _merge_info(info, json.loads(text))
+        return info
+
+    def extend(self, timeout):
+        self._ticket.extend(timeout)
+        body = json.dumps({"timeout": timeout}).encode("utf-8")
+        self._authorizer._forward("PATCH", "/tickets/" + self._ticket.uuid,
+                                  body)
+
+    def __getattr__(self, name):
+        return getattr(self._ticket, name)
+
+
+def _merge_info(info, other):
+    info["active"] = info["active"] or other["active"]
+    info["canceled"] = info["canceled"] or other["canceled"]
+    info["connections"] += other["connections"]
+    info["idle_time"] = min(info["idle_time"], other["idle_time"])
+    if "transferred" in other:
+        # Processes usually transfer different parts of the image, but ranges
+        # transferred by multiple processes are counted multiple times, so the
+        # value is limited to the image size.
+        info["transferred"] = min(
+            info.get("transferred", 0) + other["transferred"], info["size"])
+
+
+def start_workers(config, count, inherited=(), setup=None, timeout=30):
+    """
+    Fork count worker processes serving the remote service, and return list
+    of Worker instances.
+
+    The workers close the inherited services, and call setup() after creating
+    their services.
+    """
+    workers = []
+    try:
+        for _ in range(count):
+            workers.append(
+                _start_worker(config, workers, inherited, setup, timeout))
+    except BaseException:
+        stop_workers(workers)
+        raise
+    return workers
+
+
+def stop_workers(workers, timeout=10):
+    for worker in workers:
+        worker.stop()
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        worker.wait(max(0, deadline - time.monotonic()))
+
+
+def _start_worker(config, workers, inherited, setup, timeout):
+    channel, worker_channel = socket.socketpair(
+        socket.AF_UNIX, socket.SOCK_STREAM)
+    r, w = os.pipe()
+    ready_r, ready_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(w)
+        os.close(ready_r)
+        channel.close()
+        # Do not keep other workers alive when the main process exits.
+        for worker in workers:
+            worker.stop()
+        _run_worker(config, worker_channel, r, ready_w, inherited, setup)
+
+    os.close(r)
+    os.close(ready_w)
+    worker_channel.close()
+    worker = Worker(pid, channel, w)
+    log.info("Started %s", worker)
+
+    try:
+        _wait_for_worker(worker, ready_r, timeout)
+    except BaseException:
+        stop_workers([worker])
+        raise
+    finally:
+        os.close(ready_r)
+
+    return worker
+
+
+def _wait_for_worker(worker, ready, timeout):
+    """
+    Wait until the worker writes to the ready pipe.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise errors.ServerStartupError(
+                "Timeout waiting for worker {}".format(worker.pid))
+
+        readable, _, _ = select.select([ready], [], [], remaining)
+        if readable:
+            if os.read(ready, 1):
+                return
+
+            # The worker exited before it was ready.
+            raise errors.ServerStartupError(
+                "Worker {} failed".format(worker.pid))
+
+
+def _run_worker(config, channel, pipe, ready, inherited, setup):
+    """
+    Run worker process until the main process closes the pipe. Never returns.
+    """
+    status = 1
+    try:
+        # The main process handles termination signals and stops the workers.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        for service in inherited:
+            service.close()
+
+        authorizer = auth.Authorizer(config)
+        remote_service = services.RemoteService(config, authorizer)
+        worker_service = services.WorkerService(config, authorizer, channel)
+
+        if setup:
+            setup()
+
+        remote_service.start()
+        worker_service.start()
+        os.write(ready, b"1")
+        os.close(ready)
+        log.info("Worker %s ready", os.getpid())
+
+        _wait_for_eof(pipe)
+
+        log.info("Worker %s stopping", os.getpid())
+        worker_service.stop()
+        remote_service.stop()
+        status = 0
+    except BaseException:
+        log.exception("Worker %s failed", os.getpid())
+    finally:
+        os._exit(status)
+
+
+def _wait_for_eof(pipe):
+    while True:
+        try:
+            if not os.read(pipe, 1):
+                return
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
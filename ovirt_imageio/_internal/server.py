@@ -15,10 +15,13 @@ import socket
 import sys
 
 from . import auth
+from . import bufpool
 from . import config
 from . import errors
+from . import prefork
 from . import services
 from . import version
+from .handlers import checksum
 
 DEFAULT_CONF_DIR = "/etc/ovirt-imageio"
 VENDOR_CONF_DIR = "/usr/lib/ovirt-imageio"
@@ -116,22 +119,63 @@ def notify_systemd(cfg):
         systemd.daemon.notify("READY=1")
 
 
+def _buffer_pool_size(config):
+    """
+    Return the size of the buffer pool of every process, validating that the
+    pool can provide the largest buffer used by the server.
+    """
+    size = config.daemon.buffer_pool_size // max(config.remote.workers, 1)
+    if size:
+        largest = max(
+            config.backend_file.buffer_size,
+            config.backend_http.buffer_size,
+            config.backend_nbd.buffer_size,
+            checksum.MAX_BLOCK_SIZE)
+        if size < largest:
+            log.error(
+                "Buffer pool size per process %s is smaller than the largest "
+                "buffer size %s", size, largest)
+            raise errors.InvalidConfig(
+                "daemon.buffer_pool_size", config.daemon.buffer_pool_size)
+    return size
+
+
 class Server:
 
     def __init__(self, config, ticket=None):
         self.config = config
         self.running = False
-        self.auth = auth.Authorizer(config)
+        if config.remote.workers > 1:
+            self.auth = prefork.Authorizer(config)
+        else:
+            self.auth = auth.Authorizer(config)
+        # Every process has its own buffer pool, inherited by the workers.
+        bufpool.configure(
+            _buffer_pool_size(config), config.daemon.buffer_pool_timeout)
         self.remote_service = services.RemoteService(self.config, self.auth)
-
         self.local_service = None
+        self.control_service = None
+
+        # Worker processes must be started before starting any thread, and
+        # serve the remote port selected by the remote service.
+        self.workers = []
+        if config.remote.workers > 1:
+            setup = None
+            if os.geteuid() == 0 and self.config.daemon.drop_privileges:
+                setup = self._drop_privileges
+            self.workers = prefork.start_workers(
+                config,
+                config.remote.workers - 1,
+                inherited=[self.remote_service],
+                setup=setup)
+            self.auth.workers = self.workers
+
         if config.local.enable:
             self.local_service = services.LocalService(self.config, self.auth)
 
-        self.control_service = None
         if config.control.enable:
             self.control_service = services.ControlService(
-                self.config, self.auth)
+                self.config, self.auth, get_stats=self.stats)
 
         if os.geteuid() == 0 and self.config.daemon.drop_privileges:
             self._drop_privileges()
@@ -156,6 +200,24 @@ class Server:
             self.local_service.stop()
         if self.control_service is not None:
             self.control_service.stop()
+        if self.workers:
+            log.debug("Stopping workers")
+            prefork.stop_workers(self.workers)
+        log.debug("Buffer pool stats: %s", bufpool.stats())
+        bufpool.clear()
+
+    def stats(self):
+        """
+        Return statistics of the services and the buffer pool in the main
+        process.
+        """
+        res = {
+            "remote": self.remote_service.stats(),
+            "buffer_pool": bufpool.stats(),
+        }
+        if self.local_service is not None:
+            res["local"] = self.local_service.stats()
+        return res
 
     def terminate(self, signo, frame):
         log.info("Received signal %d, shutting down", signo)
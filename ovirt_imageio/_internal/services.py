@@ -4,6 +4,7 @@
 import logging
 import os
 
+from . import ahttp
 from . import errors
 from . import http
 from . import ssl
@@ -14,9 +15,11 @@ from . import util
 from .handlers import (
     checksum,
     extents,
+    fd,
     images,
     info,
     profile,
+    stats as stats_handler,
     tickets,
 )
 
@@ -37,6 +40,20 @@ class Service:
         log.debug("Stopping %s", self.name)
         self._server.shutdown()
 
+    def close(self):
+        """
+        Close the service socket without stopping the service. Used by worker
+        processes to close sockets inherited from the main process.
+        """
+        self._server.server_close()
+
+    def stats(self):
+        """
+        Return service statistics.
+        """
+        pool = getattr(self._server, "pool", None)
+        return {"worker_pool": pool.stats() if pool else None}
+
     @property
     def port(self):
         return self._server.server_port
@@ -67,10 +84,25 @@ class RemoteService(Service):
         port = config.remote.port
         if not 0 <= port < 0xFFFF:
             raise errors.InvalidConfig("remote.port", port)
-        log.debug("Creating %s on port %d", self.name, port)
-        self._server = http.Server((config.remote.host, port), http.Connection)
+        log.debug("Creating %s on port %d event_loop=%s",
+                  self.name, port, config.remote.event_loop)
+        # When using worker processes, every process listens on the same
+        # port.
+        reuse_port = config.remote.workers > 1
+        if config.remote.event_loop:
+            self._server = ahttp.Server(
+                (config.remote.host, port),
+                ahttp.Connection,
+                reuse_port=reuse_port)
+        else:
+            self._server = http.Server(
+                (config.remote.host, port),
+                http.Connection,
+                reuse_port=reuse_port)
         # TODO: Make clock configurable, disabled by default.
         self._server.clock_class = stats.Clock
+        self._server.max_workers = config.daemon.max_workers
+        self._server.max_queued = config.daemon.max_queued
         if port == 0:
             config.remote.port = self.port
         if config.tls.enable:
@@ -79,12 +111,24 @@ class RemoteService(Service):
             (r"/images/(.*)/extents", extents.Handler(config, auth)),
             (r"/images/(.*)/checksum/algorithms",
                 checksum.Algorithms(config, auth)),
+            (r"/images/(.*)/checksum/map", checksum.Map(config, auth)),
             (r"/images/(.*)/checksum", checksum.Checksum(config, auth)),
             (r"/images/(.*)", images.Handler(config, auth)),
             (r"/info/", info.Handler(config, auth)),
         ])
         log.info("%s listening on %r", self.name, self.address)
 
+    def stop(self):
+        super().stop()
+        if self._config.tls.enable:
+            log.debug("TLS handshakes: %s", self._server.handshakes())
+
+    def stats(self):
+        result = super().stats()
+        if self._config.tls.enable:
+            result["tls_handshakes"] = self._server.handshakes()
+        return result
+
     def _secure_server(self):
         if "" in (self._config.tls.cert_file, self._config.tls.key_file):
             raise errors.TlsConfigurationError(self._config.tls)
@@ -97,7 +141,9 @@ class RemoteService(Service):
             self._config.tls.cert_file,
             self._config.tls.key_file,
             cafile=self._config.tls.ca_file,
-            enable_tls1_1=self._config.tls.enable_tls1_1)
+            enable_tls1_1=self._config.tls.enable_tls1_1,
+            session_tickets=self._config.tls.session_tickets,
+            enable_ktls=self._config.tls.enable_ktls)
         self._server.socket = context.wrap_socket(
             self._server.socket, server_side=True)
 
@@ -118,18 +164,42 @@ class LocalService(Service):
         self._server = uhttp.Server(config.local.socket, uhttp.Connection)
         # TODO: Make clock configurable, disabled by default.
         self._server.clock_class = stats.Clock
+        self._server.max_workers = config.daemon.max_workers
+        self._server.max_queued = config.daemon.max_queued
         if config.local.socket == "":
             config.local.socket = self.address
         self._server.app = http.Router([
             (r"/images/(.*)/extents", extents.Handler(config, auth)),
             (r"/images/(.*)/checksum/algorithms",
                 checksum.Algorithms(config, auth)),
+            (r"/images/(.*)/checksum/map", checksum.Map(config, auth)),
             (r"/images/(.*)/checksum", checksum.Checksum(config, auth)),
+            (r"/images/(.*)/fd", fd.Handler(config, auth)),
             (r"/images/(.*)", images.Handler(config, auth)),
         ])
         log.info("%s listening on %r", self.name, self.address)
 
 
+class WorkerService(Service):
+    """
+    Service used by the main process to manage tickets in a worker process.
+
+    The service serves one end of a socket pair created by the main process
+    before starting the worker. The socket has no address, so no other
+    process can connect to the service.
+    """
+
+    name = "worker.service"
+
+    def __init__(self, config, auth, sock):
+        self._config = config
+        log.debug("Creating %s on socket fd %d", self.name, sock.fileno())
+        self._server = uhttp.ChannelServer(sock, uhttp.ChannelConnection)
+        self._server.app = http.Router([
+            (r"/tickets/(.*)", tickets.Handler(config, auth)),
+        ])
+
+
 class ControlService(Service):
     """
     Service used to control imageio daemon on a host.
@@ -140,7 +210,7 @@ class ControlService(Service):
 
     name = "control.service"
 
-    def __init__(self, config, auth):
+    def __init__(self, config, auth, get_stats=None):
         self._config = config
         transport = self._config.control.transport.lower()
         if transport == "tcp":
@@ -167,8 +237,13 @@ class ControlService(Service):
         # TODO: Make clock configurable, disabled by default.
         self._server.clock_class = stats.Clock
 
-        self._server.app = http.Router([
+        routes = [
+            (r"/tickets/(.*)/copy", tickets.Copy(config, auth)),
             (r"/tickets/(.*)", tickets.Handler(config, auth)),
             (r"/profile/", profile.Handler(config, auth)),
-        ])
+        ]
+        if get_stats:
+            routes.append(
+                (r"/stats/", stats_handler.Handler(config, auth, get_stats)))
+        self._server.app = http.Router(routes)
         log.info("%s listening on %r", self.name, self.address)
@@ -1,17 +1,69 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import os
 import ssl
 import subprocess
+import threading
 
 
-def server_context(certfile, keyfile, cafile=None, enable_tls1_1=False):
+# Enable kernel TLS in OpenSSL 3. Available in the ssl module since Python
+# 3.12.
+OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 1 << 3)
+
+# Server contexts created in this process. Session tickets are encrypted with
+# keys kept in the context, so using the same context in the prefork worker
+# processes allows resuming a session established with another process.
+# Contexts are keyed by configuration, and replaced when the certificate, key
+# or CA files are modified, so a rotated certificate is used by new servers.
+_server_contexts = {}
+_lock = threading.Lock()
+
+
+def server_context(certfile, keyfile, cafile=None, enable_tls1_1=False,
+                   session_tickets=True, enable_ktls=False):
+    key = (certfile, keyfile, cafile, enable_tls1_1, session_tickets,
+           enable_ktls)
+    version = _files_version(certfile, keyfile, cafile)
+    with _lock:
+        cached = _server_contexts.get(key)
+        if cached is None or cached[0] != version:
+            ctx = _create_server_context(*key)
+            cached = _server_contexts[key] = (version, ctx)
+        return cached[1]
+
+
+def _files_version(*paths):
+    """
+    Return a value changing when any of the files is replaced or modified.
+    """
+    version = []
+    for path in paths:
+        if not path:
+            version.append(None)
+        else:
+            st = os.stat(path)
+            version.append((st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(version)
+
+
+def _create_server_context(certfile, keyfile, cafile, enable_tls1_1,
+                           session_tickets, enable_ktls):
     # TODO: Verify client certs
     ctx = ssl.create_default_context(
         purpose=ssl.Purpose.CLIENT_AUTH, cafile=cafile)
     ctx.options |= ssl.OP_NO_TLSv1
     if not enable_tls1_1:
         ctx.options |= ssl.OP_NO_TLSv1_1
+    if not session_tickets:
+        # Clients can still resume TLSv1.2 sessions cached by the server
+        # process.
+        ctx.options |= ssl.OP_NO_TICKET
+        ctx.num_tickets = 0
+    if enable_ktls and ssl.OPENSSL_VERSION_INFO >= (3, 0):
+        # OpenSSL falls back to user space encryption if the kernel does not
+        # support kernel TLS or the negotiated cipher.
+        ctx.options |= OP_ENABLE_KTLS
     ctx.load_cert_chain(certfile, keyfile=keyfile)
     return ctx
 
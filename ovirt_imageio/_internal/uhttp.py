@@ -1,14 +1,20 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import array
 import errno
 import http.client as http_client
+import io
+import json
 import logging
 import os
 import socket
+import threading
+import urllib.parse
 import uuid
 
 from . import http
+from . import stats
 from . import util
 
 PUT = "PUT"
@@ -23,6 +29,16 @@ class UnsupportedError(Exception):
     pass
 
 
+class RequestError(Exception):
+
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+    def __str__(self):
+        return "{} {}".format(self.status, self.reason)
+
+
 class _UnixMixin:
 
     def set_tunnel(self, host, port=None, headers=None):
@@ -43,6 +59,20 @@ class UnixHTTPConnection(_UnixMixin, http_client.HTTPConnection):
         self.sock.connect(self.path)
 
 
+class ChannelHTTPConnection(_UnixMixin, http_client.HTTPConnection):
+    """
+    HTTP connection over a connected unix socket, such as one end of a socket
+    pair. The connection cannot be reopened once it was closed.
+    """
+
+    def __init__(self, sock, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.sock = sock
+
+    def connect(self):
+        raise ConnectionError("Channel was closed")
+
+
 class Server(http.Server):
     """
     HTTP server over unix domain socket.
@@ -118,6 +148,139 @@ class Connection(http.Connection):
         return "local"
 
 
+class ChannelServer:
+    """
+    HTTP server serving a single connected unix socket, such as one end of a
+    socket pair created by another process. Since the socket has no address,
+    only the process holding the other end can send requests.
+
+    The connection is served until the peer closes it, or the server is shut
+    down.
+    """
+
+    server_name = "localhost"
+    server_port = None
+    server_address = ""
+
+    # A callable called for every request.
+    app = None
+
+    # Clock used to profile connections.
+    clock_class = stats.NullClock
+
+    def __init__(self, sock, RequestHandlerClass):
+        self.socket = sock
+        self.RequestHandlerClass = RequestHandlerClass
+        self._done = threading.Event()
+
+    def serve_forever(self, poll_interval=None):
+        try:
+            self.RequestHandlerClass(self.socket, self.server_address, self)
+        finally:
+            self._done.set()
+
+    def shutdown(self):
+        # Wake up the connection waiting for the next request.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            log.debug("Error shutting down socket: %s", e)
+        self._done.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+
+class ChannelConnection(Connection):
+    """
+    HTTP connection over a socket served by ChannelServer.
+    """
+
+    # The peer keeps the connection open while idle, possibly for a long
+    # time.
+    timeout = None
+
+
+def get_image_fd(path, ticket_id, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """
+    Get an open file descriptor for the image of ticket ticket_id from the
+    local service listening on unix socket path.
+
+    Returns a tuple (fd, info), where info is a dict with the "mode" the file
+    descriptor was opened with, and the ticket image "size". The caller must
+    close the file descriptor, and must not access data after size bytes.
+
+    Raises RequestError if the server failed the request.
+    """
+    sock = _create_unix_socket(timeout)
+    fds = array.array("i")
+    try:
+        sock.connect(path)
+        sock.sendall(
+            b"GET /images/%s/fd HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Connection: close\r\n"
+            b"\r\n" % urllib.parse.quote(ticket_id, safe="").encode("ascii"))
+
+        # The file descriptor is received with the response, so we cannot
+        # use http.client to read the response.
+        chunks = []
+        while True:
+            data, ancdata, flags, _ = sock.recvmsg(
+                64 * 1024, socket.CMSG_SPACE(fds.itemsize))
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    cdata = cdata[:len(cdata) - len(cdata) % fds.itemsize]
+                    fds.frombytes(cdata)
+            if flags & socket.MSG_CTRUNC:
+                raise RuntimeError("Received too many file descriptors")
+            if not data:
+                break
+            chunks.append(data)
+    except BaseException:
+        _close_fds(fds)
+        raise
+    finally:
+        sock.close()
+
+    res = http_client.HTTPResponse(_ResponseBuffer(b"".join(chunks)))
+    try:
+        res.begin()
+        body = res.read()
+    except http_client.HTTPException:
+        _close_fds(fds)
+        raise
+
+    if res.status != http_client.OK:
+        _close_fds(fds)
+        raise RequestError(
+            res.status, body.decode("utf-8", errors="replace").strip())
+
+    if len(fds) != 1:
+        _close_fds(fds)
+        raise RuntimeError(
+            "Expected 1 file descriptor, received {}".format(len(fds)))
+
+    return fds[0], json.loads(body)
+
+
+class _ResponseBuffer:
+    """
+    Socket like object providing a received response to http.client.
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, mode):
+        return io.BytesIO(self._data)
+
+
+def _close_fds(fds):
+    for fd in fds:
+        os.close(fd)
+
+
 def _create_unix_socket(timeout):
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
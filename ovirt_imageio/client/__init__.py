@@ -17,7 +17,9 @@ from . _api import (
     BUFFER_SIZE,
     MAX_WORKERS,
     upload,
+    upload_delta,
     download,
+    download_delta,
     info,
     measure,
     checksum,
@@ -35,10 +37,12 @@ __all__ = (
     "ProgressBar",
     "checksum",
     "download",
+    "download_delta",
     "extents",
     "info",
     "measure",
     "upload",
+    "upload_delta",
 )
 
 __version__ = version.string
@@ -19,6 +19,7 @@ from .. _internal import qemu_img
 from .. _internal import qemu_nbd
 from .. _internal import util
 from .. _internal.backends import http, nbd
+from .. _internal.extent import ZeroExtent
 from .. _internal.handlers import checksum as _checksum
 from .. _internal.nbd import UnixAddress
 
@@ -193,6 +194,162 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
                 name="download")
 
 
+def upload_delta(filename, url, cafile, block_size=blkhash.BLOCK_SIZE,
+                 algorithm=blkhash.ALGORITHM, buffer_size=BUFFER_SIZE,
+                 secure=True, progress=None, proxy_url=None,
+                 max_workers=MAX_WORKERS, member=None):
+    """
+    Upload only the blocks of filename that differ from the image at url.
+
+    Compare the digests of the local image blocks with the digests of the
+    remote image blocks computed by the server, and upload only the blocks
+    with different digests. The local and remote images must have the same
+    size.
+
+    Args:
+        filename (str): File name for upload
+        url (str): Transfer url on the host running imageio server
+            e.g. https://{imageio.server}:{port}/images/{ticket-id}.
+        cafile (str): Certificate file name, for example "ca.pem"
+        block_size (int): Size of compared blocks in bytes. Smaller blocks
+            may transfer less data, but the server limits the allowed block
+            size.
+        algorithm (str): Algorithm used for computing block digests; must
+            be supported by the server.
+        buffer_size (int): Buffer size in bytes for reading from storage and
+            sending data over HTTP connection.
+        secure (bool): True for verifying server certificate and hostname.
+            Default is True.
+        progress (client.ProgressBar): an object implementing
+            client.ProgressBar() interface. Unchanged blocks are reported as
+            transferred.
+        proxy_url (str): Proxy url on the host running imageio as proxy, used
+            if url is not accessible.
+            e.g. https://{proxy.server}:{port}/images/{ticket-id}.
+        max_workers (int): Maximum number of worker threads to use.
+        member (str): Upload a disk with specified name from OVA file. This is
+            the name reported by "tar tf vm.ova".
+    """
+    if callable(progress):
+        progress = ProgressWrapper(progress)
+
+    with _open_http(
+            url,
+            "r+",
+            cafile=cafile,
+            secure=secure,
+            proxy_url=proxy_url) as dst:
+
+        max_workers = min(dst.max_writers, max_workers)
+
+        image_info = info(filename, member=member)
+
+        # Using max_workers connections for computing the checksum map, and
+        # extra connection for getting image extents.
+        with _open_nbd(
+                filename,
+                image_info["format"],
+                read_only=True,
+                shared=max_workers + 1,
+                offset=image_info.get("member-offset"),
+                size=image_info.get("member-size")) as src:
+
+            src_map = _checksum.compute_map(
+                src,
+                bytearray(block_size),
+                algorithm=algorithm,
+                workers=max_workers)
+            dst_map = dst.checksum_map(algorithm, block_size)
+            extents = _delta_extents(src, dst, src_map, dst_map)
+
+            _io.copy(
+                src,
+                dst,
+                max_workers=max_workers,
+                buffer_size=buffer_size,
+                # Unchanged blocks are reported as holes and must be skipped.
+                hole=False,
+                progress=progress,
+                name="upload",
+                extents=extents)
+
+
+def download_delta(url, filename, cafile, block_size=blkhash.BLOCK_SIZE,
+                   algorithm=blkhash.ALGORITHM, buffer_size=BUFFER_SIZE,
+                   secure=True, progress=None, proxy_url=None,
+                   max_workers=MAX_WORKERS):
+    """
+    Download only the blocks of the image at url that differ from existing
+    image filename.
+
+    Compare the digests of the remote image blocks computed by the server
+    with the digests of the local image blocks, and download only the blocks
+    with different digests. The local and remote images must have the same
+    size.
+
+    Args:
+        url (str): Transfer url on the host running imageio server
+            e.g. https://{imageio.server}:{port}/images/{ticket-id}.
+        filename (str): Existing image to update.
+        cafile (str): Certificate file name, for example "ca.pem"
+        block_size (int): Size of compared blocks in bytes. Smaller blocks
+            may transfer less data, but the server limits the allowed block
+            size.
+        algorithm (str): Algorithm used for computing block digests; must
+            be supported by the server.
+        buffer_size (int): Buffer size in bytes for reading from storage and
+            sending data over HTTP connection.
+        secure (bool): True for verifying server certificate and hostname.
+            Default is True.
+        progress (client.ProgressBar): an object implementing
+            client.ProgressBar() interface. Unchanged blocks are reported as
+            transferred.
+        proxy_url (str): Proxy url on the host running imageio as proxy, used
+            as if url is not accessible.
+            e.g. https://{proxy.server}:{port}/images/{ticket-id}.
+        max_workers (int): Maximum number of worker threads to use.
+    """
+    if callable(progress):
+        progress = ProgressWrapper(progress)
+
+    with _open_http(
+            url,
+            "r",
+            cafile=cafile,
+            secure=secure,
+            proxy_url=proxy_url) as src:
+
+        max_workers = min(src.max_readers, max_workers)
+
+        image_info = info(filename)
+
+        # Using max_workers connections for computing the checksum map, and
+        # extra connection for the copy.
+        with _open_nbd(
+                filename,
+                image_info["format"],
+                shared=max_workers + 1) as dst:
+
+            src_map = src.checksum_map(algorithm, block_size)
+            dst_map = _checksum.compute_map(
+                dst,
+                bytearray(block_size),
+                algorithm=algorithm,
+                workers=max_workers)
+            extents = _delta_extents(src, dst, src_map, dst_map)
+
+            _io.copy(
+                src,
+                dst,
+                max_workers=max_workers,
+                buffer_size=buffer_size,
+                # Unchanged blocks are reported as holes and must be skipped.
+                hole=False,
+                progress=progress,
+                name="download",
+                extents=extents)
+
+
 def info(filename, member=None):
     """
     Return image information.
@@ -449,6 +606,52 @@ class ImageioClient:
             log.exception("Error closing client")
 
 
+def _delta_extents(src, dst, src_map, dst_map):
+    """
+    Compare src and dst checksum maps, and return list of zero extents
+    describing how to update dst. Changed blocks are reported as data or zero
+    extents, and unchanged blocks are reported as holes.
+    """
+    size = src.size()
+    if dst.size() != size:
+        raise RuntimeError(
+            "Image size mismatch: {} != {}".format(size, dst.size()))
+
+    src_digests = src_map["digests"]
+    dst_digests = dst_map["digests"]
+    if len(src_digests) != len(dst_digests):
+        raise RuntimeError(
+            "Checksum map mismatch: {} != {} blocks"
+            .format(len(src_digests), len(dst_digests)))
+
+    algorithm = src_map["algorithm"]
+    block_size = src_map["block_size"]
+    h = _checksum.new_hash(algorithm, block_size)
+    extents = []
+
+    for i, (src_digest, dst_digest) in enumerate(
+            zip(src_digests, dst_digests)):
+        start = i * block_size
+        length = min(block_size, size - start)
+
+        if src_digest == dst_digest:
+            # Unchanged block, skipped.
+            zero, hole = True, True
+        elif src_digest == h.zero_digest(length).hex():
+            zero, hole = True, False
+        else:
+            zero, hole = False, False
+
+        if extents and (extents[-1].zero, extents[-1].hole) == (zero, hole):
+            last = extents[-1]
+            extents[-1] = ZeroExtent(
+                last.start, last.length + length, zero, hole)
+        else:
+            extents.append(ZeroExtent(start, length, zero, hole))
+
+    return extents
+
+
 class ProgressWrapper:
     """
     In older versions we supported passing an update() callable instead of an
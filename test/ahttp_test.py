@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import http.client as http_client
+import socket
+import threading
+import time
+
+from contextlib import closing
+from contextlib import contextmanager
+
+from ovirt_imageio._internal import ahttp
+from ovirt_imageio._internal import auth
+from ovirt_imageio._internal import config
+from ovirt_imageio._internal import http
+from ovirt_imageio._internal import services
+from ovirt_imageio._internal import util
+
+from . http import RemoteClient
+
+
+class Echo:
+
+    def get(self, req, resp, name):
+        body = b"%s:%s\n" % (
+            name.encode("utf-8"),
+            threading.current_thread().name.encode("utf-8"))
+        resp.headers["content-length"] = len(body)
+        resp.write(body)
+
+
+class ShortTimeout(ahttp.Connection):
+    timeout = 0.2
+
+
+@contextmanager
+def event_loop_server(max_workers=2, connection_class=ahttp.Connection):
+    server = ahttp.Server(("127.0.0.1", 0), connection_class)
+    server.max_workers = max_workers
+    server.app = http.Router([(r"/echo/(.*)", Echo())])
+
+    t = util.start_thread(server.serve_forever)
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        t.join()
+
+
+def test_many_idle_connections():
+    with event_loop_server(max_workers=2) as server:
+        cons = [
+            http_client.HTTPConnection("localhost", server.server_port)
+            for i in range(20)
+        ]
+        try:
+            threads = set()
+
+            # Every connection sends 2 requests, keeping the connection open
+            # between the requests. 2 threads serve all the connections.
+            for n in range(2):
+                for i, con in enumerate(cons):
+                    con.request("GET", "/echo/{}".format(i))
+                    r = con.getresponse()
+                    assert r.status == http.OK
+                    name, thread = r.read().decode("utf-8").split(":")
+                    assert name == str(i)
+                    threads.add(thread)
+
+            assert len(threads) <= 2
+        finally:
+            for con in cons:
+                con.close()
+
+
+def test_pipelined_requests():
+    with event_loop_server() as server:
+        sock = socket.create_connection(("localhost", server.server_port))
+        with closing(sock):
+            # Send both requests before reading the first response. The second
+            # request is buffered by the connection when serving the first.
+            sock.sendall(
+                b"GET /echo/1 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                b"GET /echo/2 HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            # Read both responses.
+            data = b""
+            while data.count(b"HTTP/1.1 200 OK") < 2 or b"\n2:" not in data:
+                chunk = sock.recv(4096)
+                assert chunk
+                data += chunk
+
+            first, second = data.split(b"HTTP/1.1 200 OK")[1:]
+            assert b"\r\n\r\n1:" in first
+            assert b"\r\n\r\n2:" in second
+
+
+def test_idle_timeout():
+    with event_loop_server(connection_class=ShortTimeout) as server:
+        con = http_client.HTTPConnection("localhost", server.server_port)
+        with closing(con):
+            con.request("GET", "/echo/before")
+            r = con.getresponse()
+            assert r.status == http.OK
+            r.read()
+
+            # The server closes idle connection after the timeout.
+            time.sleep(0.5)
+            assert server.connections == 0
+            assert con.sock.recv(1) == b""
+
+
+def test_shutdown_closes_idle_connections():
+    with event_loop_server() as server:
+        con = http_client.HTTPConnection("localhost", server.server_port)
+        con.request("GET", "/echo/name")
+        con.getresponse().read()
+
+    with closing(con):
+        assert con.sock.recv(1) == b""
+
+
+def test_remote_service_tls():
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.remote.host = "localhost"
+    cfg.remote.event_loop = True
+    service = services.RemoteService(cfg, auth.Authorizer(cfg))
+    service.start()
+    try:
+        with RemoteClient(cfg) as c:
+            # The TLS connection is kept open between requests.
+            for i in range(2):
+                r = c.get("/info/")
+                assert r.status == http.OK
+                r.read()
+    finally:
+        service.stop()
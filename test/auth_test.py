@@ -1,6 +1,7 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import io
 import itertools
 import logging
 import time
@@ -10,6 +11,8 @@ import pytest
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import errors
 from ovirt_imageio._internal import ops
+from ovirt_imageio._internal.backends import memory
+from ovirt_imageio._internal.extent import ZeroExtent
 from ovirt_imageio._internal import util
 from ovirt_imageio._internal.auth import Ticket, Authorizer
 
@@ -463,6 +466,76 @@ def test_ticket_run(cfg):
     assert op.done == 100
 
 
+def test_ticket_extents_cache(cfg):
+    ticket = Ticket(testutil.create_ticket(ops=["write"], size=16384), cfg)
+    backend = memory.Backend(
+        mode="r+", data=bytearray(16384),
+        extents={"zero": [ZeroExtent(0, 16384, True, False)]})
+
+    assert list(ticket.extents(backend)) == [
+        ZeroExtent(0, 16384, True, False),
+    ]
+
+    # Writing and zeroing using the ticket update the cached extents.
+    with util.aligned_buffer(4096) as buf:
+        ticket.run(ops.Write(
+            backend, io.BytesIO(b"x" * 8192), buf, 8192, offset=4096))
+    ticket.run(ops.Zero(backend, 2048, offset=8192))
+
+    assert list(ticket.extents(backend)) == [
+        ZeroExtent(0, 4096, True, False),
+        ZeroExtent(4096, 4096, False, False),
+        ZeroExtent(8192, 2048, True, False),
+        ZeroExtent(10240, 2048, False, False),
+        ZeroExtent(12288, 4096, True, False),
+    ]
+
+    # Reading does not change the cached extents.
+    with util.aligned_buffer(4096) as buf:
+        ticket.run(ops.Read(backend, io.BytesIO(), buf, 4096))
+    assert len(list(ticket.extents(backend))) == 5
+
+
+@pytest.mark.parametrize("option,workers", [
+    pytest.param(False, 1, id="disabled"),
+    pytest.param(True, 2, id="prefork"),
+])
+def test_ticket_extents_no_cache(cfg, option, workers):
+    cfg.daemon.extents_cache = option
+    cfg.remote.workers = workers
+    ticket = Ticket(testutil.create_ticket(ops=["write"], size=16384), cfg)
+    backend = memory.Backend(
+        mode="r+", data=bytearray(16384),
+        extents={"zero": [ZeroExtent(0, 16384, True, False)]})
+
+    list(ticket.extents(backend))
+
+    # Extents are always received from the backend.
+    ticket.run(ops.Zero(backend, 4096, offset=4096))
+    assert list(ticket.extents(backend)) == [
+        ZeroExtent(0, 16384, True, False),
+    ]
+
+
+def test_ticket_reserve_connections(cfg):
+    ticket = Ticket(testutil.create_ticket(ops=["read"]), cfg)
+    ticket.add_context(1, Context())
+    ticket.add_context(2, Context())
+
+    with ticket.reserve_connections(4, 8) as reserved:
+        assert reserved == 4
+
+        # Limited by connections and other reservations.
+        with ticket.reserve_connections(4, 8) as reserved:
+            assert reserved == 2
+            with ticket.reserve_connections(4, 8) as reserved:
+                assert reserved == 0
+
+    # Reserved connections were released.
+    with ticket.reserve_connections(8, 8) as reserved:
+        assert reserved == 6
+
+
 def test_cancel_no_connection(cfg):
     ticket = Ticket(testutil.create_ticket(ops=["read"]), cfg)
     ticket.cancel()
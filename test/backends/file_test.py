@@ -637,13 +637,65 @@ def test_extents(user_file):
         f.truncate(size)
 
     with file.open(user_file.url, "r+", sparse=True) as f:
-        # We support detecting extents now; empty file reports one data
-        # extents.
+        # Empty file is a hole, reported as one zero extent.
+        assert list(f.extents()) == [
+            extent.ZeroExtent(0, size, True, False)
+        ]
+
+
+def test_extents_data_and_holes(user_file):
+    size = 1024**2
+    data = b"x" * 128 * 1024
+
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(size)
+        f.seek(256 * 1024)
+        f.write(data)
+
+    with file.open(user_file.url, "r+", sparse=True) as f:
+        f.seek(4096)
+        extents = list(f.extents())
+
+        # Getting extents does not change the current position.
+        assert f.tell() == 4096
+
+    # Extents cover the entire file, and the written area is reported as
+    # data. File systems may allocate more than we wrote.
+    start = 0
+    for ext in extents:
+        assert ext.start == start
+        assert not ext.hole
+        if ext.start <= 256 * 1024 < ext.start + ext.length:
+            assert not ext.zero
+        start += ext.length
+    assert start == size
+
+    assert extents[0] == extent.ZeroExtent(0, extents[0].length, True, False)
+    assert extents[-1].zero
+
+
+def test_extents_full(user_file):
+    size = user_file.sector_size * 2
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    with file.open(user_file.url, "r+", sparse=True) as f:
         assert list(f.extents()) == [
             extent.ZeroExtent(0, size, False, False)
         ]
 
 
+def test_extents_empty(user_file):
+    with io.open(user_file.path, "wb"):
+        pass
+
+    with file.open(user_file.url, "r+", sparse=True) as f:
+        assert list(f.extents()) == [
+            extent.ZeroExtent(0, 0, False, False)
+        ]
+
+
 def test_extents_dirty(user_file):
     with file.open(user_file.url, "r+", dirty=True) as f:
         with pytest.raises(errors.UnsupportedOperation):
@@ -4,6 +4,7 @@
 import io
 import json
 import logging
+import socket
 
 import pytest
 
@@ -16,11 +17,19 @@ from ovirt_imageio._internal import ssl
 from ovirt_imageio._internal import uhttp
 from ovirt_imageio._internal import util
 
+from ovirt_imageio._internal.backends import http as http_backend
 from ovirt_imageio._internal.backends.http import Backend
 
 log = logging.getLogger("test")
 
 
+@pytest.fixture
+def pool():
+    pool = http_backend.Pool()
+    yield pool
+    pool.close()
+
+
 @pytest.fixture(scope="module", params=[True, False])
 def http_server(request, tmp_pki):
     secure = request.param
@@ -156,14 +165,20 @@ class Daemon(Handler):
     and recently /extents resource.
     """
 
-    def __init__(self, http_server, uhttp_server=None, extents=True):
+    def __init__(self, http_server, uhttp_server=None, extents=True,
+                 extents_binary=False):
         super().__init__(http_server, uhttp_server)
 
         # zero and flush support was introduce with OPTIONS, so we always
         # support both.
-        self.features = ["zero", "flush"]
+        self.features = ["zero", "flush", "zero_ranges"]
         if extents:
             self.features.append("extents")
+        if extents_binary:
+            self.features.append("extents_binary")
+
+        # Accept header of the last extents request.
+        self.extents_accept = None
 
         # Extents support was added later. It works only with NBD backend, and
         # emulated otherwise by reporting single non-zero extent.
@@ -198,6 +213,7 @@ class Daemon(Handler):
         if path == "ticket-id/extents":
             self.requests += 1
             context = req.query.get("context", "zero")
+            self.extents_accept = req.headers.get("accept")
             self._extents(resp, context)
         else:
             super().get(req, resp, path)
@@ -233,9 +249,24 @@ class Daemon(Handler):
         if context not in self.extents:
             raise http.Error(http.NOT_FOUND, "No dirty extents for you!")
         log.debug("EXTENTS context=%s", context)
-        resp.send_json(self.extents[context])
+        if ("extents_binary" in self.features and
+                self.extents_accept == "application/octet-stream"):
+            cls = (extent.ZeroExtent if context == "zero"
+                   else extent.DirtyExtent)
+            body = extent.pack(cls.from_dict(d) for d in self.extents[context])
+            resp.headers["content-type"] = "application/octet-stream"
+            resp.headers["content-length"] = len(body)
+            resp.write(body)
+        else:
+            resp.send_json(self.extents[context])
 
     def _zero(self, msg):
+        if "ranges" in msg:
+            assert "zero_ranges" in self.features
+            for r in msg["ranges"]:
+                self._zero(dict(r, flush=msg["flush"]))
+            return
+
         offset = msg["offset"]
         size = msg["size"]
         flush = msg["flush"]
@@ -586,6 +617,39 @@ def test_daemon_extents_dirty(http_server, uhttp_server):
         ]
 
 
+@pytest.mark.parametrize("context,cls,extents", [
+    ("zero", extent.ZeroExtent, [
+        {"start": 0, "length": 4096, "zero": False, "hole": False},
+        {"start": 4096, "length": 4096, "zero": True, "hole": True},
+    ]),
+    ("dirty", extent.DirtyExtent, [
+        {"start": 0, "length": 4096, "dirty": True, "zero": False},
+        {"start": 4096, "length": 4096, "dirty": False, "zero": True},
+    ]),
+])
+@pytest.mark.parametrize("binary,accept", [
+    pytest.param(False, None, id="json"),
+    pytest.param(True, "application/octet-stream", id="binary"),
+])
+def test_daemon_extents_format(
+        http_server, uhttp_server, context, cls, extents, binary, accept):
+    handler = Daemon(http_server, uhttp_server, extents_binary=binary)
+    handler.extents[context] = extents
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        # Binary extents are requested only if the server supports them, and
+        # both formats return the same extents.
+        assert list(b.extents(context)) == [cls.from_dict(d) for d in extents]
+        assert handler.extents_accept == accept
+
+        # Extents are cached, and shared with cloned backends.
+        with b.clone() as c:
+            assert list(c.extents(context, start=2048, length=4096)) == [
+                cls.from_dict(dict(extents[0], start=2048, length=2048)),
+                cls.from_dict(dict(extents[1], length=2048)),
+            ]
+
+
 def test_daemon_extents_error(http_server, uhttp_server):
     handler = Daemon(http_server, uhttp_server)
 
@@ -672,6 +736,28 @@ def test_daemon_zero_error(http_server, uhttp_server):
         check_zero_error(handler, b)
 
 
+@pytest.mark.parametrize("zero_ranges", [True, False])
+def test_daemon_zero_ranges(http_server, uhttp_server, zero_ranges):
+    handler = Daemon(http_server, uhttp_server)
+    if not zero_ranges:
+        handler.features.remove("zero_ranges")
+    handler.image[:] = b"x" * len(handler.image)
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        b.seek(42)
+        handler.requests = 0
+        b.zero_ranges([(0, 4096), (65536, 4096)])
+
+        # Position is not modified.
+        assert b.tell() == 42
+
+    # Single request if the server supports zeroing multiple ranges.
+    assert handler.requests == (1 if zero_ranges else 2)
+    assert handler.image[:4096] == b"\0" * 4096
+    assert handler.image[4096:65536] == b"x" * (65536 - 4096)
+    assert handler.image[65536:65536 + 4096] == b"\0" * 4096
+
+
 def test_daemon_flush_error(http_server, uhttp_server):
     handler = Daemon(http_server, uhttp_server)
     with Backend(http_server.url, http_server.cafile) as b:
@@ -754,6 +840,202 @@ def test_clone_unix(http_server, uhttp_server):
             assert buf == b"x" * 4096
 
 
+def test_pool_reuse_connection(http_server, pool):
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        con = b._con
+        b.size()
+
+    # The connection was returned to the pool and reused by the next backend.
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b._con is con
+        assert b.size() == 1024**2
+
+    stats = pool.stats()
+    assert stats["connected"] == 1
+    assert stats["reused"] == 1
+    assert stats["idle"] == 1
+
+
+def test_pool_concurrent_backends(http_server, pool):
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as a:
+        with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+            # Backends in use do not share a connection.
+            assert a._con is not b._con
+
+    assert pool.stats()["idle"] == 2
+
+
+def test_pool_drop_unread_response(http_server, pool):
+    handler = Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        # Leave a response unread on the connection.
+        b._con.request("GET", b.url.path)
+        b._con.getresponse()
+
+    assert pool.stats()["idle"] == 0
+    handler.requests = 0
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b.size() == len(handler.image)
+
+
+def test_pool_drop_closed_connection(http_server, pool):
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        con = b._con
+
+    # Simulate the server closing the idle connection.
+    con.sock.shutdown(socket.SHUT_RDWR)
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b._con is not con
+        assert b.size() == 1024**2
+
+    assert pool.stats()["connected"] == 2
+
+
+def test_pool_idle_timeout(http_server):
+    Daemon(http_server)
+    clock = [0]
+    pool = http_backend.Pool(idle_timeout=60, clock=lambda: clock[0])
+    try:
+        with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+            con = b._con
+
+        # Old idle connection is closed instead of reused.
+        clock[0] += 60
+        with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+            assert b._con is not con
+        assert con.sock is None
+    finally:
+        pool.close()
+
+
+def test_pool_max_idle(http_server):
+    Daemon(http_server)
+    pool = http_backend.Pool(max_idle=1)
+    try:
+        with Backend(http_server.url, http_server.cafile, pool=pool):
+            with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+                pass
+            assert b._con is http_backend.CLOSED
+        assert pool.stats()["idle"] == 1
+    finally:
+        pool.close()
+
+
+def test_pool_reuse_unix_connection(http_server, uhttp_server, pool):
+    Daemon(http_server, uhttp_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        con = b._con
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b._con is con
+        assert b.server_address == uhttp_server.server_address
+
+    # Both tcp connection and unix connection are idle.
+    assert pool.stats()["idle"] == 2
+
+
+def test_pool_cache_options(http_server, pool):
+    handler = Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool):
+        pass
+    assert handler.requests == 1
+
+    # Server options are cached for the same ticket.
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b._can_zero
+        assert b._can_flush
+        assert b._can_extents
+    assert handler.requests == 1
+    assert pool.stats()["options_cached"] == 1
+
+
+def test_pool_options_ttl(http_server):
+    handler = Daemon(http_server)
+    clock = [0]
+    pool = http_backend.Pool(options_ttl=60, clock=lambda: clock[0])
+    try:
+        with Backend(http_server.url, http_server.cafile, pool=pool):
+            pass
+
+        # Expired options are fetched again.
+        clock[0] += 60
+        with Backend(http_server.url, http_server.cafile, pool=pool):
+            pass
+        assert handler.requests == 2
+    finally:
+        pool.close()
+
+
+def test_pool_resume_tls_session(http_server, pool):
+    if http_server.url.scheme != "https":
+        pytest.skip("Requires https server")
+
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert not b._con.sock.session_reused
+        # Complete a request so the TLS session is available.
+        b.size()
+
+    # The first backend reuses the idle connection, and the second resumes
+    # its TLS session when connecting.
+    with Backend(http_server.url, http_server.cafile, pool=pool) as a:
+        with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+            assert a._con is not b._con
+            assert b._con.sock.session_reused
+
+    stats = pool.stats()
+    assert stats["tls_full"] == 1
+    assert stats["tls_resumed"] == 1
+
+
+def test_pool_close_with_last_backend(http_server):
+    Daemon(http_server)
+    a = Backend(http_server.url, http_server.cafile)
+    try:
+        b = a.clone()
+        con = b._con
+        b.close()
+        # The clone connection is kept for other backends using the pool.
+        assert con.sock is not None
+    finally:
+        a.close()
+
+    # Closing the last backend closed idle connections.
+    assert con.sock is None
+    assert a._con is http_backend.CLOSED
+
+
+def test_pool_not_closed_by_backend(http_server, pool):
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        con = b._con
+
+    # The pool owner is responsible for closing the pool.
+    assert con.sock is not None
+    assert pool.stats()["idle"] == 1
+
+    pool.close()
+    assert con.sock is None
+    assert pool.stats()["idle"] == 0
+
+
+def test_clone_resume_tls_session(http_server):
+    if http_server.url.scheme != "https":
+        pytest.skip("Requires https server")
+
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile) as a:
+        a.size()
+        # Cloned backend resumes the original backend TLS session.
+        with a.clone() as b:
+            assert b._con.sock.session_reused
+
+
 # Common flows - must works for all variants.
 
 def check_readinto(handler, backend):
@@ -225,6 +225,29 @@ def test_extents():
     assert list(m.extents()) == [extent.ZeroExtent(0, 4, False, False)]
 
 
+@pytest.mark.parametrize("start,length,expected", [
+    (0, None, [(0, 32, False), (32, 32, True)]),
+    (0, 64, [(0, 32, False), (32, 32, True)]),
+    (16, None, [(16, 16, False), (32, 32, True)]),
+    (16, 32, [(16, 16, False), (32, 16, True)]),
+    (32, 16, [(32, 16, True)]),
+    (40, 8, [(40, 8, True)]),
+    (32, 0, []),
+    (64, None, []),
+])
+def test_extents_range(start, length, expected):
+    extents = {
+        "zero": [
+            extent.ZeroExtent(0, 32, False, False),
+            extent.ZeroExtent(32, 32, True, False),
+        ],
+    }
+    m = memory.Backend(data=b"a" * 32 + b"\0" * 32, extents=extents)
+    assert list(m.extents(start=start, length=length)) == [
+        extent.ZeroExtent(s, n, z, False) for s, n, z in expected
+    ]
+
+
 def test_extents_dirty():
     m = memory.Backend(data=bytearray(b"data"))
     with pytest.raises(errors.UnsupportedOperation):
@@ -275,6 +275,31 @@ def test_extents_zero(nbd_server, user_file, fmt):
         ]
 
 
+def test_extents_zero_range(nbd_server):
+    size = 1024**2
+    qemu_img.create(nbd_server.image, "raw", size=size)
+    nbd_server.start()
+
+    with nbd.open(nbd_server.url, "r+") as b:
+        data = b"x" * 64 * 1024
+        b.seek(256 * 1024)
+        b.write(data)
+
+        # Extents start at start, and the first and last extents are clipped
+        # to the requested range.
+        assert list(b.extents(start=128 * 1024, length=256 * 1024)) == [
+            extent.ZeroExtent(128 * 1024, 128 * 1024, True, False),
+            extent.ZeroExtent(256 * 1024, len(data), False, False),
+            extent.ZeroExtent(
+                256 * 1024 + len(data), 64 * 1024, True, False),
+        ]
+
+        # Without length, extents end at the end of the image.
+        assert list(b.extents(start=512 * 1024)) == [
+            extent.ZeroExtent(512 * 1024, size - 512 * 1024, True, False),
+        ]
+
+
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
 def test_extents_dirty_not_availabe(nbd_server, fmt):
     qemu_img.create(nbd_server.image, fmt, 65536)
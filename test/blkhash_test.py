@@ -70,6 +70,30 @@ def test_hasher_zero():
     assert h1.hexdigest() == h2.hexdigest()
 
 
+def test_hasher_block_digests():
+    data = (b"data\n").ljust(blkhash.BLOCK_SIZE, b"\0")
+    zero = b"\0" * blkhash.BLOCK_SIZE
+    last = b"last\n"
+
+    h1 = blkhash.Hash()
+    h1.update(data)
+    h1.zero(len(zero))
+    h1.update(last)
+
+    # Block digests can be computed separately (e.g. in another thread),
+    # and combined later in the order of the blocks.
+    h2 = blkhash.Hash()
+    digests = [
+        h2.block_digest(data),
+        h2.zero_digest(len(zero)),
+        h2.block_digest(last),
+    ]
+    for block_digest in digests:
+        h2.update_digest(block_digest)
+
+    assert h1.hexdigest() == h2.hexdigest()
+
+
 @pytest.mark.parametrize("size,algorithm,digest_size,checksum", [
     # Files aligned to block size.
     (4 * 1024**2, "blake2b", 32,
@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import time
+
+import pytest
+
+from ovirt_imageio._internal import bufpool
+from ovirt_imageio._internal import errors
+from ovirt_imageio._internal import util
+
+
+def test_unlimited():
+    pool = bufpool.Pool()
+    buf = pool.acquire(4096)
+    assert len(buf) == 4096
+    assert pool.stats()["size"] == 4096
+    assert pool.stats()["leased"] == 4096
+
+    # Released buffer is freed.
+    pool.release(buf)
+    assert buf.closed
+    assert pool.stats()["size"] == 0
+    assert pool.stats()["leased"] == 0
+    assert pool.stats()["free"] == 0
+
+
+def test_reuse():
+    pool = bufpool.Pool(max_size=8192)
+    with pool.lease(4096) as b1:
+        pass
+    assert pool.stats()["free"] == 1
+
+    # Released buffer is reused.
+    with pool.lease(4096) as b2:
+        assert b2 is b1
+        assert pool.stats()["leased"] == 4096
+        assert pool.stats()["free"] == 0
+
+    assert not b1.closed
+    assert pool.stats()["size"] == 4096
+
+
+def test_evict_free_buffers():
+    pool = bufpool.Pool(max_size=8192)
+    with pool.lease(4096) as b1, pool.lease(4096):
+        pass
+    assert pool.stats()["free"] == 2
+
+    # Free buffers of another size are freed to make room.
+    with pool.lease(8192) as b2:
+        assert len(b2) == 8192
+        assert b1.closed
+        assert pool.stats()["free"] == 0
+        assert pool.stats()["size"] == 8192
+
+
+def test_timeout():
+    pool = bufpool.Pool(max_size=8192, timeout=0.1)
+    with pool.lease(8192):
+        start = time.monotonic()
+        with pytest.raises(errors.BufferPoolTimeout):
+            pool.acquire(4096)
+        assert time.monotonic() - start >= 0.1
+
+    stats = pool.stats()
+    assert stats["waits"] == 1
+    assert stats["wait_seconds"] >= 0.1
+    assert stats["leased"] == 0
+
+
+def test_no_wait():
+    pool = bufpool.Pool(max_size=4096)
+    with pool.lease(4096):
+        with pytest.raises(errors.BufferPoolTimeout):
+            pool.acquire(4096, timeout=0)
+    assert pool.stats()["waits"] == 0
+
+
+def test_wait_for_release():
+    pool = bufpool.Pool(max_size=4096, timeout=10)
+    b1 = pool.acquire(4096)
+
+    def release():
+        time.sleep(0.1)
+        pool.release(b1)
+
+    t = util.start_thread(release)
+    try:
+        with pool.lease(4096) as b2:
+            assert b2 is b1
+    finally:
+        t.join()
+
+    assert pool.stats()["waits"] == 1
+
+
+def test_too_large():
+    pool = bufpool.Pool(max_size=4096)
+    with pytest.raises(errors.BufferTooLarge):
+        pool.acquire(8192)
+
+
+def test_configure():
+    pool = bufpool.Pool(max_size=8192)
+    with pool.lease(4096) as buf:
+        pass
+
+    # Reconfiguring frees cached buffers.
+    pool.configure(0, 60)
+    assert buf.closed
+    assert pool.stats()["max_size"] == 0
+    assert pool.stats()["size"] == 0
+
+
+def test_clear_exported_buffer():
+    pool = bufpool.Pool(max_size=8192)
+    with pool.lease(4096) as buf:
+        view = memoryview(buf)
+
+    # The buffer cannot be closed while the view is alive, but it is removed
+    # from the pool.
+    pool.clear()
+    assert pool.stats()["size"] == 0
+    assert pool.stats()["free"] == 0
+    view.release()
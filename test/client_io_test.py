@@ -7,6 +7,7 @@ import pytest
 from urllib.parse import urlparse
 
 from ovirt_imageio._internal import extent
+from ovirt_imageio._internal import io
 from ovirt_imageio._internal import qemu_img
 from ovirt_imageio._internal import qemu_nbd
 from ovirt_imageio._internal.backends import nbd, memory
@@ -233,6 +234,67 @@ def test_copy_dirty_progress():
     assert sum(p.updates) == len(dst_backing)
 
 
+class ZeroRangesBackend(memory.Backend):
+    """
+    Memory backend zeroing multiple ranges in one call.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def zero_ranges(self, ranges):
+        self.calls.append(ranges)
+        for offset, length in ranges:
+            self.seek(offset)
+            self.zero(length)
+
+
+@pytest.mark.parametrize("max_ranges,calls", [
+    (128, [((1 * CHUNK_SIZE, CHUNK_SIZE), (3 * CHUNK_SIZE, CHUNK_SIZE))]),
+    (1, [((1 * CHUNK_SIZE, CHUNK_SIZE),), ((3 * CHUNK_SIZE, CHUNK_SIZE),)]),
+])
+def test_copy_data_zero_ranges(monkeypatch, max_ranges, calls):
+    monkeypatch.setattr(io, "MAX_ZERO_RANGES", max_ranges)
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("A0C-"),
+        extents={"zero": create_zero_extents("A0C-")},
+    )
+    dst_backing = create_backing("XXXX")
+    dst = ZeroRangesBackend("r+", data=dst_backing)
+
+    p = FakeProgress()
+    _io.copy(src, dst, max_workers=1, progress=p)
+
+    # Zero extents are zeroed together.
+    assert dst.calls == calls
+    assert dst_backing == create_backing("A0C0")
+    assert sum(p.updates) == len(dst_backing)
+
+
+def test_copy_dirty_zero_ranges():
+    src = memory.Backend(
+        mode="r",
+        data=create_backing("A0C0"),
+        extents={"dirty": [
+            extent.DirtyExtent(0 * CHUNK_SIZE, CHUNK_SIZE, True, False),
+            extent.DirtyExtent(1 * CHUNK_SIZE, CHUNK_SIZE, True, True),
+            extent.DirtyExtent(2 * CHUNK_SIZE, CHUNK_SIZE, False, False),
+            extent.DirtyExtent(3 * CHUNK_SIZE, CHUNK_SIZE, True, True),
+        ]},
+    )
+    dst_backing = create_backing("XXXX")
+    dst = ZeroRangesBackend("r+", data=dst_backing)
+
+    _io.copy(src, dst, dirty=True, max_workers=1)
+
+    # Dirty zero extents are zeroed together, clean extents are skipped.
+    assert dst.calls == [
+        ((1 * CHUNK_SIZE, CHUNK_SIZE), (3 * CHUNK_SIZE, CHUNK_SIZE))]
+    assert dst_backing == create_backing("A0X0")
+
+
 class BackendError(Exception):
     pass
 
@@ -408,8 +408,8 @@ def test_download_raw(tmpdir, srv, fmt):
     # When we download raw data, we can convert it on-the-fly to other format.
     client.download(url, dst, srv.config.tls.ca_file, fmt=fmt)
 
-    # file backend does not support extents, so downloaded data is always
-    # fully allocated.
+    # file backend reports holes as zero extents, so unallocated areas are not
+    # downloaded.
     qemu_img.compare(src, dst, format1="raw", format2=fmt)
 
 
@@ -534,6 +534,82 @@ def test_download_shallow(srv, nbd_server, tmpdir, base_fmt):
         src_top, dst_top, format1="qcow2", format2="qcow2", strict=True)
 
 
+@pytest.mark.parametrize("fmt", ["raw", "qcow2"])
+def test_upload_delta(tmpdir, srv, fmt):
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 4 * block_size
+
+    src = str(tmpdir.join("src"))
+    qemu_img.create(src, fmt, size=size)
+    with qemu_nbd.open(src, fmt) as c:
+        c.write(0, b"a" * block_size)
+        c.write(2 * block_size, b"b" * block_size)
+        c.flush()
+
+    # Destination differs in the second block (data instead of zeroes) and
+    # in the third block (different data).
+    dst = str(tmpdir.join("dst"))
+    with open(dst, "wb") as f:
+        f.write(b"a" * block_size)
+        f.write(b"x" * block_size)
+        f.write(b"y" * block_size)
+        f.truncate(size)
+
+    url = prepare_transfer(srv, "file://" + dst, size=size)
+    progress = FakeProgress()
+
+    client.upload_delta(
+        src, url, srv.config.tls.ca_file, block_size=block_size,
+        progress=progress)
+
+    qemu_img.compare(src, dst, format1=fmt, format2="raw")
+    assert progress.size == size
+    assert sum(progress.updates) == size
+
+
+@pytest.mark.parametrize("fmt", ["raw", "qcow2"])
+def test_download_delta(tmpdir, srv, fmt):
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 4 * block_size
+
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.write(b"a" * block_size)
+        f.seek(2 * block_size)
+        f.write(b"b" * block_size)
+        f.truncate(size)
+
+    dst = str(tmpdir.join("dst"))
+    qemu_img.create(dst, fmt, size=size)
+    with qemu_nbd.open(dst, fmt) as c:
+        c.write(0, b"a" * block_size)
+        c.write(block_size, b"x" * block_size)
+        c.write(2 * block_size, b"y" * block_size)
+        c.flush()
+
+    url = prepare_transfer(srv, "file://" + src, size=size)
+
+    client.download_delta(url, dst, srv.config.tls.ca_file,
+                          block_size=block_size)
+
+    qemu_img.compare(src, dst, format1="raw", format2=fmt)
+
+
+def test_upload_delta_size_mismatch(tmpdir, srv):
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.truncate(IMAGE_SIZE)
+
+    dst = str(tmpdir.join("dst"))
+    with open(dst, "wb") as f:
+        f.truncate(IMAGE_SIZE * 2)
+
+    url = prepare_transfer(srv, "file://" + dst, size=IMAGE_SIZE * 2)
+
+    with pytest.raises(RuntimeError):
+        client.upload_delta(src, url, srv.config.tls.ca_file)
+
+
 def test_upload_proxy_url(tmpdir, srv):
     src = str(tmpdir.join("src"))
     with open(src, "wb") as f:
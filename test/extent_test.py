@@ -0,0 +1,242 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import pytest
+
+from ovirt_imageio._internal import extent
+from ovirt_imageio._internal.backends import memory
+
+from ovirt_imageio._internal.extent import ZeroExtent
+
+
+class Backend(memory.Backend):
+    """
+    Memory backend counting extents calls.
+    """
+
+    def __init__(self, extents):
+        size = extents[-1].start + extents[-1].length
+        super().__init__(data=bytearray(size), extents={"zero": extents})
+        self.calls = 0
+
+    def extents(self, context="zero", start=0, length=None):
+        self.calls += 1
+        return super().extents(context=context, start=start, length=length)
+
+
+@pytest.mark.parametrize("start,length,expected", [
+    (0, None, [(0, 4096), (4096, 4096)]),
+    (1024, None, [(1024, 3072), (4096, 4096)]),
+    (1024, 1024, [(1024, 1024)]),
+    (4096, 4096, [(4096, 4096)]),
+    (2048, 4096, [(2048, 2048), (4096, 2048)]),
+    (8192, None, []),
+    (1024, 0, []),
+])
+def test_clip(start, length, expected):
+    extents = [
+        ZeroExtent(0, 4096, False, False),
+        ZeroExtent(4096, 4096, True, False),
+    ]
+    assert [(e.start, e.length)
+            for e in extent.clip(extents, start, length)] == expected
+
+
+def test_cache_miss():
+    backend = Backend([
+        ZeroExtent(0, 4096, False, False),
+        ZeroExtent(4096, 4096, True, False),
+    ])
+    cache = extent.Cache()
+
+    # Extents are cached only after iterating over all extents.
+    assert list(cache.extents(backend)) == backend._extents["zero"]
+    assert backend.calls == 1
+
+    assert list(cache.extents(backend)) == backend._extents["zero"]
+    assert backend.calls == 1
+
+
+def test_cache_range():
+    backend = Backend([
+        ZeroExtent(0, 4096, False, False),
+        ZeroExtent(4096, 4096, True, False),
+        ZeroExtent(8192, 4096, False, False),
+    ])
+    cache = extent.Cache()
+
+    # Range request is not cached.
+    assert list(cache.extents(backend, start=2048, length=4096)) == [
+        ZeroExtent(2048, 2048, False, False),
+        ZeroExtent(4096, 2048, True, False),
+    ]
+    assert backend.calls == 1
+
+    list(cache.extents(backend))
+    assert backend.calls == 2
+
+    # Range request is served from the cache.
+    assert list(cache.extents(backend, start=2048, length=4096)) == [
+        ZeroExtent(2048, 2048, False, False),
+        ZeroExtent(4096, 2048, True, False),
+    ]
+    assert list(cache.extents(backend, start=8192)) == [
+        ZeroExtent(8192, 4096, False, False),
+    ]
+    assert backend.calls == 2
+
+
+def test_cache_partial_iteration():
+    backend = Backend([
+        ZeroExtent(0, 4096, False, False),
+        ZeroExtent(4096, 4096, True, False),
+    ])
+    cache = extent.Cache()
+
+    # Extents are not cached if the caller did not get all extents.
+    next(iter(cache.extents(backend)))
+    list(cache.extents(backend))
+    assert backend.calls == 2
+
+
+@pytest.mark.parametrize("start,length,zero,expected", [
+    # Write data into zero extent.
+    (5120, 1024, False, [
+        (0, 4096, False),
+        (4096, 1024, True),
+        (5120, 1024, False),
+        (6144, 2048, True),
+        (8192, 4096, False),
+    ]),
+    # Write data at start of zero extent, merged with previous extent.
+    (4096, 1024, False, [
+        (0, 5120, False),
+        (5120, 3072, True),
+        (8192, 4096, False),
+    ]),
+    # Write data over all zero extent, merging all extents.
+    (4096, 4096, False, [
+        (0, 12288, False),
+    ]),
+    # Zero range spanning multiple extents.
+    (2048, 8192, True, [
+        (0, 2048, False),
+        (2048, 8192, True),
+        (10240, 2048, False),
+    ]),
+    # Zero entire image.
+    (0, 12288, True, [
+        (0, 12288, True),
+    ]),
+    # Write zero length does not change anything.
+    (4096, 0, False, [
+        (0, 4096, False),
+        (4096, 4096, True),
+        (8192, 4096, False),
+    ]),
+])
+def test_cache_write(start, length, zero, expected):
+    backend = Backend([
+        ZeroExtent(0, 4096, False, False),
+        ZeroExtent(4096, 4096, True, False),
+        ZeroExtent(8192, 4096, False, False),
+    ])
+    cache = extent.Cache()
+    list(cache.extents(backend))
+
+    cache.start_write()
+    cache.end_write(start, length, zero=zero)
+
+    # Cached extents were patched.
+    assert list(cache.extents(backend)) == [
+        ZeroExtent(s, n, z, False) for s, n, z in expected
+    ]
+    assert backend.calls == 1
+
+
+def test_cache_write_after_end():
+    backend = Backend([ZeroExtent(0, 8192, True, False)])
+    cache = extent.Cache()
+    list(cache.extents(backend))
+
+    # Write after the end of the image drops the cache.
+    cache.start_write()
+    cache.end_write(4096, 8192)
+
+    list(cache.extents(backend))
+    assert backend.calls == 2
+
+
+def test_cache_write_failed():
+    backend = Backend([ZeroExtent(0, 8192, True, False)])
+    cache = extent.Cache()
+    list(cache.extents(backend))
+
+    # Failed write drops the cache.
+    cache.start_write()
+    cache.end_write(0, 4096, completed=False)
+
+    list(cache.extents(backend))
+    assert backend.calls == 2
+
+
+def test_cache_ongoing_write():
+    backend = Backend([ZeroExtent(0, 8192, True, False)])
+    cache = extent.Cache()
+    list(cache.extents(backend))
+
+    cache.start_write()
+
+    # Extents are not returned from the cache or cached during a write.
+    list(cache.extents(backend))
+    list(cache.extents(backend))
+    assert backend.calls == 3
+
+    cache.end_write(0, 4096)
+
+    assert list(cache.extents(backend)) == [
+        ZeroExtent(0, 4096, False, False),
+        ZeroExtent(4096, 4096, True, False),
+    ]
+    assert backend.calls == 3
+
+
+def test_cache_write_while_getting_extents():
+    backend = Backend([ZeroExtent(0, 8192, True, False)])
+    cache = extent.Cache()
+
+    # Extents received before a write are not cached after the write.
+    it = iter(cache.extents(backend))
+    next(it)
+    cache.start_write()
+    cache.end_write(0, 4096)
+    list(it)
+
+    list(cache.extents(backend))
+    assert backend.calls == 2
+
+
+def test_cache_disable():
+    backend = Backend([ZeroExtent(0, 8192, True, False)])
+    cache = extent.Cache()
+    it = iter(cache.extents(backend))
+    next(it)
+
+    # Extents received before disabling the cache are not cached.
+    cache.disable()
+    list(it)
+
+    for i in range(2):
+        list(cache.extents(backend))
+    assert backend.calls == 3
+
+
+def test_cache_clear():
+    backend = Backend([ZeroExtent(0, 8192, True, False)])
+    cache = extent.Cache()
+    list(cache.extents(backend))
+
+    cache.clear()
+
+    list(cache.extents(backend))
+    assert backend.calls == 2
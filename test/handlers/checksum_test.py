@@ -5,14 +5,22 @@ import hashlib
 import json
 import os
 
+from urllib.parse import urlencode
+
 import userstorage
 import pytest
 
+from ovirt_imageio._internal import auth
 from ovirt_imageio._internal import blkhash
+from ovirt_imageio._internal import bufpool
 from ovirt_imageio._internal import config
+from ovirt_imageio._internal import extent
 from ovirt_imageio._internal import qemu_img
 from ovirt_imageio._internal import qemu_nbd
 from ovirt_imageio._internal import server
+from ovirt_imageio._internal import util
+from ovirt_imageio._internal.backends import memory
+from ovirt_imageio._internal.handlers import checksum
 
 from .. import testutil
 from .. import http
@@ -148,6 +156,22 @@ def test_user_block_size_invalid(srv, client, block_size):
     assert res.status == 400
 
 
+def test_user_block_size_too_large(srv, client, tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        bufpool, "_pool", bufpool.Pool(max_size=blkhash.BLOCK_SIZE))
+
+    img = str(tmpdir.join("file"))
+    with open(img, "wb") as f:
+        f.truncate(1024**2)
+    ticket = testutil.create_ticket(url="file://" + img, size=1024**2)
+    srv.auth.add(ticket)
+
+    res = client.request("GET", "/images/{}/checksum?block_size={}"
+                         .format(ticket["uuid"], blkhash.BLOCK_SIZE * 2))
+    res.read()
+    assert res.status == 413
+
+
 @pytest.mark.parametrize("fmt,compressed", [
     ("raw", False),
     ("qcow2", False),
@@ -234,3 +258,165 @@ def test_checksum_algorithms(srv, client, tmpdir):
 
     res = json.loads(data)
     assert res == {"algorithms": sorted(ALGORITHMS)}
+
+
+@pytest.mark.parametrize("offset,length", [
+    (None, None),
+    (0, None),
+    (blkhash.BLOCK_SIZE // 4, None),
+    (0, blkhash.BLOCK_SIZE // 4 * 2 + 4096),
+    (blkhash.BLOCK_SIZE // 4 * 3, 0),
+])
+def test_map(srv, client, tmpdir, offset, length):
+    block_size = blkhash.BLOCK_SIZE // 4
+    size = 3 * block_size
+
+    img = str(tmpdir.join("file"))
+    with open(img, "wb") as f:
+        f.truncate(size)
+        f.seek(block_size)
+        f.write(b"data")
+
+    ticket = testutil.create_ticket(url="file://" + img, size=size)
+    srv.auth.add(ticket)
+
+    query = {"block_size": block_size}
+    if offset is not None:
+        query["offset"] = offset
+    if length is not None:
+        query["length"] = length
+
+    res = client.request("GET", "/images/{}/checksum/map?{}".format(
+        ticket["uuid"], urlencode(query)))
+    data = res.read()
+    assert res.status == 200
+
+    start = offset or 0
+    end = size if length is None else start + length
+
+    # Compute expected block digests.
+    h = checksum.new_hash(blkhash.ALGORITHM, block_size)
+    digests = []
+    with open(img, "rb") as f:
+        for pos in range(start, end, block_size):
+            f.seek(pos)
+            block = f.read(min(block_size, end - pos))
+            digests.append(h.block_digest(block).hex())
+
+    res = json.loads(data)
+    assert res == {
+        "algorithm": blkhash.ALGORITHM,
+        "block_size": block_size,
+        "offset": start,
+        "length": end - start,
+        "digests": digests,
+    }
+
+
+@pytest.mark.parametrize("query,status", [
+    ("offset=invalid", 400),
+    ("offset=-4096", 400),
+    ("offset=4096", 400),
+    ("offset=8388608", 416),
+    ("length=invalid", 400),
+    ("length=1048577", 416),
+    ("block_size=4097", 400),
+    ("algorithm=invalid", 400),
+])
+def test_map_invalid(srv, client, tmpdir, query, status):
+    size = 1024**2
+    img = str(tmpdir.join("file"))
+    with open(img, "wb") as f:
+        f.truncate(size)
+
+    ticket = testutil.create_ticket(url="file://" + img, size=size)
+    srv.auth.add(ticket)
+
+    res = client.request("GET", "/images/{}/checksum/map?{}".format(
+        ticket["uuid"], query))
+    res.read()
+    assert res.status == status
+
+
+def test_map_workers():
+    block_size = blkhash.BLOCK_SIZE // 4
+    data = bytearray(os.urandom(5 * block_size + 4096))
+    data[block_size:2 * block_size] = bytes(block_size)
+    backend = memory.Backend("r", data)
+
+    expected = checksum.compute_map(backend, bytearray(block_size))
+    assert len(expected["digests"]) == 6
+
+    with util.aligned_buffer(block_size) as buf:
+        res = checksum.compute_map(backend, buf, workers=4)
+
+    assert res == expected
+
+
+@pytest.mark.parametrize("workers", [2, 4, 8])
+@pytest.mark.parametrize("size", [
+    pytest.param(blkhash.BLOCK_SIZE // 4 * 10, id="aligned"),
+    pytest.param(blkhash.BLOCK_SIZE // 4 * 10 + 4096, id="unaligned"),
+])
+def test_operation_workers(workers, size):
+    block_size = blkhash.BLOCK_SIZE // 4
+    data = bytearray(size)
+    extents = []
+
+    # Mix data, zero, and data extents containing only zeroes.
+    for i, start in enumerate(range(0, size, block_size)):
+        length = min(block_size, size - start)
+        if i % 3 == 0:
+            data[start:start + length] = os.urandom(length)
+            extents.append(extent.ZeroExtent(start, length, False, False))
+        elif i % 3 == 1:
+            extents.append(extent.ZeroExtent(start, length, True, False))
+        else:
+            extents.append(extent.ZeroExtent(start, length, False, False))
+
+    backend = memory.Backend("r", data, extents={"zero": extents})
+    expected = checksum.compute(backend, bytearray(block_size))
+
+    with util.aligned_buffer(block_size) as buf:
+        res = checksum.compute(backend, buf, workers=workers)
+
+    assert res == expected
+
+
+def test_operation_workers_read_error():
+
+    class Error(Exception):
+        pass
+
+    class Backend(memory.Backend):
+        def readinto(self, buf):
+            if self.tell() == 4 * 1024**2:
+                raise Error
+            return super().readinto(buf)
+
+    backend = Backend("r", bytearray(8 * 1024**2))
+    with util.aligned_buffer(1024**2) as buf:
+        with pytest.raises(Error):
+            checksum.compute(backend, buf, workers=4)
+
+
+@pytest.mark.parametrize("checksum_workers,connections,expected", [
+    # Workers disabled by configuration.
+    (1, 1, 1),
+    # Every worker uses its own connection.
+    (4, 1, 4),
+    # Limited by connections used by other clients.
+    (4, 6, 2),
+    # No connection available for workers.
+    (4, 7, 1),
+])
+def test_workers(checksum_workers, connections, expected):
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.daemon.checksum_workers = checksum_workers
+    ticket = auth.Ticket(testutil.create_ticket(ops=["read"]), cfg)
+    backend = memory.Backend("r", bytearray(4096), max_connections=8)
+    for con_id in range(connections):
+        ticket.add_context(con_id, backend)
+
+    with checksum._workers(cfg, ticket, backend) as workers:
+        assert workers == expected
@@ -9,7 +9,9 @@ import userstorage
 import pytest
 
 from ovirt_imageio._internal import config
+from ovirt_imageio._internal import extent
 from ovirt_imageio._internal import server
+from ovirt_imageio._internal.handlers import extents as handler
 
 from .. import testutil
 from .. import http
@@ -96,9 +98,24 @@ def test_file_zero(srv, client, user_file, fmt, path):
     assert res.status == 200
 
     extents = json.loads(data.decode("utf-8"))
-    assert extents == [
-        {"start": 0, "length": size, "zero": False, "hole": False}
-    ]
+
+    if fmt == "raw":
+        # Empty raw image is a hole, reported as zero extent.
+        assert extents == [
+            {"start": 0, "length": size, "zero": True, "hole": False}
+        ]
+    else:
+        # qcow2 image starts with allocated metadata.
+        assert extents[0]["start"] == 0
+        assert not extents[0]["zero"]
+
+    # Extents cover the entire file.
+    start = 0
+    for ext in extents:
+        assert ext["start"] == start
+        assert not ext["hole"]
+        start += ext["length"]
+    assert start == size
 
 
 def test_file_ticket_not_dirty(srv, client, tmpfile):
@@ -127,3 +144,219 @@ def test_file_does_not_support_dirty(srv, client, tmpfile):
         "GET", "/images/%(uuid)s/extents?context=dirty" % ticket)
     res.read()
     assert res.status == 404
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("", [(0, 65536)]),
+    ("?start=0", [(0, 65536)]),
+    ("?start=4096", [(4096, 61440)]),
+    ("?start=4096&length=8192", [(4096, 8192)]),
+    ("?length=8192", [(0, 8192)]),
+    ("?start=65536", []),
+    ("?start=4096&length=0", []),
+])
+def test_file_zero_range(srv, client, tmpfile, query, expected):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request("GET", "/images/%(uuid)s/extents" % ticket + query)
+    data = res.read()
+    assert res.status == 200
+
+    # Empty file is a hole, reported as zero extent.
+    extents = json.loads(data.decode("utf-8"))
+    assert extents == [
+        {"start": start, "length": length, "zero": True, "hole": False}
+        for start, length in expected
+    ]
+
+
+@pytest.mark.parametrize("query,status", [
+    ("?start=-1", 400),
+    ("?start=invalid", 400),
+    ("?length=-1", 400),
+    ("?length=invalid", 400),
+    ("?start=65537", 416),
+    ("?start=4096&length=61441", 416),
+])
+def test_file_zero_range_invalid(srv, client, tmpfile, query, status):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request("GET", "/images/%(uuid)s/extents" % ticket + query)
+    res.read()
+    assert res.status == status
+
+
+def test_chunked(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    # Extents are streamed to the client as they are computed.
+    res = client.request("GET", "/images/%(uuid)s/extents" % ticket)
+    data = res.read()
+    assert res.status == 200
+    assert res.getheader("transfer-encoding") == "chunked"
+    assert res.getheader("content-type") == "application/json"
+    assert data.endswith(b"\n")
+    json.loads(data.decode("utf-8"))
+
+
+@pytest.mark.parametrize("count", [0, 1, 100])
+def test_json_chunks(count):
+    extents = [
+        extent.ZeroExtent(i * 4096, 4096, bool(i % 2), False)
+        for i in range(count)
+    ]
+
+    # Use tiny chunks to test splitting extents to multiple chunks.
+    chunks = list(handler._json_chunks(iter(extents), chunk_size=256))
+    assert all(chunks)
+    if count > 10:
+        assert len(chunks) > 1
+
+    # Same content as json.dumps() of the entire list.
+    expected = json.dumps([ext.to_dict() for ext in extents]) + "\n"
+    assert b"".join(chunks).decode("utf-8") == expected
+
+
+@pytest.mark.parametrize("query,headers", [
+    pytest.param("?format=binary", {}, id="query"),
+    pytest.param(
+        "", {"accept": "application/octet-stream"}, id="accept"),
+    pytest.param(
+        "?format=binary", {"accept": "application/json"}, id="query-wins"),
+])
+def test_file_zero_binary(srv, client, tmpfile, query, headers):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents" % ticket + query, headers=headers)
+    data = res.read()
+    assert res.status == 200
+    assert res.getheader("content-type") == "application/octet-stream"
+
+    extents = list(extent.unpack(extent.ZeroExtent, data))
+    assert extents == [extent.ZeroExtent(0, 65536, True, False)]
+
+
+def test_file_zero_json_format(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?format=json" % ticket,
+        headers={"accept": "application/octet-stream"})
+    data = res.read()
+    assert res.status == 200
+    assert res.getheader("content-type") == "application/json"
+    assert json.loads(data) == [
+        {"start": 0, "length": 65536, "zero": True, "hole": False}
+    ]
+
+
+def test_invalid_format(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?format=xml" % ticket)
+    res.read()
+    assert res.status == 400
+
+
+@pytest.mark.parametrize("cls,extents", [
+    (extent.ZeroExtent, [
+        extent.ZeroExtent(i * 4096, 4096, bool(i % 2), bool(i % 3 == 0))
+        for i in range(100)
+    ]),
+    (extent.DirtyExtent, [
+        extent.DirtyExtent(i * 4096, 4096, bool(i % 2), bool(i % 3 == 0))
+        for i in range(100)
+    ]),
+    (extent.ZeroExtent, []),
+])
+def test_binary_chunks(cls, extents):
+    # Use tiny chunks to test splitting extents to multiple chunks.
+    chunks = list(handler._binary_chunks(iter(extents), chunk_size=256))
+    assert all(chunks)
+
+    data = b"".join(chunks)
+    assert len(data) == len(extents) * extent.RECORD.size
+    assert data == extent.pack(extents)
+    assert list(extent.unpack(cls, data)) == extents
+
+
+def test_unpack_invalid_size():
+    data = extent.pack([extent.ZeroExtent(0, 4096, True, False)])
+    with pytest.raises(ValueError):
+        list(extent.unpack(extent.ZeroExtent, data[:-1]))
+
+
+def test_cache_updated_by_writes(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    path = "/images/%(uuid)s/extents" % ticket
+
+    def get_extents():
+        res = client.get(path)
+        data = res.read()
+        assert res.status == 200
+        return [(e["start"], e["length"], e["zero"])
+                for e in json.loads(data)]
+
+    assert get_extents() == [(0, 65536, True)]
+
+    # Extents are cached in the ticket and updated by writes.
+    res = client.put(
+        "/images/%(uuid)s" % ticket, b"x" * 8192,
+        headers={"content-range": "bytes 8192-16383/*"})
+    res.read()
+    assert res.status == 200
+
+    assert get_extents() == [
+        (0, 8192, True),
+        (8192, 8192, False),
+        (16384, 49152, True),
+    ]
+
+    msg = {"op": "zero", "offset": 8192, "size": 4096}
+    res = client.patch("/images/%(uuid)s" % ticket, json.dumps(msg))
+    res.read()
+    assert res.status == 200
+
+    assert get_extents() == [
+        (0, 12288, True),
+        (12288, 4096, False),
+        (16384, 49152, True),
+    ]
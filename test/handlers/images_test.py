@@ -9,6 +9,7 @@ import time
 import pytest
 
 from ovirt_imageio._internal import config
+from ovirt_imageio._internal import ops
 from ovirt_imageio._internal import server
 
 from .. import testutil
@@ -22,8 +23,8 @@ CONNECTION_CLOSED = (
 )
 
 
-BASE_FEATURES = {"checksum", "extents"}
-ALL_FEATURES = BASE_FEATURES | {"zero", "flush"}
+BASE_FEATURES = {"checksum", "extents", "extents_binary"}
+ALL_FEATURES = BASE_FEATURES | {"zero", "flush", "zero_ranges"}
 
 
 @pytest.fixture(scope="module")
@@ -141,6 +142,61 @@ def test_upload(tmpdir, srv, client, flush):
     assert res.getheader("content-length") == "0"
 
 
+@pytest.mark.parametrize("option", [False, True])
+def test_upload_zero_copy(tmpdir, srv, client, monkeypatch, option):
+    # Receiving uploads using splice() writes via the page cache, so it must
+    # be enabled explicitly.
+    monkeypatch.setattr(srv.config.daemon, "zero_copy_upload", option)
+    calls = []
+
+    class Write(ops.Write):
+        def __init__(self, *args, zero_copy=False, **kwargs):
+            calls.append(zero_copy)
+            super().__init__(*args, zero_copy=zero_copy, **kwargs)
+
+    monkeypatch.setattr(ops, "Write", Write)
+
+    data = b"x" * 8192
+    image = testutil.create_tempfile(tmpdir, "image", bytes(len(data)))
+    ticket = testutil.create_ticket(url="file://" + str(image))
+    srv.auth.add(ticket)
+    res = client.put("/images/" + ticket["uuid"], data)
+    assert res.status == 200
+    assert calls == [option]
+    with io.open(str(image), "rb") as f:
+        assert f.read() == data
+
+
+def test_zero_copy_default():
+    # Zero copy reads and writes via the page cache, so it is disabled by
+    # default.
+    cfg = config.load(["test/conf/daemon.conf"])
+    assert not cfg.daemon.zero_copy
+    assert not cfg.daemon.zero_copy_upload
+
+
+@pytest.mark.parametrize("option", [False, True])
+def test_download_zero_copy(tmpdir, srv, client, monkeypatch, option):
+    monkeypatch.setattr(srv.config.daemon, "zero_copy", option)
+    calls = []
+
+    class Read(ops.Read):
+        def __init__(self, *args, zero_copy=False, **kwargs):
+            calls.append(zero_copy)
+            super().__init__(*args, zero_copy=zero_copy, **kwargs)
+
+    monkeypatch.setattr(ops, "Read", Read)
+
+    data = b"x" * 8192
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=8192)
+    srv.auth.add(ticket)
+    res = client.get("/images/" + ticket["uuid"])
+    assert res.read() == data
+    assert res.status == 200
+    assert calls == [option]
+
+
 def test_upload_invalid_flush(tmpdir, srv, client):
     ticket = testutil.create_ticket(url="file:///no/such/image")
     srv.auth.add(ticket)
@@ -600,6 +656,70 @@ def test_zero_validation(srv, client, msg):
     assert res.status == 400
 
 
+@pytest.mark.parametrize("flush", [True, False])
+def test_zero_ranges(tmpdir, srv, client, flush):
+    data = b"x" * 4096
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image))
+    srv.auth.add(ticket)
+    msg = {
+        "op": "zero",
+        "ranges": [
+            {"offset": 0, "size": 512},
+            {"offset": 1024, "size": 512},
+            {"offset": 4000, "size": 96},
+        ],
+        "flush": flush,
+    }
+    body = json.dumps(msg).encode("ascii")
+    res = client.patch("/images/" + ticket["uuid"], body)
+
+    assert res.status == 200
+    assert res.getheader("content-length") == "0"
+    with io.open(str(image), "rb") as f:
+        assert f.read() == (
+            b"\0" * 512 + b"x" * 512 +
+            b"\0" * 512 + b"x" * 2464 +
+            b"\0" * 96)
+
+
+def test_zero_ranges_out_of_range(tmpdir, srv, client):
+    data = b"x" * 4096
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=4096)
+    srv.auth.add(ticket)
+    msg = {
+        "op": "zero",
+        "ranges": [
+            {"offset": 0, "size": 512},
+            {"offset": 4096, "size": 512},
+        ],
+    }
+    body = json.dumps(msg).encode("ascii")
+    res = client.patch("/images/" + ticket["uuid"], body)
+    assert res.status == 416
+
+    # Nothing was zeroed.
+    with io.open(str(image), "rb") as f:
+        assert f.read() == data
+
+
+@pytest.mark.parametrize("msg", [
+    {"op": "zero", "ranges": "not a list"},
+    {"op": "zero", "ranges": ["not a dict"]},
+    {"op": "zero", "ranges": [{"offset": 0}]},
+    {"op": "zero", "ranges": [{"size": 1}]},
+    {"op": "zero", "ranges": [{"offset": -1, "size": 1}]},
+    {"op": "zero", "ranges": [{"offset": 0, "size": -1}]},
+    {"op": "zero", "ranges": [{"offset": 0, "size": 1}] * 1025},
+    {"op": "zero", "ranges": [{"offset": 0, "size": 1}], "flush": "no"},
+])
+def test_zero_ranges_validation(srv, client, msg):
+    body = json.dumps(msg).encode("ascii")
+    res = client.patch("/images/no-such-uuid", body)
+    assert res.status == 400
+
+
 def test_zero_no_ticket_id(srv, client):
     body = json.dumps({"op": "zero", "size": 1}).encode("ascii")
     res = client.patch("/images/", body)
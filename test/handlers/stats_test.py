@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+
+import pytest
+
+from ovirt_imageio._internal import config
+from ovirt_imageio._internal import server
+
+from .. import http
+
+
+@pytest.fixture(scope="module")
+def srv():
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.daemon.max_workers = 2
+    s = server.Server(cfg)
+    s.start()
+    yield s
+    s.stop()
+
+
+def get_stats(srv):
+    with http.ControlClient(srv.config) as c:
+        res = c.get("/stats/")
+        data = res.read()
+    assert res.status == 200
+    return json.loads(data)
+
+
+def test_get(srv):
+    with http.RemoteClient(srv.config) as c:
+        res = c.get("/info/")
+        res.read()
+
+    stats = get_stats(srv)
+
+    # Connection waiting time is available while the server is running.
+    pool = stats["remote"]["worker_pool"]
+    assert pool["served"] >= 1
+    assert pool["wait_seconds"] >= 0
+    assert pool["max_wait"] >= 0
+
+    # TLS handshakes are reported with the other remote service stats.
+    handshakes = stats["remote"]["tls_handshakes"]
+    assert handshakes["full"] + handshakes["resumed"] >= 1
+
+    buffer_pool = stats["buffer_pool"]
+    assert buffer_pool["max_size"] == srv.config.daemon.buffer_pool_size
@@ -419,3 +419,117 @@ def test_delete_conflict(srv, tmpdir, monkeypatch):
             res = control_client.delete("/tickets/" + ticket["uuid"])
             res.read()
             assert res.status == 409
+
+
+def copy_request(client, ticket_id, msg):
+    res = client.request(
+        "POST", "/tickets/{}/copy".format(ticket_id),
+        body=json.dumps(msg).encode("utf-8"))
+    res.read()
+    return res
+
+
+def wait_for_job(client, ticket_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        res = client.get("/tickets/" + ticket_id)
+        job = json.loads(res.read())["job"]
+        if job["status"] != "running":
+            return job
+        assert time.monotonic() < deadline, "Timeout waiting for job"
+        time.sleep(0.05)
+
+
+def test_copy(srv, tmpdir):
+    size = 2 * 1024**2
+    data = b"x" * 1024**2 + b"\0" * 512 * 1024 + b"y" * 512 * 1024
+    src_image = testutil.create_tempfile(tmpdir, "src", data)
+    dst_image = testutil.create_tempfile(tmpdir, "dst", size=size)
+    src = testutil.create_ticket(
+        url="file://" + str(src_image), size=size, ops=["read"])
+    dst = testutil.create_ticket(
+        url="file://" + str(dst_image), size=size, ops=["write"])
+    srv.auth.add(src)
+    srv.auth.add(dst)
+
+    with http.ControlClient(srv.config) as c:
+        res = copy_request(c, dst["uuid"], {"src": src["uuid"]})
+        assert res.status == 202
+
+        job = wait_for_job(c, dst["uuid"])
+        assert job == {
+            "type": "copy",
+            "src": src["uuid"],
+            "status": "done",
+            "size": size,
+            "done": size,
+        }
+
+    with open(str(dst_image), "rb") as f:
+        assert f.read() == data
+
+    # Both tickets report the copy.
+    assert srv.auth.get(src["uuid"]).info()["transferred"] == size
+    assert srv.auth.get(dst["uuid"]).info()["transferred"] == size
+
+
+def test_copy_failed(srv, tmpdir):
+    dst_image = testutil.create_tempfile(tmpdir, "dst", size=4096)
+    src = testutil.create_ticket(
+        url="file:///no/such/image", size=4096, ops=["read"])
+    dst = testutil.create_ticket(
+        url="file://" + str(dst_image), size=4096, ops=["write"])
+    srv.auth.add(src)
+    srv.auth.add(dst)
+
+    with http.ControlClient(srv.config) as c:
+        res = copy_request(c, dst["uuid"], {"src": src["uuid"]})
+        assert res.status == 202
+
+        job = wait_for_job(c, dst["uuid"])
+        assert job["status"] == "failed"
+        assert "/no/such/image" in job["error"]
+
+
+def test_copy_no_ticket(srv):
+    src = testutil.create_ticket(ops=["read"])
+    srv.auth.add(src)
+    with http.ControlClient(srv.config) as c:
+        res = copy_request(c, "no-such-ticket", {"src": src["uuid"]})
+        assert res.status == 404
+        res = copy_request(c, src["uuid"], {"src": "no-such-ticket"})
+        assert res.status == 404
+
+
+def test_copy_forbidden(srv):
+    src = testutil.create_ticket(ops=["read"])
+    dst = testutil.create_ticket(ops=["read"])
+    srv.auth.add(src)
+    srv.auth.add(dst)
+    with http.ControlClient(srv.config) as c:
+        res = copy_request(c, dst["uuid"], {"src": src["uuid"]})
+        assert res.status == 403
+
+
+@pytest.mark.parametrize("msg", [
+    {},
+    {"src": 1},
+    {"src": "ticket-id", "zero": "yes"},
+    [],
+])
+def test_copy_invalid_request(srv, msg):
+    dst = testutil.create_ticket(ops=["write"])
+    srv.auth.add(dst)
+    with http.ControlClient(srv.config) as c:
+        res = copy_request(c, dst["uuid"], msg)
+        assert res.status == 400
+
+
+def test_copy_larger_source(srv):
+    src = testutil.create_ticket(ops=["read"], size=8192)
+    dst = testutil.create_ticket(ops=["write"], size=4096)
+    srv.auth.add(src)
+    srv.auth.add(dst)
+    with http.ControlClient(srv.config) as c:
+        res = copy_request(c, dst["uuid"], {"src": src["uuid"]})
+        assert res.status == 400
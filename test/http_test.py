@@ -1,8 +1,10 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import email.utils
 import errno
 import http.client as http_client
+import http.server as http_server
 import io
 import json
 import logging
@@ -15,7 +17,9 @@ from contextlib import contextmanager
 
 import pytest
 
+from ovirt_imageio._internal import ahttp
 from ovirt_imageio._internal import http
+from ovirt_imageio._internal import ssl
 from ovirt_imageio._internal import util
 from ovirt_imageio._internal import version
 
@@ -87,6 +91,47 @@ class JSON:
         resp.send_json(msg)
 
 
+class Chunked:
+
+    def get(self, req, resp):
+        count = int(req.query["count"])
+        resp.send_chunked(
+            (b"chunk %d\n" % i for i in range(count)),
+            content_type="text/plain")
+
+
+class SendFile:
+
+    def get(self, req, resp):
+        path = req.query["path"]
+        offset = int(req.query["offset"])
+        count = int(req.query["count"])
+        if not resp.zero_copy:
+            raise http.Error(http.BAD_REQUEST, "Zero copy not supported")
+
+        resp.headers["content-length"] = count
+        with open(path, "rb") as f:
+            resp.sendfile(f.fileno(), offset, count)
+
+
+class Splice:
+
+    def put(self, req, resp):
+        path = req.query["path"]
+        offset = int(req.query["offset"])
+        if not req.zero_copy:
+            raise http.Error(http.BAD_REQUEST, "Zero copy not supported")
+
+        count = req.length
+        with open(path, "r+b") as f:
+            received = req.splice(f.fileno(), offset, count)
+
+        if received < count:
+            raise http.Error(http.BAD_REQUEST, "Partial content")
+
+        resp.headers["content-length"] = 0
+
+
 class RangeDemo:
     """
     Demonstrate using Range and Content-Range headers.
@@ -311,9 +356,17 @@ def demo_server(address, prefer_ipv4=False):
         t.join()
 
 
-@pytest.fixture(scope="module")
-def server():
-    server = http.Server(("127.0.0.1", 0), http.Connection)
+@pytest.fixture(
+    scope="module",
+    params=[
+        (http.Server, http.Connection),
+        (ahttp.Server, ahttp.Connection),
+    ],
+    ids=["threads", "event-loop"],
+)
+def server(request):
+    server_class, connection_class = request.param
+    server = server_class(("127.0.0.1", 0), connection_class)
     log.info("Server listening on %r", server.server_address)
 
     server.app = http.Router([
@@ -321,7 +374,10 @@ def server():
         (r"/echo-read/(.*)", EchoRead()),
         (r"/echo-readinto/(.*)", EchoReadinto()),
         (r"/json/", JSON()),
+        (r"/chunked/", Chunked()),
         (r"/range-demo/", RangeDemo()),
+        (r"/sendfile/", SendFile()),
+        (r"/splice/", Splice()),
         (r"/request-info/(.*)", RequestInfo()),
         (r"/context/(.*)", Context()),
         (r"/close-context/(.*)", CloseContext()),
@@ -396,6 +452,117 @@ def test_demo_request_length_too_long(server):
         r.read()
 
 
+@pytest.mark.parametrize("request_line,headers,expected", [
+    # HTTP/0.9 request is not supported.
+    (b"GET /demo/name", b"", http.BAD_REQUEST),
+    (b"GET  /demo/name HTTP/1.1", b"", http.BAD_REQUEST),
+    (b"GET /demo/name FTP/1.1", b"", http.BAD_REQUEST),
+    (b"GET /demo/name HTTP/2.0", b"", http.HTTP_VERSION_NOT_SUPPORTED),
+    (b"GET /demo/name HTTP/1.1", b"no-colon\r\n", http.BAD_REQUEST),
+    (b"GET /demo/name HTTP/1.1", b": no-name\r\n", http.BAD_REQUEST),
+    (b"GET /demo/name HTTP/1.1", b"space : x\r\n", http.BAD_REQUEST),
+    # Obsolete line folding is not supported.
+    (b"GET /demo/name HTTP/1.1", b"a: 1\r\n folded\r\n", http.BAD_REQUEST),
+    (b"GET /demo/name HTTP/1.1", b"a: %s\r\n" % (b"x" * 4096),
+     http.REQUEST_HEADER_FIELDS_TOO_LARGE),
+    (b"GET /demo/name HTTP/1.1", b"a: 1\r\n" * 101,
+     http.REQUEST_HEADER_FIELDS_TOO_LARGE),
+])
+def test_request_invalid(server, request_line, headers, expected):
+    status, _ = send_raw(server, request_line + b"\r\n" + headers + b"\r\n")
+    assert status == expected
+
+
+def test_request_headers(server):
+    status, body = send_raw(
+        server,
+        b"GET /request-info/arg HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"X-Mixed-Case:  value \r\n"
+        b"x-repeated: 1\r\n"
+        b"X-Repeated: 2\r\n"
+        b"connection: close\r\n"
+        b"\r\n")
+    assert status == http.OK
+    headers = json.loads(body)["headers"]
+    assert headers["x-mixed-case"] == "value"
+    assert headers["x-repeated"] == "1, 2"
+
+
+def test_request_http_1_0(server):
+    status, body = send_raw(server, b"GET /demo/name HTTP/1.0\r\n\r\n")
+    assert status == http.OK
+    assert body == b"name\n"
+
+
+def test_response_date(server):
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        con.request("GET", "/demo/name")
+        r = con.getresponse()
+        r.read()
+        date = email.utils.parsedate_to_datetime(r.getheader("date"))
+        assert abs(date.timestamp() - time.time()) < 2
+        assert r.getheader("server") == "imageio/" + version.string
+
+
+def send_raw(server, data):
+    """
+    Send raw request data on new connection, and return the response status
+    and body.
+    """
+    sock = socket.create_connection(("localhost", server.server_port))
+    with closing(sock):
+        sock.sendall(data)
+        res = http_client.HTTPResponse(sock)
+        res.begin()
+        return res.status, res.read()
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("parse_request", [
+    pytest.param(
+        http_server.BaseHTTPRequestHandler.parse_request, id="stdlib"),
+    pytest.param(http.Connection.parse_request, id="imageio"),
+])
+def test_parse_request_benchmark(parse_request):
+    request = (
+        b"PATCH /images/ticket-id HTTP/1.1\r\n"
+        b"Host: localhost:54322\r\n"
+        b"Accept-Encoding: identity\r\n"
+        b"Content-Type: application/json\r\n"
+        b"Content-Length: 65\r\n"
+        b"\r\n")
+    con = http.Connection.__new__(http.Connection)
+    con.raw_requestline, headers = request.split(b"\r\n", 1)
+    count = 100000
+
+    start = time.monotonic()
+    for i in range(count):
+        con.rfile = io.BytesIO(headers)
+        assert parse_request(con)
+    elapsed = time.monotonic() - start
+
+    print("%d requests, %.3f s, %.2f requests/s"
+          % (count, elapsed, count / elapsed))
+
+
+@pytest.mark.benchmark
+def test_requests_benchmark(server):
+    count = 10000
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        start = time.monotonic()
+        for i in range(count):
+            con.request("GET", "/demo/name")
+            r = con.getresponse()
+            r.read()
+        elapsed = time.monotonic() - start
+
+    print("%d requests, %.3f s, %.2f requests/s"
+          % (count, elapsed, count / elapsed))
+
+
 def test_demo_get_empty(server):
     con = http_client.HTTPConnection("localhost", server.server_port)
     with closing(con):
@@ -458,6 +625,148 @@ def test_echo_100_continue(server):
         assert r.read() == data
 
 
+@pytest.mark.parametrize("offset,count", [
+    pytest.param(0, 8 * 1024**2, id="full"),
+    pytest.param(42, 8 * 1024**2 - 42 - 1, id="unaligned"),
+])
+def test_sendfile(tmpdir, server, offset, count):
+    data = os.urandom(8 * 1024**2)
+    path = str(tmpdir.join("file"))
+    with open(path, "wb") as f:
+        f.write(data)
+
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        con.request(
+            "GET",
+            "/sendfile/?path={}&offset={}&count={}".format(
+                path, offset, count))
+        r = con.getresponse()
+        assert r.status == http.OK
+        assert int(r.getheader("content-length")) == count
+        # Reading slowly, so sending must wait until the socket is writable.
+        time.sleep(0.1)
+        assert r.read() == data[offset:offset + count]
+
+
+@pytest.mark.skipif(not hasattr(os, "splice"), reason="Requires os.splice")
+@pytest.mark.parametrize("offset,count", [
+    pytest.param(0, 8 * 1024**2, id="full"),
+    pytest.param(42, 8 * 1024**2 - 42 - 1, id="unaligned"),
+])
+def test_splice(tmpdir, server, offset, count):
+    data = os.urandom(count)
+    path = str(tmpdir.join("file"))
+    with open(path, "wb") as f:
+        f.truncate(offset + count)
+
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        con.putrequest("PUT", "/splice/?path={}&offset={}".format(
+            path, offset))
+        con.putheader("content-length", count)
+        # Send the start of the body with the headers, so it is buffered by
+        # the connection, and the rest slowly, so splicing must wait until
+        # the socket is readable.
+        con.endheaders(data[:4096])
+        time.sleep(0.1)
+        con.send(data[4096:])
+        r = con.getresponse()
+        assert r.status == http.OK
+        r.read()
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        assert f.read() == data
+
+
+@pytest.mark.skipif(not hasattr(os, "splice"), reason="Requires os.splice")
+def test_splice_chunked(tmpdir, server):
+    path = str(tmpdir.join("file"))
+    with open(path, "wb") as f:
+        f.truncate(4096)
+
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        # The content length does not match the chunked body, so splicing
+        # the body would copy the chunks framing into the file.
+        con.putrequest("PUT", "/splice/?path={}&offset=0".format(path))
+        con.putheader("content-length", 4096)
+        con.putheader("transfer-encoding", "chunked")
+        con.endheaders(b"1000\r\n" + b"x" * 4096 + b"\r\n0\r\n\r\n")
+        r = con.getresponse()
+        assert r.status == http.BAD_REQUEST
+        r.read()
+
+    with open(path, "rb") as f:
+        assert f.read() == b"\0" * 4096
+
+
+@pytest.mark.parametrize("enable_ktls", [True, False])
+def test_sendfile_tls(tmpdir, tmp_pki, enable_ktls):
+    data = os.urandom(1024**2)
+    path = str(tmpdir.join("file"))
+    with open(path, "wb") as f:
+        f.write(data)
+
+    server = http.Server(("localhost", 0), http.Connection)
+    server.app = http.Router([(r"/sendfile/", SendFile())])
+    ctx = ssl.server_context(
+        tmp_pki.certfile, tmp_pki.keyfile, enable_ktls=enable_ktls)
+    server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    t = util.start_thread(server.serve_forever, kwargs={"poll_interval": 0.1})
+    try:
+        con = http_client.HTTPSConnection(
+            "localhost",
+            server.server_port,
+            context=ssl.client_context(tmp_pki.cafile))
+        with closing(con):
+            con.request(
+                "GET",
+                "/sendfile/?path={}&offset=0&count={}".format(
+                    path, len(data)))
+            r = con.getresponse()
+            body = r.read()
+    finally:
+        server.shutdown()
+        t.join()
+
+    # Zero copy is possible only if the kernel encrypts the data.
+    if r.status == http.BAD_REQUEST:
+        assert b"Zero copy not supported" in body
+        if enable_ktls:
+            pytest.skip("Kernel TLS not available")
+    else:
+        assert enable_ktls
+        assert r.status == http.OK
+        assert body == data
+
+
+@pytest.mark.parametrize("count", [0, 1, 10])
+def test_send_chunked(server, count):
+    expected = b"".join(b"chunk %d\n" % i for i in range(count))
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        # The connection is kept open after a chunked response.
+        for i in range(2):
+            con.request("GET", "/chunked/?count={}".format(count))
+            r = con.getresponse()
+            assert r.status == http.OK
+            assert r.getheader("transfer-encoding") == "chunked"
+            assert r.getheader("content-length") is None
+            assert r.getheader("content-type") == "text/plain"
+            assert r.read() == expected
+
+
+def test_send_chunked_http_1_0(server):
+    # HTTP/1.0 clients do not support chunked transfer encoding, so the
+    # server closes the connection after the body.
+    status, body = send_raw(
+        server, b"GET /chunked/?count=3 HTTP/1.0\r\n\r\n")
+    assert status == http.OK
+    assert body == b"chunk 0\nchunk 1\nchunk 2\n"
+
+
 def test_json(server):
     con = http_client.HTTPConnection("localhost", server.server_port)
     with closing(con):
@@ -1161,3 +1470,71 @@ def test_prefer_ipv4(listen_address):
         with closing(con):
             con.request("GET", "/demo/name")
             con.getresponse()
+
+
+@contextmanager
+def pooled_server(max_workers, max_queued):
+    server = http.Server(("127.0.0.1", 0), http.Connection)
+    server.max_workers = max_workers
+    server.max_queued = max_queued
+    server.app = http.Router([(r"/demo/(.*)", Demo())])
+
+    t = util.start_thread(
+        server.serve_forever,
+        kwargs={"poll_interval": 0.1})
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        t.join()
+
+
+def test_pool_serve():
+    with pooled_server(max_workers=2, max_queued=2) as server:
+        for i in range(4):
+            con = http_client.HTTPConnection("localhost", server.server_port)
+            with closing(con):
+                con.request("GET", "/demo/{}".format(i))
+                r = con.getresponse()
+                assert r.status == http.OK
+                assert r.read() == b"%d\n" % i
+
+        stats = server.pool.stats()
+        assert stats["served"] == 4
+        assert 1 <= stats["workers"] <= 2
+        assert stats["max_wait"] >= 0
+
+
+def test_pool_limit_connections():
+    with pooled_server(max_workers=2, max_queued=2) as server:
+        busy = []
+        for i in range(2):
+            con = http_client.HTTPConnection("localhost", server.server_port)
+            busy.append(con)
+            con.request("GET", "/demo/busy")
+            con.getresponse().read()
+
+        # Both workers are serving keep-alive connections, so this connection
+        # must wait in the queue.
+        con = http_client.HTTPConnection(
+            "localhost", server.server_port, timeout=0.5)
+        with closing(con):
+            con.request("GET", "/demo/queued")
+            with pytest.raises(socket.timeout):
+                con.getresponse()
+
+            # Closing a busy connection frees a worker, serving the queued
+            # connection.
+            busy.pop().close()
+            con.sock.settimeout(5)
+            r = con.getresponse()
+            assert r.status == http.OK
+            assert r.read() == b"queued\n"
+
+        for con in busy:
+            con.close()
+
+        stats = server.pool.stats()
+        assert stats["workers"] == 2
+        assert stats["served"] == 3
+        assert stats["max_wait"] >= 0.5
@@ -1,6 +1,7 @@
 # SPDX-FileCopyrightText: Red Hat, Inc.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import fcntl
 import http.client as http_client
 import io
 import json
@@ -11,6 +12,7 @@ import pytest
 
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import server
+from ovirt_imageio._internal import uhttp
 
 from . import http
 from . import testutil
@@ -121,11 +123,109 @@ def test_images_zero(srv, tmpdir):
             assert f.read() == data[offset + size:]
 
 
+@pytest.fixture
+def fd_passing(srv):
+    srv.config.local.fd_passing = True
+    yield
+    srv.config.local.fd_passing = False
+
+
+@pytest.mark.parametrize("ops,mode,flags", [
+    (["read"], "r", os.O_RDONLY),
+    (["write"], "r+", os.O_RDWR),
+])
+def test_fd(srv, tmpdir, fd_passing, ops, mode, flags):
+    data = b"a" * 512 + b"b" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=1024, ops=ops)
+    srv.auth.add(ticket)
+
+    fd, info = uhttp.get_image_fd(
+        srv.local_service.address, ticket["uuid"], timeout=10)
+    try:
+        assert info == {"mode": mode, "size": 1024}
+        assert fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_ACCMODE == flags
+        assert os.pread(fd, 1024, 0) == data
+    finally:
+        os.close(fd)
+
+
+def test_fd_write_extents(srv, tmpdir, fd_passing):
+    image = tmpdir.join("image")
+    with open(str(image), "wb") as f:
+        f.truncate(1024**2)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=1024**2, ops=["write"])
+    srv.auth.add(ticket)
+
+    # Cache the image extents.
+    assert get_extents(srv, ticket) == [
+        {"start": 0, "length": 1024**2, "zero": True, "hole": False},
+    ]
+
+    fd, info = uhttp.get_image_fd(
+        srv.local_service.address, ticket["uuid"], timeout=10)
+    try:
+        os.pwrite(fd, b"x" * 4096, 0)
+    finally:
+        os.close(fd)
+
+    # Writes using the file descriptor are not hidden by the cache.
+    extents = get_extents(srv, ticket)
+    assert extents[0]["zero"] is False
+
+
+def get_extents(srv, ticket):
+    with http.LocalClient(srv.config) as c:
+        res = c.get("/images/{}/extents".format(ticket["uuid"]))
+        assert res.status == http_client.OK
+        return json.loads(res.read())
+
+
+def test_fd_disabled(srv, tmpdir):
+    image = testutil.create_tempfile(tmpdir, "image", b"x" * 512)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=512)
+    srv.auth.add(ticket)
+
+    with pytest.raises(uhttp.RequestError) as e:
+        uhttp.get_image_fd(srv.local_service.address, ticket["uuid"])
+    assert e.value.status == http_client.NOT_FOUND
+
+
+def test_fd_forbidden(srv, fd_passing):
+    with pytest.raises(uhttp.RequestError) as e:
+        uhttp.get_image_fd(srv.local_service.address, "no-such-ticket")
+    assert e.value.status == http_client.FORBIDDEN
+
+
+def test_fd_quote_ticket_id(srv, tmpdir, fd_passing):
+    image = testutil.create_tempfile(tmpdir, "image", b"x" * 512)
+    ticket = testutil.create_ticket(
+        uuid="ticket id?", url="file://" + str(image), size=512, ops=["read"])
+    srv.auth.add(ticket)
+
+    fd, info = uhttp.get_image_fd(
+        srv.local_service.address, ticket["uuid"], timeout=10)
+    os.close(fd)
+    assert info == {"mode": "r", "size": 512}
+
+
+def test_fd_unsupported_backend(srv, fd_passing):
+    ticket = testutil.create_ticket(url="nbd:unix:/no/such/socket")
+    srv.auth.add(ticket)
+
+    with pytest.raises(uhttp.RequestError) as e:
+        uhttp.get_image_fd(srv.local_service.address, ticket["uuid"])
+    assert e.value.status == http_client.NOT_FOUND
+
+
 def test_options(srv):
     with http.LocalClient(srv.config) as c:
         res = c.options("/images/*")
         allows = {"OPTIONS", "GET", "PUT", "PATCH"}
-        features = {"checksum", "extents", "flush", "zero"}
+        features = {"checksum", "extents", "extents_binary", "flush", "zero",
+                    "zero_ranges"}
         assert res.status == http_client.OK
         assert set(res.getheader("allow").split(',')) == allows
         options = json.loads(res.read())
@@ -5,6 +5,8 @@ import errno
 import io
 import logging
 import os
+import socket
+import struct
 
 import pytest
 import userstorage
@@ -534,6 +536,77 @@ def test_extents_reply_error(nbd_server, user_file):
         assert c.read(4096, 1) == b"\0"
 
 
+# Pipelined interface
+
+
+def test_aio_write_read(nbd_server):
+    nbd_server.start()
+    count = 32
+    size = 64 * 1024
+
+    with nbd.open(nbd_server.url, max_inflight=8) as c:
+        for i in range(count):
+            c.aio_write(i * size, bytes([i]) * size)
+            assert c.inflight <= 8
+        c.wait()
+        assert c.inflight == 0
+
+        bufs = [bytearray(size) for i in range(count)]
+        cmds = [c.aio_readinto(i * size, bufs[i]) for i in range(count)]
+        for cmd in cmds:
+            assert c.wait(cmd) == size
+
+    for i, buf in enumerate(bufs):
+        assert buf == bytes([i]) * size
+
+
+def test_aio_callback(nbd_server):
+    nbd_server.start()
+    done = []
+
+    with nbd.open(nbd_server.url) as c:
+        write = c.aio_write(0, b"x" * 4096, callback=done.append)
+        zero = c.aio_zero(4096, 4096, callback=done.append)
+        flush = c.aio_flush(callback=done.append)
+        c.wait()
+
+        assert sorted(done, key=lambda cmd: cmd.handle) == [write, zero, flush]
+        assert all(cmd.done and cmd.error is None for cmd in done)
+
+
+def test_aio_extents(nbd_server):
+    nbd_server.start()
+
+    with nbd.open(nbd_server.url) as c:
+        c.write(0, b"x" * 1024**2)
+        cmd = c.aio_extents(0, c.export_size)
+        reply = c.wait(cmd)
+
+    assert reply[nbd.BASE_ALLOCATION][0] == nbd.Extent(1024**2, 0)
+
+
+def test_aio_error(nbd_server):
+    nbd_server.start()
+
+    with nbd.open(nbd_server.url) as c:
+        ok = c.aio_write(0, b"x" * 4096)
+        bad = c.aio_readinto(c.export_size, bytearray(4096))
+        c.wait(ok)
+
+        with pytest.raises(nbd.ReplyError):
+            c.wait(bad)
+
+        # Failed command does not break the connection.
+        assert c.inflight == 0
+        assert c.read(0, 4096) == b"x" * 4096
+
+
+def test_aio_invalid_max_inflight(nbd_server):
+    nbd_server.start()
+    with pytest.raises(ValueError):
+        nbd.open(nbd_server.url, max_inflight=0)
+
+
 # Communicate with qemu builtin NBD server
 
 
@@ -806,6 +879,172 @@ def test_extent_merge_qcow2_data_cluster():
     assert merged.hole is False
 
 
+def test_extent_list_unpack_base_allocation():
+    data = b"".join([
+        nbd.Extent.pack(4096, 0),
+        nbd.Extent.pack(8192, nbd.STATE_ZERO),
+        nbd.Extent.pack(4096, nbd.STATE_ZERO | nbd.STATE_HOLE),
+        # Unexpected bits are ignored.
+        nbd.Extent.pack(4096, 0xffff),
+    ])
+    extents = nbd.ExtentList.unpack(data)
+    assert extents == [
+        nbd.Extent(4096, 0),
+        nbd.Extent(8192, nbd.STATE_ZERO),
+        nbd.Extent(4096, nbd.STATE_ZERO | nbd.STATE_HOLE),
+        nbd.Extent(4096, nbd.STATE_ZERO | nbd.STATE_HOLE),
+    ]
+
+    # Same result as unpacking every descriptor.
+    assert extents == [
+        nbd.Extent.unpack(data[i:i + nbd.Extent.size])
+        for i in range(0, len(data), nbd.Extent.size)
+    ]
+
+
+def test_extent_list_unpack_dirty_bitmap():
+    data = b"".join([
+        nbd.Extent.pack(4096, 0),
+        nbd.Extent.pack(4096, nbd.STATE_DIRTY),
+        nbd.Extent.pack(4096, 0xffff),
+    ])
+    extents = nbd.ExtentList.unpack(data, nbd.Extent.DIRTY)
+    assert extents == [
+        nbd.Extent(4096, 0),
+        nbd.Extent(4096, nbd.EXTENT_DIRTY),
+        nbd.Extent(4096, nbd.EXTENT_DIRTY),
+    ]
+
+
+def test_extent_list_unpack_depth():
+    data = b"".join([
+        nbd.Extent.pack(65536, 0),
+        nbd.Extent.pack(4096, 1),
+        nbd.Extent.pack(4096, 2),
+    ])
+    extents = nbd.ExtentList.unpack(data, nbd.Extent.DEPTH)
+    assert extents == [
+        nbd.Extent(65536, nbd.EXTENT_BACKING),
+        nbd.Extent(4096, 0),
+        nbd.Extent(4096, 0),
+    ]
+
+
+@pytest.mark.parametrize("data", [
+    pytest.param(
+        nbd.Extent.pack(4096, 0) + nbd.Extent.pack(0, 0), id="zero-length"),
+    pytest.param(nbd.Extent.pack(4096, 0)[:-1], id="partial-descriptor"),
+])
+def test_extent_list_unpack_invalid(data):
+    with pytest.raises(nbd.ProtocolError):
+        nbd.ExtentList.unpack(data)
+
+
+def test_extent_list_view():
+    extents = nbd.ExtentList.create([
+        nbd.Extent(4096, 0),
+        nbd.Extent(8192, nbd.STATE_ZERO),
+    ])
+    assert len(extents) == 2
+    assert extents[1] == nbd.Extent(8192, nbd.STATE_ZERO)
+    assert list(extents) == [
+        nbd.Extent(4096, 0),
+        nbd.Extent(8192, nbd.STATE_ZERO),
+    ]
+    assert list(extents.items()) == [(4096, 0), (8192, nbd.STATE_ZERO)]
+    assert nbd.ExtentList.create(extents) is extents
+
+
+def test_extent_list_merged():
+    alloc = nbd.ExtentList.create([
+        nbd.Extent(4096, 0),
+        nbd.Extent(8192, nbd.STATE_ZERO),
+    ])
+    dirty = nbd.ExtentList.create([
+        nbd.Extent(8192, nbd.EXTENT_DIRTY),
+        nbd.Extent(8192, 0),
+    ])
+
+    # Merging ends when the shorter list ends.
+    assert alloc.merged(dirty) == [
+        nbd.Extent(4096, nbd.EXTENT_DIRTY),
+        nbd.Extent(4096, nbd.STATE_ZERO | nbd.EXTENT_DIRTY),
+        nbd.Extent(4096, nbd.STATE_ZERO),
+    ]
+    assert dirty.merged(alloc) == alloc.merged(dirty)
+
+
+def test_extent_list_coalesced():
+    extents = nbd.ExtentList.create([
+        nbd.Extent(4096, 0),
+        nbd.Extent(4096, 0),
+        nbd.Extent(4096, nbd.STATE_ZERO),
+        nbd.Extent(4096, 0),
+        nbd.Extent(4096, 0),
+    ])
+    assert extents.coalesced() == [
+        nbd.Extent(8192, 0),
+        nbd.Extent(4096, nbd.STATE_ZERO),
+        nbd.Extent(8192, 0),
+    ]
+    assert nbd.ExtentList().coalesced() == []
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    """
+    Yield a connected client and the server socket, skipping the handshake.
+    """
+    client_sock, server_sock = socket.socketpair()
+
+    def connect(self, address):
+        return client_sock
+
+    def handshake(self, dirty):
+        self.export_size = 1024**2
+        self.transmission_flags = 0
+        self._structured_reply = True
+        self._state = nbd.TRANSMISSION
+
+    monkeypatch.setattr(nbd.Client, "_connect", connect)
+    monkeypatch.setattr(nbd.Client, "_newstyle_handshake", handshake)
+
+    with server_sock, nbd.Client(nbd.UnixAddress("/fake")) as c:
+        yield c, server_sock
+
+
+def send_chunk(sock, flags, type, handle, payload=b""):
+    sock.sendall(struct.pack(
+        "!IHHQI", nbd.STRUCTURED_REPLY_MAGIC, flags, type, handle,
+        len(payload)))
+    sock.sendall(payload)
+
+
+def test_reply_error_chunk_not_done(fake_server):
+    c, server = fake_server
+    cmd1 = c.aio_write(0, b"x" * 512)
+    cmd2 = c.aio_write(512, b"y" * 512)
+
+    # The server may send more chunks after the error chunk. The request
+    # fails when receiving the last chunk.
+    message = b"writing to file failed"
+    send_chunk(
+        server, 0, nbd.REPLY_TYPE_ERROR, cmd1.handle,
+        struct.pack("!IH", errno.ENOSPC, len(message)) + message)
+    send_chunk(
+        server, nbd.REPLY_FLAG_DONE, nbd.REPLY_TYPE_NONE, cmd2.handle)
+    send_chunk(
+        server, nbd.REPLY_FLAG_DONE, nbd.REPLY_TYPE_NONE, cmd1.handle)
+
+    assert c.poll() is cmd2
+    assert not cmd1.done
+
+    with pytest.raises(nbd.ReplyError) as e:
+        c.wait(cmd1)
+    assert e.value.code == errno.ENOSPC
+    assert c.inflight == 0
+
+
 def test_reply_error_structured():
     s = str(nbd.ReplyError(28, "writing to file failed"))
     assert s == "Writing to file failed: [Error 28] No space left on device"
@@ -49,6 +49,22 @@ class FakeClient:
         else:
             self.dirty_bitmap = None
 
+        # Block status commands sent and not waited for yet.
+        self.inflight = []
+        # Maximum number of commands in flight seen.
+        self.max_inflight = 0
+
+    def aio_extents(self, offset, length):
+        cmd = FakeCommand(offset, length, self.extents(offset, length))
+        self.inflight.append(cmd)
+        self.max_inflight = max(self.max_inflight, len(self.inflight))
+        return cmd
+
+    def wait(self, cmd):
+        self.inflight.remove(cmd)
+        cmd.done = True
+        return cmd.reply
+
     def extents(self, offset, length):
         """
         Simulate real NBD server extents reply.
@@ -130,6 +146,15 @@ class FakeClient:
                 break
 
 
+class FakeCommand:
+
+    def __init__(self, offset, length, reply):
+        self.offset = offset
+        self.length = length
+        self.reply = reply
+        self.done = False
+
+
 def fake_client(n, max_extents=0):
     """
     A client simulating few interesting cases:
@@ -415,6 +440,101 @@ def test_extents_last_extent_excceeds_export_size_dirty():
     ]
 
 
+@pytest.mark.parametrize("queue_depth,max_inflight", [
+    (1, 1),
+    (2, 2),
+    # Limited by the number of steps.
+    (8, 3),
+])
+@pytest.mark.parametrize("max_extents", [None, 1, 2])
+def test_extents_queue_depth(queue_depth, max_inflight, max_extents):
+    n = GiB
+    c = fake_client(n, max_extents=max_extents)
+    extents = list(nbdutil.extents(c, queue_depth=queue_depth))
+
+    # Replies are merged in order, regardless of the queue depth.
+    assert extents == [
+        nbd.Extent(2 * n, 0),
+        nbd.Extent(2 * n, STATE_ZERO | STATE_HOLE),
+        nbd.Extent(2 * n, STATE_ZERO | STATE_HOLE | EXTENT_BACKING),
+    ]
+    assert c.max_inflight == max_inflight
+    assert c.inflight == []
+
+
+def test_extents_stop_iteration():
+    n = GiB
+    c = fake_client(n)
+    it = nbdutil.extents(c, queue_depth=3)
+    assert next(it) == nbd.Extent(2 * n, 0)
+    assert len(c.inflight) == 1
+
+    # Closing the iterator waits for in-flight commands.
+    it.close()
+    assert c.inflight == []
+
+
+class FailingClient(FakeClient):
+    """
+    Fail waiting for commands, simulating a command error if done is True, or
+    a connection error if done is False.
+    """
+
+    def __init__(self, *args, errors=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = list(errors)
+        self.waits = 0
+
+    def wait(self, cmd):
+        self.waits += 1
+        if self.errors:
+            error, done = self.errors.pop(0)
+            if done:
+                self.inflight.remove(cmd)
+                cmd.done = True
+            raise error
+        return super().wait(cmd)
+
+
+def failing_client(n, errors):
+    c = fake_client(n)
+    return FailingClient(c.alloc, depth=c.depth, errors=errors)
+
+
+def test_extents_command_error():
+    n = GiB
+    error = nbd.ReplyError(5, "Fake error")
+    c = failing_client(n, errors=[(error, True)])
+
+    with pytest.raises(nbd.ReplyError) as e:
+        list(nbdutil.extents(c, queue_depth=3))
+    assert e.value is error
+
+    # Pending commands are waited for after a failure.
+    assert c.inflight == []
+
+
+def test_extents_connection_error():
+    n = GiB
+    error = OSError("Fake connection error")
+    c = failing_client(
+        n, errors=[(error, False), (OSError("Fake drain error"), False)])
+
+    # The original error is not hidden by errors waiting for pending commands.
+    with pytest.raises(OSError) as e:
+        list(nbdutil.extents(c, queue_depth=3))
+    assert e.value is error
+
+    # Waiting stopped after the first failure to receive a reply.
+    assert c.waits == 2
+
+
+def test_extents_invalid_queue_depth():
+    c = fake_client(GiB)
+    with pytest.raises(ValueError):
+        list(nbdutil.extents(c, queue_depth=0))
+
+
 # Testing nbdutil.merged()
 
 
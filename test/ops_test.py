@@ -154,6 +154,163 @@ def test_read_seek():
     assert dst.getvalue() == b"01234"
 
 
+@pytest.mark.parametrize("offset,size", OFFSET_SIZE)
+def test_read_ahead_full(user_file, offset, size):
+    data = b"b" * size
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"a" * offset)
+        f.write(data)
+
+    dst = io.BytesIO()
+    with file.open(user_file.url, "r") as src, \
+            util.aligned_buffer(128 * 1024) as buf:
+        op = ops.Read(src, dst, buf, size, offset=offset, read_ahead=1)
+        op.run()
+
+    assert dst.getvalue() == data
+
+
+@pytest.mark.parametrize("read_ahead", [1, 2, 4])
+@pytest.mark.parametrize("offset,size", [
+    pytest.param(0, 4096, id="single-chunk"),
+    pytest.param(0, 8192, id="aligned"),
+    pytest.param(42, 8192 - 42, id="unaligned-offset"),
+    pytest.param(42, 5000, id="unaligned-offset-and-size"),
+])
+def test_read_ahead_memory(read_ahead, offset, size):
+    data = bytearray(os.urandom(offset + size))
+    src = memory.Backend("r", data)
+    dst = io.BytesIO()
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Read(src, dst, buf, size, offset=offset,
+                      read_ahead=read_ahead)
+        op.run()
+
+    assert dst.getvalue() == data[offset:]
+    assert op.done == size
+
+
+def test_read_ahead_partial_content():
+    src = memory.Backend("r", bytearray(b"x" * 8191))
+    dst = io.BytesIO()
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Read(src, dst, buf, 8192, read_ahead=1)
+        with pytest.raises(errors.PartialContent) as e:
+            op.run()
+
+    assert e.value.requested == 8192
+    assert e.value.available == 8191
+    assert dst.getvalue() == b"x" * 8191
+
+
+def test_read_ahead_write_error():
+
+    class Error(Exception):
+        pass
+
+    class Writer:
+        def __init__(self):
+            self.chunks = 0
+
+        def write(self, buf):
+            self.chunks += 1
+            if self.chunks == 2:
+                raise Error
+
+    src = memory.Backend("r", bytearray(b"x" * 8192))
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Read(src, Writer(), buf, 8192, read_ahead=1)
+        with pytest.raises(Error):
+            op.run()
+
+
+def test_read_ahead_cancel():
+
+    class Writer:
+        def __init__(self, op):
+            self.op = op
+
+        def write(self, buf):
+            self.op.cancel()
+
+    src = memory.Backend("r", bytearray(b"x" * 8192))
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Read(src, None, buf, 8192, read_ahead=1)
+        op._dst = Writer(op)
+        with pytest.raises(ops.Canceled):
+            op.run()
+
+    assert op.done == 1024
+
+
+class SendfileWriter(io.BytesIO):
+    """
+    Destination supporting sendfile(), like http.Response.
+    """
+
+    zero_copy = True
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def sendfile(self, fd, offset, count):
+        self.calls += 1
+        data = os.pread(fd, count, offset)
+        self.write(data)
+        return len(data)
+
+
+@pytest.mark.parametrize("offset,size", OFFSET_SIZE)
+def test_read_zero_copy(user_file, offset, size):
+    data = b"b" * size
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"a" * offset)
+        f.write(data)
+        f.write(b"c" * 8192)
+
+    dst = SendfileWriter()
+    buf_size = 1024**2
+    with file.open(user_file.url, "r") as src, \
+            util.aligned_buffer(buf_size) as buf:
+        op = ops.Read(src, dst, buf, size, offset=offset, zero_copy=True)
+        op.run()
+
+    assert dst.getvalue() == data
+    # Data is sent in buffer size chunks.
+    assert dst.calls == (size + buf_size - 1) // buf_size
+    assert op.done == size
+
+
+def test_read_zero_copy_partial_content(user_file):
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(8191)
+
+    dst = SendfileWriter()
+    with file.open(user_file.url, "r") as src, \
+            util.aligned_buffer(4096) as buf:
+        op = ops.Read(src, dst, buf, 8192, zero_copy=True)
+        with pytest.raises(errors.PartialContent) as e:
+            op.run()
+
+    assert e.value.requested == 8192
+    assert e.value.available == 8191
+
+
+def test_read_zero_copy_unsupported():
+    # Memory backend does not support sendfile(), so data is copied.
+    src = memory.Backend("r", bytearray(b"x" * 8192))
+    dst = SendfileWriter()
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Read(src, dst, buf, 8192, zero_copy=True)
+        op.run()
+
+    assert dst.getvalue() == b"x" * 8192
+    assert dst.calls == 0
+
+
 def test_read_repr():
     op = ops.Read(None, None, None, 200, offset=24)
     rep = repr(op)
@@ -320,6 +477,274 @@ def test_write_no_size(user_file, offset, size):
         assert f.read() == b"\0" * trailer
 
 
+@pytest.mark.parametrize("write_behind", [1, 2, 4])
+@pytest.mark.parametrize("offset,size", [
+    pytest.param(0, 1024, id="single-chunk"),
+    pytest.param(0, 8192, id="aligned"),
+    pytest.param(42, 8192 - 42, id="unaligned-offset"),
+    pytest.param(42, 5000, id="unaligned-offset-and-size"),
+])
+def test_write_behind_memory(write_behind, offset, size):
+    dst = memory.Backend("r+", bytearray(offset + size))
+    data = os.urandom(size)
+    src = io.BytesIO(data)
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Write(dst, src, buf, size, offset=offset,
+                       write_behind=write_behind)
+        op.run()
+
+    assert dst.data()[offset:] == data
+    assert op.done == size
+    assert not dst.dirty
+
+
+def test_write_behind_full(user_file):
+    size = 1024**2
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(size)
+
+    data = os.urandom(size)
+    src = util.UnbufferedStream([data[i:i + 4096]
+                                 for i in range(0, size, 4096)])
+    with file.open(user_file.url, "r+") as dst, \
+            util.aligned_buffer(128 * 1024) as buf:
+        op = ops.Write(dst, src, buf, size, write_behind=2)
+        op.run()
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read() == data
+
+
+def test_write_behind_no_size():
+    dst = memory.Backend("r+", bytearray(8192))
+    src = io.BytesIO(b"x" * 5000)
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Write(dst, src, buf, write_behind=1)
+        op.run()
+
+    assert dst.data() == b"x" * 5000 + b"\0" * (8192 - 5000)
+    assert op.done == 5000
+
+
+def test_write_behind_partial_content():
+    dst = memory.Backend("r+", bytearray(8192))
+    src = io.BytesIO(b"x" * 8191)
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Write(dst, src, buf, 8192, write_behind=1)
+        with pytest.raises(errors.PartialContent) as e:
+            op.run()
+
+    assert e.value.requested == 8192
+    assert e.value.available == 8191
+    assert dst.data() == b"x" * 8191 + b"\0"
+
+
+def test_write_behind_write_error():
+
+    class Error(Exception):
+        pass
+
+    class Backend(memory.Backend):
+        def write(self, buf):
+            if self.tell() == 2048:
+                raise Error
+            return super().write(buf)
+
+    dst = Backend("r+", bytearray(8192))
+    src = io.BytesIO(b"x" * 8192)
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Write(dst, src, buf, 8192, write_behind=1)
+        with pytest.raises(Error):
+            op.run()
+
+    # Data after the failed chunk was not written, and the backend was not
+    # flushed.
+    assert dst.data()[2048:] == b"\0" * (8192 - 2048)
+    assert dst.dirty
+
+
+def test_write_behind_cancel():
+
+    class Reader:
+        def __init__(self):
+            self.op = None
+
+        def readinto(self, buf):
+            self.op.cancel()
+            buf[:] = b"x" * len(buf)
+            return len(buf)
+
+    dst = memory.Backend("r+", bytearray(8192))
+    src = Reader()
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Write(dst, src, buf, 8192, write_behind=1)
+        src.op = op
+        with pytest.raises(ops.Canceled):
+            op.run()
+
+    assert op.done <= 1024
+
+
+class CountingBackend(memory.Backend):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def write(self, buf):
+        self.calls.append(("write", self.tell(), len(buf)))
+        return super().write(buf)
+
+    def zero(self, count):
+        self.calls.append(("zero", self.tell(), count))
+        # memory.Backend.zero() calls write().
+        return super().write(b"\0" * count)
+
+
+@pytest.mark.parametrize("write_behind", [0, 1])
+def test_write_detect_zeroes(write_behind):
+    block = ops.Write.ZERO_BLOCK_SIZE
+    data = (b"x" * block +
+            b"\0" * 2 * block +
+            b"x" * 42 + b"\0" * (block - 42) +
+            b"\0" * 100)
+    dst = CountingBackend("r+", bytearray(b"y" * len(data)))
+    src = io.BytesIO(data)
+    with util.aligned_buffer(8 * block) as buf:
+        op = ops.Write(dst, src, buf, len(data), detect_zeroes=True,
+                       write_behind=write_behind)
+        op.run()
+
+    assert dst.data() == data
+    assert op.done == len(data)
+
+    # Blocks with any data are written, and consecutive zero blocks are
+    # zeroed using single call.
+    assert dst.calls == [
+        ("write", 0, block),
+        ("zero", block, 2 * block),
+        ("write", 3 * block, block),
+        ("zero", 4 * block, 100),
+    ]
+
+
+def test_write_detect_zeroes_unaligned_offset():
+    block = ops.Write.ZERO_BLOCK_SIZE
+    offset = block - 100
+    data = b"\0" * 100 + b"\0" * block + b"x" * 100
+    dst = CountingBackend("r+", bytearray(b"y" * (offset + len(data))))
+    src = io.BytesIO(data)
+    with util.aligned_buffer(8 * block) as buf:
+        op = ops.Write(dst, src, buf, len(data), offset=offset,
+                       detect_zeroes=True)
+        op.run()
+
+    assert dst.data()[offset:] == data
+
+    # Zero detection is aligned to the image offset.
+    assert dst.calls == [
+        ("zero", offset, 100 + block),
+        ("write", 2 * block, 100),
+    ]
+
+
+def test_write_detect_zeroes_disabled():
+    block = ops.Write.ZERO_BLOCK_SIZE
+    data = b"\0" * 2 * block
+    dst = CountingBackend("r+", bytearray(b"y" * len(data)))
+    src = io.BytesIO(data)
+    with util.aligned_buffer(8 * block) as buf:
+        op = ops.Write(dst, src, buf, len(data))
+        op.run()
+
+    assert dst.data() == data
+    assert dst.calls == [("write", 0, 2 * block)]
+
+
+class SpliceReader(io.BytesIO):
+    """
+    Source supporting splice(), like http.Request.
+    """
+
+    zero_copy = True
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.calls = 0
+
+    def splice(self, fd, offset, count):
+        self.calls += 1
+        data = self.read(count)
+        return os.pwrite(fd, data, offset)
+
+
+@pytest.mark.parametrize("offset,size", OFFSET_SIZE)
+def test_write_zero_copy(user_file, offset, size):
+    trailer = 8192
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(offset + size + trailer)
+
+    src = SpliceReader(b"x" * size)
+    with file.open(user_file.url, "r+") as dst, \
+            util.aligned_buffer(1024**2) as buf:
+        op = ops.Write(dst, src, buf, size, offset=offset, zero_copy=True)
+        op.run()
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read(offset) == b"\0" * offset
+        assert f.read(size) == src.getvalue()
+        assert f.read() == b"\0" * trailer
+
+    # Only complete blocks are spliced.
+    if size >= 2 * user_file.sector_size:
+        assert src.calls > 0
+    assert op.done == size
+
+
+def test_write_zero_copy_partial_content(user_file):
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(8192)
+
+    src = SpliceReader(b"x" * 8191)
+    with file.open(user_file.url, "r+") as dst, \
+            util.aligned_buffer(4096) as buf:
+        op = ops.Write(dst, src, buf, 8192, zero_copy=True)
+        with pytest.raises(errors.PartialContent) as e:
+            op.run()
+
+    assert e.value.requested == 8192
+    assert e.value.available == 8191
+
+
+def test_write_zero_copy_unsupported():
+    # Memory backend does not support splice(), so data is copied.
+    dst = memory.Backend("r+", bytearray(8192))
+    src = SpliceReader(b"x" * 8192)
+    with util.aligned_buffer(1024) as buf:
+        op = ops.Write(dst, src, buf, 8192, zero_copy=True)
+        op.run()
+
+    assert dst.data() == b"x" * 8192
+    assert src.calls == 0
+
+
+def test_write_zero_copy_detect_zeroes(user_file):
+    # Detecting zeroes needs the data in the buffer, so data is copied.
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(8192)
+
+    src = SpliceReader(b"x" * 8192)
+    with file.open(user_file.url, "r+") as dst, \
+            util.aligned_buffer(4096) as buf:
+        op = ops.Write(dst, src, buf, 8192, detect_zeroes=True,
+                       zero_copy=True)
+        op.run()
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read() == b"x" * 8192
+    assert src.calls == 0
+
+
 @pytest.mark.parametrize("sparse", [
     pytest.param(True, id="sparse"),
     pytest.param(False, id="preallocated"),
@@ -0,0 +1,121 @@
+# SPDX-FileCopyrightText: Red Hat, Inc.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import os
+
+from contextlib import ExitStack
+
+import pytest
+
+from ovirt_imageio._internal import bufpool
+from ovirt_imageio._internal import config
+from ovirt_imageio._internal import server
+
+from . import http
+from . import testutil
+
+WORKERS = 3
+
+
+@pytest.fixture(scope="module")
+def srv():
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.remote.workers = WORKERS
+    s = server.Server(cfg)
+    s.start()
+    yield s
+    s.stop()
+
+
+def test_workers_started(srv):
+    assert len(srv.workers) == WORKERS - 1
+    for worker in srv.workers:
+        assert worker.pid != os.getpid()
+
+
+def test_buffer_pool_size(srv):
+    # Every process has its own pool, inherited by the workers, so the pool
+    # size is divided between the processes.
+    max_size = srv.config.daemon.buffer_pool_size // WORKERS
+    assert bufpool.stats()["max_size"] == max_size
+
+
+def test_ticket_forwarding(tmpdir, srv):
+    data = b"x" * 4096
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://{}".format(image), size=len(data), ops=["read"])
+
+    with http.ControlClient(srv.config) as c:
+        res = c.put("/tickets/" + ticket["uuid"], json.dumps(ticket))
+        assert res.status == 200
+        res.read()
+
+    # Open enough connections to reach all processes. Every connection keeps
+    # the ticket context until the connection is closed.
+    connections = WORKERS * 4
+    with ExitStack() as stack:
+        for _ in range(connections):
+            client = stack.enter_context(http.RemoteClient(srv.config))
+            res = client.get("/images/" + ticket["uuid"])
+            assert res.status == 200
+            assert res.read() == data
+
+        # Ticket info includes the connections in all processes.
+        with http.ControlClient(srv.config) as c:
+            res = c.get("/tickets/" + ticket["uuid"])
+            assert res.status == 200
+            info = json.loads(res.read())
+            assert info["connections"] == connections
+            # All connections read the same range.
+            assert info["transferred"] == len(data)
+
+    with http.ControlClient(srv.config) as c:
+        res = c.delete("/tickets/" + ticket["uuid"])
+        assert res.status == 204
+        res.read()
+
+    # The ticket was removed from all processes.
+    for _ in range(connections):
+        with http.RemoteClient(srv.config) as client:
+            res = client.get("/images/" + ticket["uuid"])
+            assert res.status == 403
+            res.read()
+
+
+def unix_socket_paths(pid):
+    """
+    Return the addresses of the unix sockets used by process pid.
+    """
+    inodes = set()
+    fd_dir = "/proc/{}/fd".format(pid)
+    for name in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, name))
+        except FileNotFoundError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(target[len("socket:["):-1])
+
+    paths = []
+    with open("/proc/net/unix") as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            # Unnamed sockets have no path field.
+            if fields[6] in inodes and len(fields) > 7:
+                paths.append(fields[7])
+    return paths
+
+
+def test_worker_channel_has_no_address(srv):
+    for worker in srv.workers:
+        # The worker is controlled using a socket pair, which has no address
+        # that another process can connect to.
+        assert worker.channel.getsockname() in ("", b"")
+        assert worker.channel.getpeername() in ("", b"")
+        # The worker does not listen on unix sockets. Sockets inherited from
+        # the main process are also used by the main process.
+        worker_paths = set(unix_socket_paths(worker.pid))
+        assert worker_paths <= set(unix_socket_paths(os.getpid()))
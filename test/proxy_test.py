@@ -52,9 +52,10 @@ def test_images_extents(daemon, proxy, tmpfile):
 
     assert res.status == 200
 
+    # The file is a hole, reported as zero extent.
     extents = json.loads(data)
     assert extents == [
-        {"start": 0, "length": size, "zero": False, "hole": False}
+        {"start": 0, "length": size, "zero": True, "hole": False}
     ]
 
 
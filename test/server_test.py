@@ -12,6 +12,7 @@ import pytest
 from contextlib import contextmanager
 
 from ovirt_imageio._internal import config
+from ovirt_imageio._internal import errors
 from ovirt_imageio._internal import server
 from ovirt_imageio._internal import sockutil
 
@@ -136,6 +137,26 @@ def test_load_config_no_conf_files(tmpdir):
         server.load_config(str(conf_dir))
 
 
+@pytest.mark.parametrize("pool_size,workers,expected", [
+    (0, 4, 0),
+    (64 * 1024**2, 1, 64 * 1024**2),
+    (64 * 1024**2, 4, 16 * 1024**2),
+])
+def test_buffer_pool_size(pool_size, workers, expected):
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.daemon.buffer_pool_size = pool_size
+    cfg.remote.workers = workers
+    assert server._buffer_pool_size(cfg) == expected
+
+
+def test_buffer_pool_size_too_small():
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.daemon.buffer_pool_size = 64 * 1024**2
+    cfg.remote.workers = 8
+    with pytest.raises(errors.InvalidConfig):
+        server._buffer_pool_size(cfg)
+
+
 def test_show_config():
     cfg = config.load(["test/conf.d/daemon.conf"])
     out = subprocess.check_output(
@@ -2,7 +2,11 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import os
+import shutil
+import socket
+import time
 
+from contextlib import closing
 from contextlib import contextmanager
 
 import pytest
@@ -10,13 +14,15 @@ import pytest
 from ovirt_imageio._internal import auth
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import services
+from ovirt_imageio._internal import ssl
 from ovirt_imageio._internal.ssl import check_protocol
 
 
 @contextmanager
-def remote_service(config_file):
+def remote_service(config_file, session_tickets=True):
     path = os.path.join("test/conf", config_file)
     cfg = config.load([path])
+    cfg.tls.session_tickets = session_tickets
     authorizer = auth.Authorizer(cfg)
     s = services.RemoteService(cfg, authorizer)
     s.start()
@@ -38,3 +44,82 @@ def test_default_accept(protocol):
     with remote_service("daemon.conf") as service:
         rc = check_protocol("127.0.0.1", service.port, protocol)
     assert rc == 0
+
+
+def test_server_context_cached():
+    args = ("test/pki/system/cert.pem", "test/pki/system/key.pem")
+    # Worker processes use the context created in the main process, sharing
+    # the session tickets keys.
+    assert ssl.server_context(*args) is ssl.server_context(*args)
+    assert ssl.server_context(*args) is not ssl.server_context(
+        *args, session_tickets=False)
+
+
+def test_server_context_rotated(tmpdir):
+    certfile = str(tmpdir.join("cert.pem"))
+    keyfile = str(tmpdir.join("key.pem"))
+    shutil.copyfile("test/pki/system/cert.pem", certfile)
+    shutil.copyfile("test/pki/system/key.pem", keyfile)
+    ctx = ssl.server_context(certfile, keyfile)
+
+    # Rotating the certificate replaces the file; the new certificate must be
+    # loaded by the next server.
+    tmpfile = certfile + ".tmp"
+    shutil.copyfile("test/pki/system/cert.pem", tmpfile)
+    os.rename(tmpfile, certfile)
+
+    new_ctx = ssl.server_context(certfile, keyfile)
+    assert new_ctx is not ctx
+    assert ssl.server_context(certfile, keyfile) is new_ctx
+
+
+@pytest.mark.parametrize("session_tickets,resumed", [
+    (True, 1),
+    (False, 0),
+])
+def test_session_resumption(session_tickets, resumed):
+    with remote_service("daemon.conf", session_tickets) as service:
+        ctx = ssl.client_context("test/pki/system/ca.pem")
+        session = None
+        for i in range(2):
+            session = get_info(ctx, service.port, session)
+
+        # The server records the handshake when it starts serving the
+        # connection.
+        deadline = time.monotonic() + 2
+        while sum(service._server.handshakes().values()) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        assert service._server.handshakes() == {
+            "full": 2 - resumed,
+            "resumed": resumed,
+        }
+
+
+def get_info(ctx, port, session=None):
+    """
+    Send GET /info/ on a new connection, resuming session if possible, and
+    return the connection session.
+    """
+    sock = socket.create_connection(("localhost", port))
+    sock = ctx.wrap_socket(sock, server_hostname="localhost", session=session)
+    with closing(sock):
+        sock.sendall(
+            b"GET /info/ HTTP/1.1\r\nHost: localhost\r\n"
+            b"Connection: close\r\n\r\n")
+        # Session tickets are sent after the handshake, so we must read the
+        # response to get a resumable session.
+        while sock.recv(4096):
+            pass
+        return sock.session
+
+
+def test_server_context_ktls():
+    args = ("test/pki/system/cert.pem", "test/pki/system/key.pem")
+    ctx = ssl.server_context(*args)
+    assert not ctx.options & ssl.OP_ENABLE_KTLS
+
+    ctx = ssl.server_context(*args, enable_ktls=True)
+    if ssl.ssl.OPENSSL_VERSION_INFO >= (3, 0):
+        assert ctx.options & ssl.OP_ENABLE_KTLS